@@ -0,0 +1,79 @@
+"""
+Load Test for the Customer Service
+
+Hammers a running service with concurrent keep-alive clients and reports
+throughput and latency percentiles, so gunicorn settings can be compared
+on the same box.
+
+Usage:
+    # the old single sync worker
+    gunicorn --workers=1 --worker-class=sync --bind 0.0.0.0:8080 service:app
+    python benchmarks/load_test.py --url http://localhost:8080/customers
+
+    # the tuned production configuration
+    gunicorn --config gunicorn.conf.py service:app
+    python benchmarks/load_test.py --url http://localhost:8080/customers
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(samples, pct):
+    """Returns the pct percentile of a sorted list of samples"""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+    return samples[index]
+
+
+def run_client(url, deadline, latencies, errors, lock):
+    """Issues requests on one keep-alive session until the deadline"""
+    session = requests.Session()
+    local_latencies = []
+    local_errors = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = session.get(url, timeout=10)
+            if response.status_code >= 500:
+                local_errors += 1
+        except requests.RequestException:
+            local_errors += 1
+        local_latencies.append(time.perf_counter() - start)
+    with lock:
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+
+
+def main():
+    """Runs the load test and prints a summary"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/customers")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run")
+    args = parser.parse_args()
+
+    latencies, errors, lock = [], [], threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in range(args.concurrency):
+            executor.submit(run_client, args.url, deadline, latencies, errors, lock)
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"requests:    {total}")
+    print(f"errors:      {sum(errors)}")
+    print(f"throughput:  {total / args.duration:.1f} req/s")
+    if total:
+        print(f"mean:        {statistics.mean(latencies) * 1000:.1f} ms")
+        for pct in (50, 95, 99):
+            print(f"p{pct}:         {percentile(latencies, pct) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
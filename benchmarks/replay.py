@@ -0,0 +1,263 @@
+"""
+Traffic Replay and Load Generation for the Customer Service
+
+Sends requests to a running service at a target rate over many keep-alive
+connections and reports throughput, error rate and latency percentiles
+for each endpoint. The requests come either from a recorded log or from
+a synthetic mix of customer calls.
+
+Recorded logs can be gunicorn access logs (the request line is replayed,
+and POST/PUT bodies are made up) or JSON lines of
+{"method": ..., "path": ..., "body": ...}.
+
+Requests are started on a fixed schedule (open loop), and latency is
+measured from the time a request was due, so a slow server shows up as
+higher latency instead of a lower request rate.
+
+Usage:
+    # a synthetic mix at 200 requests per second for 60 seconds
+    python benchmarks/replay.py --url http://localhost:8080 --rate 200 --duration 60 \\
+        --mix list=20,get=50,create=15,update=10,suspend=5
+
+    # replay a gunicorn access log as fast as 64 connections allow
+    python benchmarks/replay.py --url http://localhost:8080 --log access.log --rate 0 --concurrency 64
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from load_test import percentile
+
+ACCESS_LOG_REQUEST = re.compile(r'"(GET|POST|PUT|DELETE|PATCH) (\S+) HTTP/[\d.]+"')
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+DEFAULT_MIX = "list=20,get=50,create=15,update=10,suspend=5"
+
+
+def endpoint_label(method: str, path: str) -> str:
+    """Groups requests by endpoint, e.g. GET /customers/{id}"""
+    path = ID_SEGMENT.sub("/{id}", path.split("?", 1)[0])
+    return f"{method} {path}"
+
+
+def fake_customer() -> dict:
+    """Returns a new, unique customer payload"""
+    tag = uuid.uuid4().hex[:12]
+    return {
+        "first_name": f"Load{tag[:4]}",
+        "last_name": "Tester",
+        "email": f"load-{tag}@example.com",
+        "password": "secret",
+        "status": "ACTIVE",
+    }
+
+
+def read_log(path: str) -> list:
+    """Reads the requests of a JSON lines file or a gunicorn access log"""
+    requests_ = []
+    with open(path, encoding="utf-8") as log:
+        for line in log:
+            line = line.strip()
+            if line.startswith("{"):
+                entry = json.loads(line)
+                requests_.append((entry.get("method", "GET").upper(), entry["path"], entry.get("body")))
+                continue
+            match = ACCESS_LOG_REQUEST.search(line)
+            if match:
+                method, target = match.groups()
+                requests_.append((method, target, fake_customer() if method in ("POST", "PUT") else None))
+    return requests_
+
+
+class SyntheticMix:
+    """Makes up list, get, create, update and suspend calls in the given proportions"""
+
+    def __init__(self, spec: str, customer_ids: list):
+        self.operations, self.weights = [], []
+        for item in spec.split(","):
+            name, _, weight = item.partition("=")
+            self.operations.append(name.strip())
+            self.weights.append(float(weight or 1))
+        self.customer_ids = customer_ids
+        self._lock = threading.Lock()
+
+    def _customer_id(self) -> int:
+        with self._lock:
+            return random.choice(self.customer_ids) if self.customer_ids else 0
+
+    def next_request(self):
+        """Returns the (method, path, body) of the next call"""
+        operation = random.choices(self.operations, self.weights)[0]
+        if operation == "list":
+            return "GET", "/customers", None
+        if operation == "create":
+            return "POST", "/customers", fake_customer()
+        if operation == "update":
+            return "PUT", f"/customers/{self._customer_id()}", fake_customer()
+        if operation == "suspend":
+            return "PUT", f"/customers/{self._customer_id()}/{random.choice(('suspend', 'activate'))}", None
+        return "GET", f"/customers/{self._customer_id()}", None
+
+    def created(self, response):
+        """Remembers the id of a customer the load created"""
+        if response.status_code == 201:
+            with self._lock:
+                self.customer_ids.append(response.json()["id"])
+
+
+class Results:
+    """Latencies and status codes per endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, label: str, latency: float, status):
+        """Records one request; status is the HTTP status or "error" if it failed"""
+        with self._lock:
+            self.latencies[label].append(latency)
+            self.statuses[label][status] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        """Returns throughput, error rate and latency percentiles per endpoint and overall"""
+        rows = {label: self._row(self.latencies[label], self.statuses[label], elapsed) for label in sorted(self.latencies)}
+        everything = defaultdict(int)
+        for statuses in self.statuses.values():
+            for status, count in statuses.items():
+                everything[status] += count
+        rows["TOTAL"] = self._row(list(itertools.chain(*self.latencies.values())), everything, elapsed)
+        return rows
+
+    @staticmethod
+    def _row(latencies: list, statuses: dict, elapsed: float) -> dict:
+        latencies = sorted(latencies)
+        total = len(latencies)
+        errors = sum(count for status, count in statuses.items() if status == "error" or status >= 500)
+        return {
+            "requests": total,
+            "throughput": total / elapsed if elapsed else 0.0,
+            "error_rate": errors / total if total else 0.0,
+            "client_errors": sum(count for status, count in statuses.items() if status != "error" and 400 <= status < 500),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+
+class Replayer:
+    """Sends requests on a fixed schedule from a pool of keep-alive connections"""
+
+    def __init__(self, base_url: str, source, rate: float, duration: float, mix: SyntheticMix = None):
+        self.base_url = base_url.rstrip("/")
+        self.source = source
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix
+        self.results = Results()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._start = None
+
+    def _next(self):
+        """Returns the next request and the time it is due, or None when done"""
+        with self._lock:
+            number = next(self._sequence)
+            request = next(self.source, None)
+        if request is None:
+            return None
+        due = self._start + number / self.rate if self.rate else time.perf_counter()
+        if due - self._start >= self.duration:
+            return None
+        return request, due
+
+    def _client(self):
+        session = requests.Session()
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            (method, path, body), due = item
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            label = endpoint_label(method, path)
+            try:
+                response = session.request(method, self.base_url + path, json=body, timeout=10)
+                status = response.status_code
+                if self.mix and method == "POST":
+                    self.mix.created(response)
+            except requests.RequestException:
+                status = "error"
+            self.results.record(label, time.perf_counter() - due, status)
+
+    def run(self, concurrency: int) -> dict:
+        """Runs the replay to the end of the source or the duration, then returns the summary"""
+        self._start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(self._client)
+        return self.results.summary(time.perf_counter() - self._start)
+
+
+def seed_customers(base_url: str, count: int) -> list:
+    """Creates customers for the synthetic mix to read and update, returning their ids"""
+    session = requests.Session()
+    ids = []
+    for _ in range(count):
+        response = session.post(f"{base_url.rstrip('/')}/customers", json=fake_customer(), timeout=10)
+        if response.status_code == 201:
+            ids.append(response.json()["id"])
+    return ids
+
+
+def print_summary(summary: dict):
+    """Prints one line per endpoint"""
+    print(f"{'endpoint':34} {'requests':>8} {'req/s':>8} {'errors':>7} {'4xx':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, row in summary.items():
+        print(f"{label:34} {row['requests']:>8} {row['throughput']:>8.1f} {row['error_rate']:>7.1%} "
+              f"{row['client_errors']:>6} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+              f"{row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}")
+
+
+def main():
+    """Parses the arguments, runs the replay and prints a summary"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080", help="base URL of the service")
+    parser.add_argument("--log", help="recorded requests to replay instead of the synthetic mix")
+    parser.add_argument("--loop", action="store_true", help="replay the log again until the duration is up")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="synthetic operation weights")
+    parser.add_argument("--seed", type=int, default=100, help="customers to create before a synthetic run")
+    parser.add_argument("--rate", type=float, default=100.0, help="target requests per second, 0 for as fast as possible")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--concurrency", type=int, default=32, help="connections")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    mix = None
+    if args.log:
+        logged = read_log(args.log)
+        source = itertools.cycle(logged) if args.loop else iter(logged)
+    else:
+        mix = SyntheticMix(args.mix, seed_customers(args.url, args.seed))
+        source = iter(mix.next_request, None)
+
+    summary = Replayer(args.url, source, args.rate, args.duration, mix).run(args.concurrency)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Serialization Benchmark
+
+Compares JSON and MessagePack for the payloads the service exchanges: the
+encode and decode time and the size of a list of serialized Customers,
+and the time of a full GET /customers through the app with each Accept.
+
+Usage:
+    DATABASE_URI=sqlite:///:memory: python benchmarks/serialization_bench.py --customers 1000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from service import app  # noqa: E402
+from service.models import Customer, db  # noqa: E402
+
+
+def make_customers(count):
+    """Returns count serialized Customers"""
+    now = datetime.utcnow().isoformat()
+    return [
+        {
+            "id": number,
+            "first_name": f"First{number}",
+            "last_name": f"Last{number}",
+            "email": f"customer{number}@example.com",
+            "password": "secret",
+            "status": "ACTIVE",
+            "created_at": now,
+            "updated_at": now,
+        }
+        for number in range(count)
+    ]
+
+
+def best_of(rounds, func):
+    """Returns the fastest of rounds calls to func, in milliseconds"""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_codecs(customers, rounds):
+    """Prints the encode and decode time and the size of each format"""
+    codecs = {
+        "json": (lambda: json.dumps(customers).encode("utf-8"), json.loads),
+        "msgpack": (lambda: msgpack.packb(customers, use_bin_type=True), msgpack.unpackb),
+    }
+    for name, (encode, decode) in codecs.items():
+        body = encode()
+        encode_ms = best_of(rounds, encode)
+        decode_ms = best_of(rounds, lambda: decode(body))  # pylint: disable=cell-var-from-loop
+        print(f"{name:8} encode {encode_ms:7.2f} ms  decode {decode_ms:7.2f} ms  size {len(body):>9,} bytes")
+
+
+def bench_endpoint(customers, rounds):
+    """Prints the time of GET /customers through the app with each Accept"""
+    db.session.query(Customer).delete()
+    for data in customers:
+        db.session.add(Customer().deserialize({**data, "id": None}))
+    db.session.commit()
+    client = app.test_client()
+    for accept in ("application/json", "application/msgpack"):
+        headers = {"Accept": accept}
+        elapsed = best_of(rounds, lambda: client.get("/customers", headers=headers))  # pylint: disable=cell-var-from-loop
+        print(f"GET /customers Accept: {accept:20} {elapsed:7.2f} ms")
+    db.session.query(Customer).delete()
+    db.session.commit()
+
+
+def main():
+    """Parses the arguments and runs the benchmarks"""
+    parser = argparse.ArgumentParser(description="Compare JSON and MessagePack payloads")
+    parser.add_argument("--customers", type=int, default=1000, help="customers per payload")
+    parser.add_argument("--rounds", type=int, default=10, help="rounds to take the best of")
+    args = parser.parse_args()
+    customers = make_customers(args.customers)
+    bench_codecs(customers, args.rounds)
+    bench_endpoint(customers, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
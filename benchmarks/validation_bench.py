@@ -0,0 +1,62 @@
+"""
+Validation Benchmark
+
+Measures how many Customer payloads the compiled schema validates per
+millisecond, for valid payloads and for payloads with several errors.
+
+Usage:
+    DATABASE_URI=sqlite:///:memory: python benchmarks/validation_bench.py --records 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from service.models import customer_schema  # noqa: E402  pylint: disable=wrong-import-position
+
+
+def make_payloads(count, invalid):
+    """Returns count Customer payloads, broken in several fields if invalid"""
+    payloads = []
+    for number in range(count):
+        payload = {
+            "first_name": f"First{number}",
+            "last_name": f"Last{number}",
+            "email": f"customer{number}@example.com",
+            "password": "secret",
+            "status": "ACTIVE",
+        }
+        if invalid:
+            payload.update(first_name=None, last_name="x" * 200, status="retired")
+            del payload["email"]
+        payloads.append(payload)
+    return payloads
+
+
+def run(records, rounds):
+    """Validates the payloads rounds times and prints the best throughput"""
+    for label, invalid in (("valid", False), ("invalid", True)):
+        payloads = make_payloads(records, invalid)
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            errors = customer_schema.validate_many(payloads)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert bool(errors) == invalid
+        print(f"{label:8} {records} records in {best * 1000:.2f} ms  ({records / (best * 1000):,.0f} records/ms)")
+
+
+def main():
+    """Parses the arguments and runs the benchmark"""
+    parser = argparse.ArgumentParser(description="Benchmark Customer payload validation")
+    parser.add_argument("--records", type=int, default=10000, help="payloads per round")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds to take the best of")
+    args = parser.parse_args()
+    run(args.records, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
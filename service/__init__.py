@@ -8,7 +8,10 @@ import sys
 from flask import Flask
 # pylint: disable=cyclic-import
 from service import config
-from service.common import constants, log_handlers, strings
+from service.common import (
+    constants, events, log_handlers, prepared, profiling, query_cache, rate_limit, readiness, single_flight,
+    slow_queries, sql_metrics, sqlite_pragmas, stats, strings
+)
 
 # Create Flask application
 app = Flask(__name__)
@@ -23,12 +26,37 @@ from service.common import error_handlers, cli_commands  # noqa: F401, E402
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
 
+# Shed load before doing any other work for a request
+rate_limit.init_app(app)
+
+# Count the requests in flight for GET /readyz
+readiness.init_app(app, models.database_engines)
+
+# Tune the connections of an embedded SQLite database
+sqlite_pragmas.init_app(app)
+
+# Prepare hot statements on the Postgres server
+prepared.init_app(app)
+
+# Count and time the SQL issued by every request
+sql_metrics.init_app(app, models.db.Model)
+slow_queries.init_app(app)
+profiling.init_app(app)
+
+# Keep the customer counts current from every flush
+stats.init_app(app, models.Customer, models.customer_sessions)
+
+# Let concurrent identical reads share one query
+single_flight.init_app(app)
+
 app.logger.info(70 * "*")
 app.logger.info("  C U S T O M E R   S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
     models.init_db(app)  # make our SQLAlchemy tables
+    events.init_app(app, models.db.engine, models.on_change, models.email_filter.on_relayed_change, models.on_relay_listening)
+    query_cache.init_app(app, models.on_change)
 except Exception as error:  # pylint: disable=broad-except
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,22 @@
+"""
+Admin Authentication
+
+Checks the X-Admin-Token header that guards the diagnostics features
+"""
+import hmac
+from flask import current_app, request
+
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+def is_admin_token_configured() -> bool:
+    """Returns True if an admin token has been configured"""
+    return bool(current_app.config.get("ADMIN_TOKEN"))
+
+
+def has_admin_token() -> bool:
+    """Returns True if the current request carries the configured admin token"""
+    token = current_app.config.get("ADMIN_TOKEN")
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, ""), token)
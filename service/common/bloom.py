@@ -0,0 +1,206 @@
+"""
+Bloom Filters
+
+A compact, probabilistic set used to answer "is this value definitely
+absent?" without a database round trip. A Bloom filter never reports a
+false negative; it may report a false positive with a probability that is
+chosen when it is sized.
+
+EmailFilter keeps one such filter over customer emails. Values can be
+added but not removed: deleted emails, and old emails replaced by an
+update, stay behind as harmless false positives. Deletes are counted as
+stale entries and the filter is rebuilt from the database once it is
+too old, too stale or over capacity.
+
+The filter only answers "definitely absent" when it has seen every email
+written by every process. That is either declared with
+EMAIL_FILTER_SINGLE_PROCESS, or it holds while the Postgres change relay
+is listening: the relay adds the emails that other workers and pods write,
+and each time it starts listening the filter is rebuilt before it is
+trusted again. Otherwise a lookup always goes to the database.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger("flask.app")
+
+
+class BloomFilter:
+    """A fixed size Bloom filter using double hashing over blake2b"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value: str):
+        """Adds a value to the filter"""
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def false_positive_rate(self) -> float:
+        """Returns the expected false positive rate at the current fill"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class EmailFilter:
+    """A rebuildable Bloom filter over customer emails"""
+
+    def __init__(self):
+        self.enabled = False
+        self.single_process = False
+        self.synced = False
+        self.error_rate = 0.01
+        self.capacity = 10000
+        self.max_age = 0
+        self.max_stale_ratio = 0.2
+        self.stale = 0
+        self.skipped_lookups = 0
+        self.built_at = None
+        self._filter = None
+        self._building = None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._rebuilding = threading.Event()
+        self._sync_epoch = 0
+
+    def configure(self, config: dict):
+        """Reads the filter settings from the app config"""
+        self.enabled = config.get("EMAIL_FILTER_ENABLED", False)
+        self.single_process = config.get("EMAIL_FILTER_SINGLE_PROCESS", False)
+        self.synced = False
+        self.error_rate = config.get("EMAIL_FILTER_ERROR_RATE", 0.01)
+        self.capacity = config.get("EMAIL_FILTER_CAPACITY", 10000)
+        self.max_age = config.get("EMAIL_FILTER_REBUILD_SECONDS", 0)
+
+    @staticmethod
+    def normalize(email: str) -> str:
+        """Returns the form of an email that is stored in the filter"""
+        return email.strip().lower()
+
+    def rebuild(self, emails, expected: int = 0):
+        """Builds a new filter from an iterable of emails and swaps it in"""
+        # one rebuild at a time, so adds made during it always reach the filter swapped in
+        with self._rebuild_lock:
+            new_filter = BloomFilter(max(self.capacity, 2 * expected), self.error_rate)
+            with self._lock:
+                self._building = new_filter
+            for email in emails:
+                new_filter.add(self.normalize(email))
+            with self._lock:
+                self._filter, self._building = new_filter, None
+                self.stale = 0
+                self.built_at = time.monotonic()
+
+    def add(self, email: str):
+        """Adds an email to the live filter and to one being rebuilt"""
+        if not self.enabled:
+            return
+        with self._lock:
+            for bloom in (self._filter, self._building):
+                if bloom is not None:
+                    bloom.add(self.normalize(email))
+
+    def discard(self, email: str):  # pylint: disable=unused-argument
+        """Notes that an email left the table; it stays in the filter until the next rebuild"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.stale += 1
+
+    def authoritative(self) -> bool:
+        """Returns True if the filter has seen the emails written by every process"""
+        return self.single_process or self.synced
+
+    def on_relayed_change(self, event_type: str, data: dict):
+        """Adds the email of a change relayed from any worker"""
+        if event_type != "delete" and data.get("email"):
+            self.add(data["email"])
+
+    def on_relay_listening(self, listening: bool, loader):
+        """Trusts the filter once loader() has rebuilt it after the relay started listening"""
+        with self._lock:
+            self._sync_epoch += 1
+            epoch = self._sync_epoch
+            self.synced = False
+        if not listening or not self.enabled:
+            return
+
+        def run():
+            try:
+                loader()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Email filter rebuild failed, lookups will query the database: %s", error)
+                return
+            with self._lock:
+                self.synced = epoch == self._sync_epoch
+
+        threading.Thread(target=run, name="email-filter-sync", daemon=True).start()
+
+    def definitely_absent(self, email: str) -> bool:
+        """Returns True only if the email is certainly not in the table"""
+        bloom = self._filter
+        if not self.enabled or bloom is None or not self.authoritative() or self.normalize(email) in bloom:
+            return False
+        self.skipped_lookups += 1
+        return True
+
+    def needs_rebuild(self) -> bool:
+        """Returns True if the filter is too old, too stale or too full"""
+        bloom = self._filter
+        if not self.enabled or bloom is None or self._rebuilding.is_set():
+            return False
+        too_old = self.max_age and time.monotonic() - self.built_at >= self.max_age
+        too_stale = self.stale > self.max_stale_ratio * max(1, bloom.count)
+        return bool(too_old or too_stale or bloom.count > bloom.capacity)
+
+    def rebuild_in_background(self, loader):
+        """Runs loader() in a thread to rebuild the filter, once at a time"""
+        if self._rebuilding.is_set():
+            return
+        self._rebuilding.set()
+
+        def run():
+            try:
+                loader()
+            finally:
+                self._rebuilding.clear()
+
+        threading.Thread(target=run, name="email-filter-rebuild", daemon=True).start()
+
+    def stats(self) -> dict:
+        """Returns the filter's size and accuracy"""
+        bloom = self._filter
+        if bloom is None:
+            return {"enabled": self.enabled, "built": False}
+        return {
+            "enabled": self.enabled,
+            "built": True,
+            "authoritative": self.authoritative(),
+            "entries": bloom.count,
+            "capacity": bloom.capacity,
+            "bits": bloom.size,
+            "hashes": bloom.hashes,
+            "target_error_rate": bloom.error_rate,
+            "expected_error_rate": bloom.false_positive_rate(),
+            "stale_entries": self.stale,
+            "skipped_lookups": self.skipped_lookups,
+            "age_seconds": time.monotonic() - self.built_at,
+        }
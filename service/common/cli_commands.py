@@ -1,8 +1,11 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import datetime, timedelta
+import click
 from service import app
-from service.models import db
+from service.common.sharding import rebalance
+from service.models import Customer, CustomerTombstone, IdempotencyKey, db
 
 
 ######################################################################
@@ -19,3 +22,60 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to delete expired idempotency keys
+# Usage:
+#   flask idempotency-purge
+######################################################################
+@app.cli.command("idempotency-purge")
+def idempotency_purge():
+    """
+    Deletes stored responses whose Idempotency-Key has expired
+    """
+    count = IdempotencyKey.purge_expired()
+    print(f"Purged {count} expired idempotency keys")
+
+
+######################################################################
+# Command to delete old change feed tombstones
+# Usage:
+#   flask tombstones-purge --days 30
+######################################################################
+@app.cli.command("tombstones-purge")
+@click.option("--days", default=30, show_default=True, help="Keep tombstones this many days")
+def tombstones_purge(days):
+    """
+    Deletes change feed tombstones older than the retention period.
+    Clients that sync less often than this will miss deletes.
+    """
+    count = CustomerTombstone.purge_older_than(datetime.utcnow() - timedelta(days=days))
+    print(f"Purged {count} tombstones")
+
+
+######################################################################
+# Command to move customers onto the shards they now hash to
+# Usage:
+#   flask shard-rebalance --batch-size 500 [--dry-run]
+######################################################################
+@app.cli.command("shard-rebalance")
+@click.option("--batch-size", default=500, show_default=True, help="Rows copied per transaction")
+@click.option("--dry-run", is_flag=True, help="Only count the rows that would move")
+def shard_rebalance(batch_size, dry_run):
+    """
+    Moves every customer and tombstone that is not on the shard its id
+    hashes to under SHARD_DATABASE_URIS. Run it after appending a shard,
+    while writes are stopped: until the workers restart with the new list
+    they look for moved customers on their old shard.
+    """
+    if Customer.shards is None:
+        raise click.ClickException("SHARD_DATABASE_URIS is not set")
+    moved = rebalance(
+        Customer.shards,
+        {Customer.__table__: "id", CustomerTombstone.__table__: "customer_id"},
+        batch_size,
+        dry_run,
+    )
+    for table, count in moved.items():
+        print(f"{table}: {count} rows {'to move' if dry_run else 'moved'}")
@@ -7,7 +7,17 @@ LAST_NAME_MAX_LEN: int = 120
 EMAIL_MAX_LEN: int = 120
 PASSWORD_MAX_LEN: int = 20
 
+#######################
+#  IDEMPOTENCY MODEL  #
+#######################
+IDEMPOTENCY_KEY_MAX_LEN: int = 255
+LOCATION_MAX_LEN: int = 2048
+
 ############
 #  ROUTES  #
 ############
 ROUTES_VERSION: str = "1.1"
+CHANGE_FEED_MAX_LIMIT: int = 1000
+STATS_MAX_DOMAINS: int = 1000
+BATCH_GET_MAX_IDS: int = 500
+BATCH_MAX_OPERATIONS: int = 100
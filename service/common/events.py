@@ -0,0 +1,198 @@
+"""
+Customer Event Stream
+
+Fans customer change events out to Server-Sent Events subscribers.
+
+Every worker has an EventBroker. Each subscriber gets a bounded queue and
+an optional filter on event type and customer id; events are filtered
+when they are published, and a subscriber whose queue is full is dropped
+rather than letting a slow consumer buffer without limit.
+
+By default the broker only sees the changes made by its own worker. With
+SSE_PG_NOTIFY on a Postgres database, changes are published with
+pg_notify() instead, and a PgNotifyRelay thread in every worker LISTENs on
+the channel and feeds its local broker, so subscribers see the changes
+made by every worker.
+"""
+import itertools
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+CHANNEL = "customer_events"
+
+logger = logging.getLogger("flask.app")
+
+
+def format_sse(event: dict) -> str:
+    """Formats an event as a Server-Sent Events message"""
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def event_payload(event_type: str, customer) -> dict:
+    """Returns the data sent for a change, without the password"""
+    if event_type == "delete":
+        return {"id": customer.id}
+    data = customer.serialize()
+    data.pop("password", None)
+    return data
+
+
+class Subscriber:
+    """A bounded queue of events for one SSE client"""
+
+    def __init__(self, queue_size: int, event_types=None, customer_id: int = None):
+        self.queue = queue.Queue(queue_size)
+        self.event_types = set(event_types) if event_types else None
+        self.customer_id = customer_id
+        self.dropped = False
+
+    def wants(self, event: dict) -> bool:
+        """Returns True if the event passes this subscriber's filter"""
+        if self.event_types and event["type"] not in self.event_types:
+            return False
+        return self.customer_id is None or event["data"].get("id") == self.customer_id
+
+
+class EventBroker:
+    """Delivers events to the subscribers of one worker"""
+
+    def __init__(self, max_subscribers: int = 10, queue_size: int = 100):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.relay = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+
+    @property
+    def subscriber_count(self) -> int:
+        """Returns how many clients are subscribed"""
+        return len(self._subscribers)
+
+    def subscribe(self, event_types=None, customer_id: int = None):
+        """Returns a new Subscriber, or None if the worker has too many"""
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(self.queue_size, event_types, customer_id)
+            self._subscribers.append(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Removes a subscriber"""
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def publish(self, event_type: str, data: dict):
+        """Delivers an event to every interested subscriber, dropping slow ones"""
+        event = {"seq": next(self._sequence), "type": event_type, "data": data}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if not subscriber.wants(event):
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    def stream(self, subscriber: Subscriber, keepalive: float):
+        """Yields a subscriber's events as SSE messages until it is dropped or disconnects"""
+        try:
+            yield "retry: 3000\n\n"
+            while not subscriber.dropped:
+                try:
+                    event = subscriber.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+            # tell the client it fell behind so it can reconnect and resync
+            yield "event: dropped\ndata: {}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def on_change(self, event_type: str, customer):
+        """Change listener that publishes model changes"""
+        if self.relay is not None:
+            self.relay.notify(event_type, event_payload(event_type, customer))
+        elif self._subscribers:
+            self.publish(event_type, event_payload(event_type, customer))
+
+
+class PgNotifyRelay:
+    """Relays Postgres notifications on CHANNEL into a local broker"""
+
+    def __init__(self, broker: EventBroker, engine, on_change=None, on_listening=None):
+        self.broker = broker
+        self.engine = engine
+        # on_change(event_type, data) sees every relayed change, and
+        # on_listening(bool) is told when LISTEN starts and when it is lost
+        self.on_change = on_change
+        self.on_listening = on_listening
+        self._thread = threading.Thread(target=self._listen, name="customer-events-listener", daemon=True)
+
+    def start(self):
+        """Starts listening in a background thread"""
+        self._thread.start()
+        return self
+
+    def notify(self, event_type: str, data: dict):
+        """Publishes an event to every worker through pg_notify()"""
+        payload = json.dumps({"type": event_type, "data": data})
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("SELECT pg_notify(%(channel)s, %(payload)s)", {"channel": CHANNEL, "payload": payload})
+
+    def _listen(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Customer event listener failed, reconnecting: %s", error)
+                if self.on_listening:
+                    self.on_listening(False)
+                time.sleep(1)
+
+    def _listen_once(self):
+        # a dedicated connection, so LISTEN does not hold one of the pool's
+        args, kwargs = self.engine.dialect.create_connect_args(self.engine.url)
+        connection = self.engine.dialect.connect(*args, **kwargs)
+        try:
+            connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {CHANNEL}")
+            if self.on_listening:
+                self.on_listening(True)
+            while True:
+                if select.select([connection], [], [], 5) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    message = json.loads(connection.notifies.pop(0).payload)
+                    if self.on_change:
+                        self.on_change(message["type"], message["data"])
+                    self.broker.publish(message["type"], message["data"])
+        finally:
+            connection.close()
+
+
+def init_app(app, engine, register_listener, on_relayed_change=None, on_relay_listening=None):
+    """Creates the worker's broker and connects it to the model changes
+
+    With SSE_PG_NOTIFY, on_relayed_change and on_relay_listening are handed
+    to the relay (see PgNotifyRelay) to follow the changes of every worker.
+    """
+    broker = EventBroker(app.config.get("SSE_MAX_CLIENTS", 10), app.config.get("SSE_CLIENT_QUEUE_SIZE", 100))
+    if app.config.get("SSE_PG_NOTIFY", False) and engine.dialect.name == "postgresql":
+        if engine.driver == "psycopg2":
+            broker.relay = PgNotifyRelay(broker, engine, on_relayed_change, on_relay_listening).start()
+        else:
+            logger.warning("SSE_PG_NOTIFY needs the psycopg2 driver: events stay within each worker")
+    register_listener(broker.on_change)
+    app.extensions["event_broker"] = broker
+    return broker
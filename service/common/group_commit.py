@@ -0,0 +1,74 @@
+"""
+Group Commit
+
+Collects items submitted concurrently by the threads of a worker and
+flushes them together, so many requests share one transaction and one
+COMMIT. The first thread to submit into an empty batch becomes its leader:
+it waits up to max_wait seconds (less if the batch fills up), then runs
+flush() on the whole batch while the other threads wait for their own
+result. flush() returns one result per item; a result that is an
+exception is raised in the thread that submitted the item.
+"""
+import threading
+from service.common.metrics import registry
+
+
+class _Batch:  # pylint: disable=too-few-public-methods
+    """Items waiting to be flushed together"""
+
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Batches concurrent submissions into a single flush"""
+
+    def __init__(self, flush, max_batch: int, max_wait: float):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._current = None
+
+    def submit(self, item):
+        """Adds item to the current batch and returns its result once flushed"""
+        with self._lock:
+            batch = self._current
+            leader = batch is None
+            if leader:
+                batch = self._current = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                self._current = None
+                batch.full.set()
+
+        if leader:
+            self._lead(batch)
+        else:
+            batch.done.wait()
+
+        result = batch.results[index]
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def _lead(self, batch: _Batch):
+        """Waits for the batch to fill or time out, then flushes it"""
+        batch.full.wait(self.max_wait)
+        with self._lock:
+            if self._current is batch:
+                self._current = None
+        try:
+            batch.results = self.flush(batch.items)
+        except Exception as error:  # pylint: disable=broad-except
+            batch.results = [error] * len(batch.items)
+        finally:
+            if batch.results is None:
+                batch.results = [RuntimeError("group commit flush failed")] * len(batch.items)
+            batch.done.set()
+        registry.increment("group_commit_batches_total")
+        registry.increment("group_commit_items_total", len(batch.items))
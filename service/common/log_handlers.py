@@ -19,18 +19,138 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+Records are handed to a bounded in-memory queue on the request thread and
+written out by a background QueueListener, so a slow log sink never adds
+to request latency. Routine INFO records can be sampled per route, while
+WARNING and above are always kept.
 """
+import atexit
+import json
 import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+SAMPLED_KEY = "customers.log_sampled"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a log record as a single line of JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for field in ("endpoint", "method", "path"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestSamplingFilter(logging.Filter):
+    """Tags records with request details and samples routine success logs
+
+    The keep/drop decision is made once per request so a sampled request
+    keeps all of its INFO lines together. WARNING and above always pass.
+    """
+
+    def __init__(self, default_rate: float = 1.0, route_rates: dict = None):
+        super().__init__()
+        self.default_rate = default_rate
+        self.route_rates = route_rates or {}
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        record.endpoint = request.endpoint
+        record.method = request.method
+        record.path = request.path
+        if record.levelno >= logging.WARNING:
+            return True
+        # Cache the decision in the WSGI environ, which lives exactly as long
+        # as the request (flask.g may outlive it if an app context is pushed)
+        sampled = request.environ.get(SAMPLED_KEY)
+        if sampled is None:
+            rate = self.route_rates.get(request.endpoint, self.default_rate)
+            sampled = request.environ[SAMPLED_KEY] = rate >= 1.0 or random.random() < rate
+        return sampled
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """A QueueHandler that drops records instead of blocking when full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue never leaves this process, so only merge the message
+        # and leave formatting to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """Parses "endpoint=rate,endpoint=rate" into a dictionary"""
+    rates = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        endpoint, rate = item.split("=", 1)
+        rates[endpoint.strip()] = float(rate)
+    return rates
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
+    target_handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
+
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT", "text") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in target_handlers:
         handler.setFormatter(formatter)
+
+    app.logger.handlers = []
+    if target_handlers:
+        # Hand records to a background thread so log I/O stays off the request path
+        app.logger.handlers = [_start_queue_listener(app, target_handlers)]
     app.logger.info("Logging handler established")
+
+
+def _start_queue_listener(app, target_handlers) -> QueueHandler:
+    """Starts a background listener feeding target_handlers from a queue"""
+    handler = NonBlockingQueueHandler(queue.Queue(app.config.get("LOG_QUEUE_SIZE", 10000)))
+    handler.addFilter(
+        RequestSamplingFilter(
+            app.config.get("LOG_SAMPLE_RATE", 1.0),
+            parse_sample_rates(app.config.get("LOG_SAMPLE_RATES", "")),
+        )
+    )
+    listener = QueueListener(handler.queue, *target_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
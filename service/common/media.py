@@ -0,0 +1,58 @@
+"""
+Content Negotiation
+
+Lets clients exchange customers as MessagePack instead of JSON. Request
+bodies are decoded according to their Content-Type, and responses are
+encoded in the type the Accept header prefers; JSON stays the default.
+
+MessagePack is optional: without the msgpack package only JSON is offered.
+"""
+from flask import Response, abort, jsonify, request
+from service.common import status
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# MIME types some MessagePack clients still send
+MSGPACK_ALIASES = {MSGPACK, "application/x-msgpack", "application/vnd.msgpack"}
+
+
+def request_types() -> tuple:
+    """Returns the Content-Types a request body may have"""
+    if msgpack is None:
+        return (JSON,)
+    return (JSON, *sorted(MSGPACK_ALIASES))
+
+
+def get_body():
+    """Returns the decoded request body"""
+    if request.mimetype in MSGPACK_ALIASES and msgpack is not None:
+        try:
+            return msgpack.unpackb(request.get_data(), raw=False)
+        except (ValueError, msgpack.UnpackException) as error:
+            return abort(status.HTTP_400_BAD_REQUEST, f"Invalid MessagePack body: {error}")
+    return request.get_json()
+
+
+def response_type() -> str:
+    """Returns the media type to answer with, preferring JSON on a tie"""
+    if msgpack is None:
+        return JSON
+    best = request.accept_mimetypes.best_match([JSON, *sorted(MSGPACK_ALIASES)], default=JSON)
+    return MSGPACK if best in MSGPACK_ALIASES else JSON
+
+
+def respond(payload, status_code: int = status.HTTP_200_OK, headers: dict = None) -> Response:
+    """Returns a response with payload encoded in the type the client accepts"""
+    if response_type() == MSGPACK:
+        response = Response(msgpack.packb(payload, use_bin_type=True), status=status_code, mimetype=MSGPACK)
+    else:
+        response = jsonify(payload)
+        response.status_code = status_code
+    response.headers.update(headers or {})
+    response.vary.add("Accept")
+    return response
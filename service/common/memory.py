@@ -0,0 +1,109 @@
+"""
+Memory Diagnostics
+
+Lets an operator look at a running worker's memory without restarting it:
+resident set size, garbage collector statistics, the number of objects
+held in SQLAlchemy identity maps, and tracemalloc snapshots that can be
+taken repeatedly and diffed against the previous one to find the
+allocation sites that keep growing.
+"""
+import gc
+import os
+import resource
+import threading
+import tracemalloc
+
+
+def rss_bytes() -> int:
+    """Returns the current resident set size of this process"""
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is the peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def identity_map_size(scoped_session) -> dict:
+    """Returns the number of sessions and the objects held in their identity maps"""
+    sessions = list(getattr(scoped_session.registry, "registry", {}).values())
+    return {
+        "sessions": len(sessions),
+        "objects": sum(len(session.identity_map) for session in sessions),
+    }
+
+
+def gc_stats() -> dict:
+    """Returns the garbage collector counters"""
+    return {
+        "counts": gc.get_count(),
+        "thresholds": gc.get_threshold(),
+        "generations": gc.get_stats(),
+        "garbage": len(gc.garbage),
+    }
+
+
+def format_statistic(stat) -> dict:
+    """Converts a tracemalloc Statistic or StatisticDiff to a dictionary"""
+    frame = stat.traceback[0]
+    entry = {
+        "site": f"{frame.filename}:{frame.lineno}",
+        "size": stat.size,
+        "count": stat.count,
+    }
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        entry["size_diff"] = stat.size_diff
+        entry["count_diff"] = stat.count_diff
+    return entry
+
+
+class MemoryTracer:
+    """Takes tracemalloc snapshots and diffs each against the previous one"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._previous = None
+        self.snapshots = 0
+
+    def snapshot(self, limit: int = 20, frames: int = 1) -> dict:
+        """Takes a snapshot, starting tracemalloc first if needed"""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),)
+            )
+            report = {
+                "snapshot": self.snapshots,
+                "traced_memory": tracemalloc.get_traced_memory(),
+                "top": [format_statistic(stat) for stat in snapshot.statistics("lineno")[:limit]],
+                "growth": None,
+            }
+            if self._previous is not None:
+                diff = snapshot.compare_to(self._previous, "lineno")
+                report["growth"] = [format_statistic(stat) for stat in diff[:limit]]
+            self._previous = snapshot
+            self.snapshots += 1
+            return report
+
+    def stop(self):
+        """Stops tracing and forgets the previous snapshot"""
+        with self._lock:
+            tracemalloc.stop()
+            self._previous = None
+            self.snapshots = 0
+
+
+def memory_stats(scoped_session) -> dict:
+    """Returns a summary of this worker's memory use"""
+    return {
+        "pid": os.getpid(),
+        "rss_bytes": rss_bytes(),
+        "gc": gc_stats(),
+        "identity_map": identity_map_size(scoped_session),
+        "tracing": tracemalloc.is_tracing(),
+    }
+
+
+# The memory tracer of this worker
+memory_tracer = MemoryTracer()
@@ -0,0 +1,60 @@
+"""
+Metrics
+
+A small, thread-safe, per-worker registry of counters and gauges that is
+rendered in the Prometheus text exposition format by GET /metrics
+"""
+import threading
+
+
+class MetricsRegistry:
+    """Holds counters and gauges keyed by name and label set"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._kinds = {}
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Adds value to the counter name{labels}"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, "counter")
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """Sets the gauge name{labels} to value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, "gauge")
+            self._values[key] = value
+
+    def get(self, name: str, **labels) -> float:
+        """Returns the current value of name{labels}"""
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        """Clears every metric"""
+        with self._lock:
+            self._values.clear()
+            self._kinds.clear()
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format"""
+        with self._lock:
+            values = sorted(self._values.items())
+            kinds = dict(self._kinds)
+        lines = []
+        seen = set()
+        for (name, labels), value in values:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} {kinds[name]}")
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry shared by the whole worker
+registry = MetricsRegistry()
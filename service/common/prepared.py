@@ -0,0 +1,51 @@
+"""
+Server-Side Prepared Statements
+
+Postgres parses and plans every statement it is sent, although the hot
+lookups (Customer.find, find_by_email and find_by_first_name) send the
+same SQL over and over. With the psycopg 3 driver
+(DATABASE_URI=postgresql+psycopg://...) a connection prepares a statement
+on the server once it has run DB_PREPARE_THRESHOLD times, and from then on
+only sends the parameters. SQLAlchemy caches the compiled SQL, so each
+lookup always sends the same text, which is what psycopg keys its
+prepared statements on.
+
+Prepared statements belong to a connection, so every pooled connection
+prepares its own and keeps the DB_PREPARED_MAX most recently used. They do
+not work through PgBouncer in transaction pooling mode; set
+DB_PREPARE_THRESHOLD=none there. psycopg2 cannot prepare statements and
+ignores these settings.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The settings applied to each new psycopg 3 connection
+settings = {"threshold": None, "max": 100}
+
+
+def parse_threshold(value):
+    """Parses the prepare threshold; "none" or an empty value turns preparing off"""
+    if value is None or str(value).strip().lower() in ("", "none"):
+        return None
+    return int(value)
+
+
+def is_psycopg3(dbapi_connection) -> bool:
+    """Returns True for a psycopg 3 connection"""
+    return type(dbapi_connection).__module__.split(".")[0] == "psycopg"
+
+
+def _on_connect(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    """Sets when a new psycopg 3 connection prepares statements"""
+    if not is_psycopg3(dbapi_connection):
+        return
+    dbapi_connection.prepare_threshold = settings["threshold"]
+    dbapi_connection.prepared_max = settings["max"]
+
+
+def init_app(app):
+    """Reads the prepared statement settings and applies them to every connection opened from now on"""
+    settings["threshold"] = parse_threshold(app.config.get("DB_PREPARE_THRESHOLD", "5"))
+    settings["max"] = int(app.config.get("DB_PREPARED_MAX", 100))
+    if not event.contains(Engine, "connect", _on_connect):
+        event.listen(Engine, "connect", _on_connect)
@@ -0,0 +1,231 @@
+"""
+Request Profiling
+
+Two opt-in ways of seeing where a worker spends its time:
+
+* A single request can be profiled in place by sending an ``X-Profile``
+  header together with a valid ``X-Admin-Token`` while PROFILING_ENABLED
+  is on. ``X-Profile: sample`` (the default) samples the request thread's
+  stack and stores it in the collapsed "folded stacks" format read by
+  flamegraph.pl and speedscope; ``X-Profile: deterministic`` runs the
+  request under cProfile instead and folds its call graph into the same
+  format, weighted by microseconds. The response carries an
+  ``X-Profile-Id`` header naming the stored profile.
+
+* With PROFILER_SAMPLE_INTERVAL_MS set, a background thread samples the
+  stacks of every thread that is serving a request and keeps a rolling
+  window of folded stacks that can be dumped at any time.
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from flask import current_app, request
+from service.common.auth import has_admin_token
+
+PROFILER_KEY = "customers.profiler"
+
+
+def fold_stack(frame) -> str:
+    """Returns a frame's call stack as a semicolon separated line, root first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _function_label(function) -> str:
+    filename, line, name = function
+    if filename == "~":
+        # a builtin, e.g. <method 'execute' of 'sqlite3.Cursor' objects>
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def fold_profile(profiler: cProfile.Profile, max_depth: int = 100) -> Counter:
+    """Returns a cProfile run as folded stacks weighted by microseconds
+
+    cProfile only records the time spent through each caller and callee
+    pair, so the time of a function called from several places is split
+    over its callers' stacks in proportion to those calls.
+    """
+    stats = pstats.Stats(profiler).stats
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((function, cumulative))
+    counts = Counter()
+
+    def visit(function, path, visited, weight):
+        _, _, own, cumulative, _ = stats[function]
+        share = min(weight / cumulative, 1.0) if cumulative else 0.0
+        stack = path + [_function_label(function)]
+        visited = visited | {function}
+        micros = round(own * share * 1e6)
+        if micros:
+            counts[";".join(stack)] += micros
+        if len(stack) >= max_depth:
+            return
+        for callee, through in callees.get(function, []):
+            # a recursive call's own time is already in the function's own
+            # time, so skip it, and skip branches too small to show
+            if callee not in visited and callee in stats and through * share >= 1e-6:
+                visit(callee, stack, visited, through * share)
+
+    for function, (_, _, _, cumulative, callers) in stats.items():
+        # the time of calls made from frames entered before profiling started
+        # is not under any recorded caller, so those calls start stacks of their own
+        outside = cumulative - sum(edge[3] for caller, edge in callers.items() if caller != function)
+        if outside >= 1e-6:
+            visit(function, [], frozenset(), outside)
+    return counts
+
+
+def render_folded(counts: Counter) -> str:
+    """Renders stack counts in the collapsed format used by flame graphs"""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+class StackSampler:
+    """Samples the stacks of selected threads from a background thread"""
+
+    def __init__(self, interval: float, thread_ids):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        """Starts sampling"""
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        """Stops sampling and returns the stack counts"""
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def sample(self):
+        """Takes one sample of every selected thread"""
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        for thread_id in list(self.thread_ids()):
+            frame = frames.get(thread_id)
+            if frame is not None:
+                self.counts[fold_stack(frame)] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+
+class RollingProfiler(StackSampler):
+    """A low overhead sampler that keeps the last two windows of samples"""
+
+    def __init__(self, interval: float, window: float, thread_ids):
+        super().__init__(interval, thread_ids)
+        self.window = window
+        self.previous = Counter()
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+
+    def sample(self):
+        with self._lock:
+            if time.monotonic() - self._window_start >= self.window:
+                self.previous, self.counts = self.counts, Counter()
+                self._window_start = time.monotonic()
+            super().sample()
+
+    def dump(self) -> str:
+        """Returns the samples of the previous and current windows as folded stacks"""
+        with self._lock:
+            counts = self.previous + self.counts
+        return render_folded(counts)
+
+
+class ProfileStore:
+    """Keeps the most recent request profiles"""
+
+    def __init__(self, capacity: int = 20):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()
+
+    def add(self, profile: str) -> str:
+        """Stores a profile and returns its id"""
+        profile_id = uuid.uuid4().hex
+        with self._lock:
+            self._profiles[profile_id] = profile
+            while len(self._profiles) > self.capacity:
+                self._profiles.popitem(last=False)
+        return profile_id
+
+    def get(self, profile_id: str):
+        """Returns a stored profile or None"""
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+# Threads currently serving a request, and this worker's profiling state
+active_threads = set()
+profile_store = ProfileStore()
+rolling_profiler = None  # pylint: disable=invalid-name
+
+
+######################################################################
+# Request hooks
+######################################################################
+def _start_request():
+    """Tracks the request thread and starts a profiler when asked to"""
+    active_threads.add(threading.get_ident())
+    mode = request.headers.get("X-Profile")
+    if not mode or not current_app.config.get("PROFILING_ENABLED", False) or not has_admin_token():
+        return
+    if mode == "deterministic":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        thread_id = threading.get_ident()
+        interval = current_app.config.get("REQUEST_PROFILE_INTERVAL_MS", 1) / 1000
+        profiler = StackSampler(interval, lambda: (thread_id,)).start()
+    request.environ[PROFILER_KEY] = profiler
+
+
+def _finish_request(response):
+    """Stops the request profiler and stores what it collected"""
+    profiler = request.environ.pop(PROFILER_KEY, None)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        response.headers["X-Profile-Id"] = profile_store.add(render_folded(fold_profile(profiler)))
+    elif profiler is not None:
+        response.headers["X-Profile-Id"] = profile_store.add(render_folded(profiler.stop()))
+    return response
+
+
+def _teardown_request(error):  # pylint: disable=unused-argument
+    """Stops tracking the request thread"""
+    active_threads.discard(threading.get_ident())
+    profiler = request.environ.pop(PROFILER_KEY, None)
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+    elif profiler is not None:
+        profiler.disable()
+
+
+def init_app(app):
+    """Registers the profiling hooks and starts the rolling profiler if configured"""
+    global rolling_profiler  # pylint: disable=global-statement,invalid-name
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    interval = app.config.get("PROFILER_SAMPLE_INTERVAL_MS", 0)
+    if interval and rolling_profiler is None:
+        window = app.config.get("PROFILER_WINDOW_SECONDS", 60)
+        rolling_profiler = RollingProfiler(interval / 1000, window, lambda: tuple(active_threads)).start()
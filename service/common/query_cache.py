@@ -0,0 +1,115 @@
+"""
+Query Result Cache
+
+Keeps the encoded responses of popular GET /customers filters in memory,
+so repeated lists skip both the query and the serialization.
+
+Every committed Customer change bumps a generation counter instead of
+searching the cache for the entries it affects. An entry remembers the
+generation read before its query ran and is a miss once the counter has
+moved on, so a change that commits while a page is being built is never
+hidden. Stale entries are dropped when they are next read or when they
+reach the end of the LRU order.
+
+The entries are held to QUERY_CACHE_MAX_BYTES, evicting the least recently
+used first. Each worker only sees its own commits, so entries also expire
+after QUERY_CACHE_TTL_SECONDS to bound how stale another worker's writes
+can leave them.
+"""
+import threading
+import time
+from collections import OrderedDict
+from service.common.metrics import registry
+
+# The list filters in the order list_customers applies them; only the first one given is used
+LIST_FILTERS = ("email", "first_name")
+
+
+def list_cache_key(args) -> tuple:
+    """Returns the cache key of a GET /customers query string, or None if it is not cached"""
+    if set(args) - set(LIST_FILTERS):
+        return None
+    for name in LIST_FILTERS:
+        if args.get(name):
+            return ("list", name, args[name])
+    return ("list", None, None)
+
+
+class QueryCache:
+    """An LRU cache of encoded query results bounded in bytes and invalidated by generation"""
+
+    def __init__(self):
+        self.enabled = False
+        self.max_bytes = 0
+        self.ttl = 0.0
+        self.generation = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, config: dict):
+        """Reads the cache settings from the app config"""
+        self.enabled = config.get("QUERY_CACHE_ENABLED", False)
+        self.max_bytes = config.get("QUERY_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+        self.ttl = config.get("QUERY_CACHE_TTL_SECONDS", 5.0)
+        self.clear()
+
+    def invalidate(self, event=None, customer=None):  # pylint: disable=unused-argument
+        """Makes every entry stale; registered as a Customer change listener"""
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def _drop(self, key):
+        """Removes an entry; the caller holds the lock"""
+        _, _, value, size = self._entries.pop(key)
+        self.size -= size
+        return value
+
+    def get(self, key):
+        """Returns the cached value for key, or None if it is missing or stale"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                result = "miss"
+            elif entry[0] != self.generation or time.monotonic() - entry[1] > self.ttl:
+                self._drop(key)
+                result = "stale"
+            else:
+                self._entries.move_to_end(key)
+                result = "hit"
+        registry.increment("query_cache_lookups_total", result=result)
+        return entry[2] if result == "hit" else None
+
+    def put(self, key, generation: int, value, size: int):
+        """Caches value, computed from the data as of generation, and evicts to stay in budget"""
+        if not self.enabled or generation != self.generation or size > self.max_bytes // 4:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (generation, time.monotonic(), value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                registry.increment("query_cache_evictions_total")
+            registry.set("query_cache_bytes", self.size)
+            registry.set("query_cache_entries", len(self._entries))
+
+
+def init_app(app, register_listener):
+    """Configures the cache and invalidates it on every committed Customer change"""
+    query_cache.configure(app.config)
+    register_listener(query_cache.invalidate)
+
+
+# The query cache of this worker
+query_cache = QueryCache()
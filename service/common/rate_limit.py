@@ -0,0 +1,201 @@
+"""
+Admission Control
+
+Sheds load in front of the routes instead of letting requests pile up on
+the workers and the database pool:
+
+* token buckets limit the request rate of the whole worker and of each
+  client, optionally per route, and answer 429 Too Many Requests
+* a concurrency limit with a bounded wait queue answers 503 Service
+  Unavailable when too many requests are already in flight
+
+Both responses carry a Retry-After header. Limits are written as
+"rate/burst", e.g. "10/20" allows 10 requests per second with bursts of 20.
+
+Clients are told apart by their address. X-Forwarded-For can be set by
+anyone, so it is only used with TRUSTED_PROXIES set to the number of
+proxies in front of the service, and then only the hops they appended.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+from service.common.metrics import registry
+
+ACQUIRED_KEY = "customers.concurrency_acquired"
+EXEMPT_ENDPOINTS = {"healthcheck", "readiness", "static", "metrics"}
+
+
+class TokenBucket:
+    """A thread-safe token bucket refilled continuously at rate tokens per second"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, returning 0 on success or the seconds until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate if self.rate else math.inf
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight requests and how many may wait for a free slot"""
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> bool:
+        """Takes a slot, waiting in the bounded queue if needed"""
+        with self._condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self.in_flight < self.limit, self.timeout):
+                    return False
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        """Gives a slot back"""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+def parse_limit(spec: str):
+    """Parses "rate/burst" into a (rate, burst) tuple, or None if empty"""
+    if not spec:
+        return None
+    rate, _, burst = spec.partition("/")
+    rate, burst = float(rate), float(burst or rate)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"Invalid rate limit '{spec}': the rate must be positive and the burst at least 1")
+    return rate, burst
+
+
+def parse_route_limits(spec: str) -> dict:
+    """Parses "endpoint=rate/burst,..." into a dictionary of limits"""
+    limits = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            endpoint, limit = item.split("=", 1)
+            limits[endpoint.strip()] = parse_limit(limit.strip())
+    return limits
+
+
+class RateLimiter:
+    """Global and per-client token buckets with per-route client limits"""
+
+    def __init__(self, global_limit, client_limit, route_limits: dict, max_clients: int = 10000):
+        self.global_bucket = TokenBucket(*global_limit) if global_limit else None
+        self.client_limit = client_limit
+        self.route_limits = route_limits
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _client_bucket(self, client: str, endpoint: str):
+        limit = self.route_limits.get(endpoint, self.client_limit)
+        if not limit:
+            return None
+        key = (client, endpoint if endpoint in self.route_limits else None)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(*limit)
+                # forget the least recently seen clients
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def check(self, client: str, endpoint: str) -> float:
+        """Returns 0 if the request may proceed, else the seconds to wait"""
+        bucket = self._client_bucket(client, endpoint)
+        retry_after = bucket.acquire() if bucket else 0.0
+        if not retry_after and self.global_bucket:
+            retry_after = self.global_bucket.acquire()
+        return retry_after
+
+
+def client_id() -> str:
+    """Identifies the client by its address, as seen by the first trusted proxy"""
+    return request.remote_addr or "unknown"
+
+
+######################################################################
+# Request hooks
+######################################################################
+def check_rate_limit(endpoint: str):
+    """Raises 429 Too Many Requests if the client is over its limit for endpoint"""
+    limiter = current_app.extensions.get("rate_limiter")
+    if limiter:
+        retry_after = limiter.check(client_id(), endpoint)
+        if retry_after:
+            registry.increment("requests_rejected_total", reason="rate_limit", endpoint=endpoint)
+            raise TooManyRequests("Rate limit exceeded", retry_after=math.ceil(retry_after))
+
+
+def _admit_request():
+    """Rejects the request if it is over a rate or concurrency limit"""
+    endpoint = request.endpoint
+    if endpoint in EXEMPT_ENDPOINTS:
+        return
+    check_rate_limit(endpoint)
+    concurrency = current_app.extensions.get("concurrency_limiter")
+    if concurrency:
+        if not concurrency.acquire():
+            registry.increment("requests_rejected_total", reason="overloaded", endpoint=endpoint)
+            raise ServiceUnavailable("Server is overloaded", retry_after=1)
+        request.environ[ACQUIRED_KEY] = True
+
+
+def _release_request(error):  # pylint: disable=unused-argument
+    """Frees the concurrency slot taken by the request"""
+    if request.environ.pop(ACQUIRED_KEY, False):
+        current_app.extensions["concurrency_limiter"].release()
+
+
+def init_app(app):
+    """Builds the limiters from the app config and registers the hooks"""
+    if app.config.get("TRUSTED_PROXIES", 0):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
+    if app.config.get("RATE_LIMIT_ENABLED", False):
+        app.extensions["rate_limiter"] = RateLimiter(
+            parse_limit(app.config.get("RATE_LIMIT_GLOBAL")),
+            parse_limit(app.config.get("RATE_LIMIT_CLIENT")),
+            parse_route_limits(app.config.get("RATE_LIMIT_ROUTES")),
+        )
+    if app.config.get("CONCURRENCY_LIMIT", 0):
+        app.extensions["concurrency_limiter"] = ConcurrencyLimiter(
+            app.config["CONCURRENCY_LIMIT"],
+            app.config.get("CONCURRENCY_QUEUE_SIZE", 0),
+            app.config.get("CONCURRENCY_QUEUE_TIMEOUT", 0.5),
+        )
+    app.before_request(_admit_request)
+    app.teardown_request(_release_request)
@@ -0,0 +1,190 @@
+"""
+Readiness
+
+Tells the load balancer whether this worker should get more traffic.
+Unlike /healthcheck, the readiness check looks at the database and at how
+busy the worker is:
+
+* the database is pinged at most once every READINESS_PROBE_SECONDS, and
+  probes in between reuse the last answer, so frequent probes from many
+  pods do not add load; only one thread pings at a time, and the first
+  probes of a worker wait for its first ping rather than guess
+* a connection pool with every connection checked out is not pinged at
+  all, since the ping would only wait for a connection
+* the in-flight requests are counted, along with the requests waiting for
+  a slot when the concurrency limit is on
+
+The worker is not ready when the last ping failed, a pool is saturated,
+requests are queueing, or more than READINESS_MAX_IN_FLIGHT requests are
+in flight.
+"""
+import logging
+import threading
+import time
+from flask import current_app, request
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+from service.common.metrics import registry
+from service.common.rate_limit import EXEMPT_ENDPOINTS
+
+COUNTED_KEY = "customers.readiness_counted"
+
+logger = logging.getLogger("flask.app")
+
+
+def pool_status(engine) -> dict:
+    """Returns how many connections of the engine's pool are in use"""
+    pool = engine.pool
+    result = {"url": engine.url.render_as_string(hide_password=True), "pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        # a negative max_overflow allows unlimited connections
+        max_overflow = pool._max_overflow  # pylint: disable=protected-access
+        capacity = pool.size() + max_overflow if max_overflow >= 0 else None
+        result.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            capacity=capacity,
+            saturation=round(pool.checkedout() / capacity, 3) if capacity else 0.0,
+        )
+    return result
+
+
+class ReadinessProbe:
+    """A cached database ping plus the saturation of the worker"""
+
+    def __init__(self):
+        self.engines = None
+        self.interval = 5.0
+        self.max_pool_saturation = 1.0
+        self.max_in_flight = 0
+        self.in_flight = 0
+        self.database_ok = None
+        self.database_error = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+
+    def configure(self, engines, interval: float, max_pool_saturation: float, max_in_flight: int):
+        """Sets the engines to ping, how often, and the saturation limits"""
+        self.engines = engines
+        self.interval = interval
+        self.max_pool_saturation = max_pool_saturation
+        self.max_in_flight = max_in_flight
+        self.database_ok = None
+        self.checked_at = None
+
+    def started(self):
+        """Counts a request that began"""
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self):
+        """Counts a request that ended"""
+        with self._lock:
+            self.in_flight -= 1
+
+    def _is_fresh(self) -> bool:
+        """Returns True if the last ping is recent enough to reuse"""
+        return self.checked_at is not None and time.monotonic() - self.checked_at < self.interval
+
+    def probe(self, pools: list):
+        """Pings the databases unless the last ping is recent or another thread is pinging"""
+        if self._is_fresh():
+            return
+        # with no answer yet there is nothing to reuse, so wait for the ping in progress
+        if not self._probe_lock.acquire(blocking=self.checked_at is None):
+            return
+        try:
+            if self._is_fresh():
+                return
+            error = None
+            for engine, pool in zip(self.engines(), pools):
+                if pool.get("capacity") and pool["checked_out"] >= pool["capacity"]:
+                    error = f"connection pool of {pool['url']} is exhausted"
+                    break
+                try:
+                    with engine.connect() as connection:
+                        connection.execute(text("SELECT 1"))
+                except Exception as exc:  # pylint: disable=broad-except
+                    error = f"{pool['url']}: {exc.__class__.__name__}: {exc}"
+                    break
+            if error:
+                logger.warning("Readiness probe failed: %s", error)
+            registry.increment("readiness_probes_total", result="error" if error else "ok")
+            self.database_ok, self.database_error = error is None, error
+            self.checked_at = time.monotonic()
+        finally:
+            self._probe_lock.release()
+
+    def _reasons(self, pools: list, requests: dict) -> list:
+        """Returns why the worker is not ready, or an empty list"""
+        reasons = []
+        if self.database_ok is False:
+            reasons.append(f"database unavailable: {self.database_error}")
+        for pool in pools:
+            if pool.get("capacity") and pool["saturation"] >= self.max_pool_saturation:
+                reasons.append(f"connection pool of {pool['url']} is saturated")
+        if requests.get("waiting"):
+            reasons.append(f"{requests['waiting']} requests are waiting for a slot")
+        if self.max_in_flight and requests["in_flight"] >= self.max_in_flight:
+            reasons.append(f"{requests['in_flight']} requests are in flight")
+        return reasons
+
+    def check(self, concurrency=None) -> dict:
+        """Returns the readiness of the worker and what it is based on"""
+        pools = [pool_status(engine) for engine in self.engines()]
+        self.probe(pools)
+        requests = {"in_flight": self.in_flight}
+        if concurrency is not None:
+            requests.update(limit=concurrency.limit, waiting=concurrency.waiting)
+        reasons = self._reasons(pools, requests)
+        registry.set("readiness_ready", 0 if reasons else 1)
+        return {
+            "ready": not reasons,
+            "reasons": reasons,
+            "database": {
+                "ok": self.database_ok,
+                "error": self.database_error,
+                "age_seconds": round(time.monotonic() - self.checked_at, 3) if self.checked_at else None,
+            },
+            "pools": pools,
+            "requests": requests,
+        }
+
+
+######################################################################
+# Request hooks
+######################################################################
+def _count_request():
+    """Counts the request as in flight"""
+    if request.endpoint not in EXEMPT_ENDPOINTS:
+        readiness_probe.started()
+        request.environ[COUNTED_KEY] = True
+
+
+def _uncount_request(error):  # pylint: disable=unused-argument
+    """Stops counting the request"""
+    if request.environ.pop(COUNTED_KEY, False):
+        readiness_probe.finished()
+
+
+def concurrency_limiter():
+    """Returns the concurrency limiter of the app, if it has one"""
+    return current_app.extensions.get("concurrency_limiter")
+
+
+def init_app(app, engines):
+    """Configures the probe and counts the requests in flight"""
+    readiness_probe.configure(
+        engines,
+        app.config.get("READINESS_PROBE_SECONDS", 5),
+        app.config.get("READINESS_MAX_POOL_SATURATION", 1.0),
+        app.config.get("READINESS_MAX_IN_FLIGHT", 0),
+    )
+    app.before_request(_count_request)
+    app.teardown_request(_uncount_request)
+
+
+# The readiness probe of this worker
+readiness_probe = ReadinessProbe()
@@ -0,0 +1,110 @@
+"""
+Payload Schemas
+
+Validates request payloads against a table's columns before anything
+reaches the database. compile_schema() reads the columns once and builds
+one small check per field; validating a payload then runs those checks in
+a single pass and reports every problem, not just the first one.
+
+Strings are checked against their column length, enums against their
+Python Enum's names, and non-nullable columns without a default are
+required.
+"""
+import enum
+from sqlalchemy import Enum, Integer, String
+
+
+def _string_check(name: str, length: int):
+    def check(value):
+        if type(value) is not str:  # pylint: disable=unidiomatic-typecheck
+            return f"{name} must be a string"
+        if length and len(value) > length:
+            return f"{name} must be at most {length} characters"
+        return None
+    return check
+
+
+def _enum_check(name: str, enum_class):
+    # the message lists the members in declaration order; the set is only for lookups
+    members = tuple(enum_class.__members__)
+    names = frozenset(members)
+    choices = ", ".join(members)
+
+    def check(value):
+        if type(value) is not str or value.upper() not in names:  # pylint: disable=unidiomatic-typecheck
+            return f"{name} must be one of {choices}"
+        return None
+    return check
+
+
+def _integer_check(name: str):
+    def check(value):
+        if type(value) is not int:  # pylint: disable=unidiomatic-typecheck
+            return f"{name} must be an integer"
+        return None
+    return check
+
+
+def _compile_check(column):
+    """Returns the check for a column's values, or None if it has no type we check"""
+    if isinstance(column.type, Enum) and column.type.enum_class is not None and issubclass(
+        column.type.enum_class, enum.Enum
+    ):
+        return _enum_check(column.name, column.type.enum_class)
+    if isinstance(column.type, String):
+        return _string_check(column.name, column.type.length)
+    if isinstance(column.type, Integer):
+        return _integer_check(column.name)
+    return None
+
+
+class Schema:
+    """The compiled checks for the fields of a payload"""
+
+    def __init__(self, name: str, fields: list):
+        self.name = name
+        # (field name, required, nullable, check)
+        self.fields = fields
+
+    def validate(self, data) -> list:
+        """Returns every problem with a payload, or an empty list if it is valid"""
+        if not isinstance(data, dict):
+            return ["body of request contained bad or no data"]
+        errors = []
+        for name, required, nullable, check in self.fields:
+            if name not in data:
+                if required:
+                    errors.append(f"missing {name}")
+                continue
+            value = data[name]
+            if value is None:
+                if not nullable:
+                    errors.append(f"{name} must not be null")
+                continue
+            error = check(value)
+            if error:
+                errors.append(error)
+        return errors
+
+    def validate_many(self, payloads) -> dict:
+        """Returns the problems of each invalid payload, keyed by its index"""
+        validate = self.validate
+        invalid = {}
+        for index, data in enumerate(payloads):
+            errors = validate(data)
+            if errors:
+                invalid[index] = errors
+        return invalid
+
+
+def compile_schema(table, exclude=()) -> Schema:
+    """Builds a Schema from a table's columns, leaving out the excluded ones"""
+    fields = []
+    for column in table.columns:
+        check = _compile_check(column)
+        if column.name in exclude or check is None:
+            continue
+        has_default = column.default is not None or column.server_default is not None
+        required = not column.nullable and not has_default
+        fields.append((column.name, required, column.nullable or has_default, check))
+    return Schema(table.name, fields)
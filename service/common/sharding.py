@@ -0,0 +1,226 @@
+"""
+Customer Sharding
+
+Spreads customers over several databases, chosen by a hash of their id.
+
+Ids are handed out in blocks from a counter table on the allocator
+database, so every shard sees globally unique ids without coordinating on
+each insert. An id is mapped to a shard with jump consistent hashing:
+appending a database to the list moves only about 1/n of the customers,
+all of them onto the new shard, and rebalance() copies them there.
+
+Lookups by id go to one shard. Queries on other columns are scattered to
+every shard in parallel and their results gathered.
+
+A shard's unique constraints only cover its own rows, so the models check
+unique columns such as the email with a scattered query before they write.
+That is check-then-write: two writers on different shards that check at
+the same moment can both pass and store duplicates.
+"""
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+logger = logging.getLogger("flask.app")
+
+metadata = MetaData()
+
+# The next free id of each sequence, on the allocator database
+id_blocks = Table(
+    "shard_id_block",
+    metadata,
+    Column("name", String(63), primary_key=True),
+    Column("next_id", Integer, nullable=False),
+)
+
+
+def parse_shard_uris(spec: str) -> list:
+    """Parses a comma separated list of database URIs"""
+    return [uri.strip() for uri in (spec or "").split(",") if uri.strip()]
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Maps a key to one of buckets, moving few keys when buckets grows (Lamping & Veach)"""
+    # ids are sequential, so spread them over 64 bits first
+    key = int.from_bytes(hashlib.blake2b(key.to_bytes(8, "little", signed=True), digest_size=8).digest(), "little")
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+class IdAllocator:
+    """Hands out globally unique ids, reserving them from the database a block at a time"""
+
+    def __init__(self, engine, name: str, block_size: int = 100, start=None):
+        self.engine = engine
+        self.name = name
+        self.block_size = block_size
+        self.start = start
+        self._next = self._limit = 0
+        self._lock = threading.Lock()
+
+    def allocate(self) -> int:
+        """Returns the next id"""
+        with self._lock:
+            if self._next >= self._limit:
+                self._next = self._reserve()
+                self._limit = self._next + self.block_size
+            self._next += 1
+            return self._next - 1
+
+    def _reserve(self) -> int:
+        """Moves the counter a block forward and returns the first id of the block"""
+        for _ in range(3):
+            try:
+                with self.engine.begin() as conn:
+                    first = conn.execute(
+                        select(id_blocks.c.next_id).where(id_blocks.c.name == self.name).with_for_update()
+                    ).scalar()
+                    if first is None:
+                        first = self.start() if callable(self.start) else (self.start or 1)
+                        conn.execute(id_blocks.insert().values(name=self.name, next_id=first + self.block_size))
+                    else:
+                        conn.execute(
+                            id_blocks.update()
+                            .where(id_blocks.c.name == self.name)
+                            .values(next_id=first + self.block_size)
+                        )
+                    return first
+            except IntegrityError:
+                # another worker created the counter first
+                continue
+        raise RuntimeError(f"Could not reserve ids for {self.name}")
+
+
+class ShardRouter:
+    """Routes customers to shard databases and scatters queries across them"""
+
+    def __init__(self, engines: list, allocator: IdAllocator = None, scopefunc=None):
+        self.engines = engines
+        self.allocator = allocator
+        self.sessions = [
+            scoped_session(sessionmaker(bind=engine), scopefunc=scopefunc) for engine in engines
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=len(engines), thread_name_prefix="shard-query")
+
+    @classmethod
+    def from_uris(cls, uris: list, engine_options: dict = None, scopefunc=None):
+        """Creates a router over new engines for the given database URIs"""
+        engines = [create_engine(uri, **(engine_options or {})) for uri in uris]
+        return cls(engines, scopefunc=scopefunc)
+
+    @property
+    def shard_count(self) -> int:
+        """Returns the number of shards"""
+        return len(self.engines)
+
+    def shard_for(self, customer_id: int) -> int:
+        """Returns the index of the shard that holds a customer"""
+        return jump_hash(customer_id, len(self.engines))
+
+    def session_for(self, customer_id: int):
+        """Returns the current session of the shard that holds a customer"""
+        return self.sessions[self.shard_for(customer_id)]()
+
+    def allocate_id(self) -> int:
+        """Returns a new, globally unique customer id"""
+        return self.allocator.allocate()
+
+    def scatter(self, query) -> list:
+        """Runs query(session) on every shard in parallel and returns the results in shard order
+
+        Each shard gets a short-lived session of its own, so loaded objects
+        come back detached, with their attributes loaded.
+        """
+        def run(engine):
+            with Session(engine, expire_on_commit=False) as session:
+                return query(session)
+
+        return list(self._executor.map(run, self.engines))
+
+    def create_all(self, tables: list):
+        """Creates the given tables on every shard"""
+        for engine in self.engines:
+            tables[0].metadata.create_all(engine, tables=tables)
+
+    def remove(self):
+        """Closes the current sessions of every shard"""
+        for session in self.sessions:
+            session.remove()
+
+    def dispose(self):
+        """Closes every shard's connections and the query threads"""
+        self.remove()
+        self._executor.shutdown(wait=False)
+        for engine in self.engines:
+            engine.dispose()
+
+
+def max_id(router: ShardRouter, table) -> int:
+    """Returns the highest id stored in any shard"""
+    return max(router.scatter(lambda session: session.execute(select(func.max(table.c.id))).scalar() or 0))
+
+
+def _move_rows(router: ShardRouter, source: int, table, rows, key: str) -> int:
+    """Copies rows to the shards their key hashes to, then deletes them from source"""
+    by_target = {}
+    for row in rows:
+        target = router.shard_for(row[key])
+        if target != source:
+            by_target.setdefault(target, []).append(row)
+    for target, misplaced in by_target.items():
+        ids = [row["id"] for row in misplaced]
+        if key == "id":
+            # skip rows an interrupted run already copied
+            with router.engines[target].connect() as conn:
+                present = set(conn.execute(select(table.c.id).where(table.c.id.in_(ids))).scalars())
+            values = [dict(row) for row in misplaced if row["id"] not in present]
+        else:
+            # secondary tables number their rows per shard
+            values = [{name: value for name, value in row.items() if name != "id"} for row in misplaced]
+        if values:
+            with router.engines[target].begin() as conn:
+                conn.execute(table.insert(), values)
+        with router.engines[source].begin() as conn:
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+    return sum(len(misplaced) for misplaced in by_target.values())
+
+
+def rebalance(router: ShardRouter, tables: dict, batch_size: int = 500, dry_run: bool = False) -> dict:
+    """Moves every row that is not on the shard its key hashes to
+
+    Args:
+        router: a router over the new list of shards
+        tables: maps each table to the column that picks its shard
+        batch_size: how many rows are read, copied and deleted at a time
+        dry_run: only count the rows that would move
+
+    Returns:
+        the number of rows moved (or to be moved) for each table name
+    """
+    moved = {}
+    for table, key in tables.items():
+        moved[table.name] = 0
+        for source, engine in enumerate(router.engines):
+            last_id = 0
+            while True:
+                with engine.connect() as conn:
+                    rows = conn.execute(
+                        select(table).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+                    ).mappings().all()
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                if dry_run:
+                    moved[table.name] += sum(1 for row in rows if router.shard_for(row[key]) != source)
+                else:
+                    moved[table.name] += _move_rows(router, source, table, rows, key)
+        logger.info("Rebalanced %s: %d rows %s", table.name, moved[table.name], "to move" if dry_run else "moved")
+    return moved
@@ -0,0 +1,96 @@
+"""
+Request Coalescing
+
+Lets concurrent identical reads in a worker share one database query.
+The first request for a key runs the query; requests for the same key that
+arrive while it is running wait for its result instead of running their
+own. If it fails they raise a FlightFailed caused by its exception, and if
+it is interrupted (e.g. a gevent timeout) they run the query themselves.
+
+A waiter gives up after SINGLE_FLIGHT_TIMEOUT_SECONDS and runs the query
+itself, so a stuck query does not hold every request for the key. Callers
+put the data generation in the key, so a read that starts after a change
+commits never gets a result read before it.
+
+The shared results are handed to several threads and must not be mutated.
+"""
+import threading
+from service.common.metrics import registry
+
+
+class FlightFailed(Exception):
+    """The call in flight that a waiter shared failed"""
+
+
+class Flight:
+    """A query in progress and the outcome its waiters are given"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one call at a time per key and shares its outcome with concurrent callers"""
+
+    def __init__(self):
+        self.enabled = False
+        self.timeout = 2.0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def configure(self, config: dict):
+        """Reads the coalescing settings from the app config"""
+        self.enabled = config.get("SINGLE_FLIGHT_ENABLED", False)
+        self.timeout = config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", 2.0)
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call for the same key already in flight"""
+        if not self.enabled or key is None:
+            return func()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if leader:
+            return self._lead(key, flight, func)
+        return self._follow(flight, func)
+
+    def _lead(self, key, flight: Flight, func):
+        """Runs the call and hands its outcome to the waiters"""
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _follow(self, flight: Flight, func):
+        """Waits for the call in flight, or runs func itself after the timeout"""
+        if not flight.done.wait(self.timeout):
+            registry.increment("single_flight_timeouts_total")
+            return func()
+        if flight.error is not None and not isinstance(flight.error, Exception):
+            # the leader was interrupted rather than failed, so there is no outcome to share
+            registry.increment("single_flight_abandoned_total")
+            return func()
+        registry.increment("single_flight_queries_saved_total", result="error" if flight.error else "ok")
+        if flight.error is not None:
+            # a fresh exception for each waiter, so none of them shares or alters the leader's traceback
+            raise FlightFailed(f"Shared query failed: {flight.error}") from flight.error
+        return flight.result
+
+
+def init_app(app):
+    """Configures request coalescing"""
+    single_flight.configure(app.config)
+
+
+# The request coalescing of this worker
+single_flight = SingleFlight()
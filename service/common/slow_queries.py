@@ -0,0 +1,155 @@
+"""
+Slow Query Log
+
+Logs every statement that takes longer than SLOW_QUERY_THRESHOLD_MS with
+its parameters (passwords redacted), duration and originating route, and
+aggregates them by statement shape so the worst offenders can be listed
+by total time. With SLOW_QUERY_EXPLAIN on, the query plan of the first
+slow occurrence of each SELECT shape is captured as well.
+"""
+import threading
+import time
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REDACTED = "********"
+SENSITIVE_PARAMETERS = ("password",)
+
+
+class SlowQueryLog:
+    """Aggregates slow statements by their SQL text"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shapes = {}
+
+    def record(self, statement: str, duration: float, route: str) -> bool:
+        """Records a slow statement, returning True the first time a shape is seen"""
+        with self._lock:
+            entry = self._shapes.get(statement)
+            if entry is None:
+                entry = self._shapes[statement] = {
+                    "statement": statement,
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "routes": [],
+                    "plan": None,
+                }
+            entry["count"] += 1
+            entry["total_ms"] += duration * 1000
+            entry["max_ms"] = max(entry["max_ms"], duration * 1000)
+            if route not in entry["routes"]:
+                entry["routes"].append(route)
+            return entry["count"] == 1
+
+    def set_plan(self, statement: str, plan: list):
+        """Stores the captured query plan for a statement shape"""
+        with self._lock:
+            if statement in self._shapes:
+                self._shapes[statement]["plan"] = plan
+
+    def top(self, limit: int = 10) -> list:
+        """Returns the slow statement shapes ordered by total time"""
+        with self._lock:
+            entries = [dict(entry, routes=list(entry["routes"])) for entry in self._shapes.values()]
+        entries.sort(key=lambda entry: entry["total_ms"], reverse=True)
+        return entries[:limit]
+
+    def reset(self):
+        """Forgets every recorded statement"""
+        with self._lock:
+            self._shapes.clear()
+
+
+# The slow query log of this worker
+slow_query_log = SlowQueryLog()
+
+
+def redact_parameters(parameters, context):
+    """Returns a copy of the statement parameters with passwords masked"""
+    if isinstance(parameters, dict):
+        return {
+            key: REDACTED if any(word in key.lower() for word in SENSITIVE_PARAMETERS) else value
+            for key, value in parameters.items()
+        }
+    names = getattr(getattr(context, "compiled", None), "positiontup", None)
+    if isinstance(parameters, (list, tuple)) and names and len(names) == len(parameters):
+        return tuple(
+            REDACTED if any(word in name.lower() for word in SENSITIVE_PARAMETERS) else value
+            for name, value in zip(names, parameters)
+        )
+    return parameters
+
+
+def explain(conn, cursor, statement, parameters) -> list:
+    """Returns the query plan of a SELECT using a separate DBAPI cursor
+
+    The cursor shares the request's connection and transaction. On Postgres
+    a failed statement aborts the whole transaction, so the EXPLAIN runs
+    inside a savepoint that is rolled back if it fails.
+    """
+    if conn.dialect.name == "postgresql":
+        sql = "EXPLAIN (ANALYZE, BUFFERS) " + statement
+        savepoint = "slow_query_explain"
+    elif conn.dialect.name == "sqlite":
+        sql = "EXPLAIN QUERY PLAN " + statement
+        savepoint = None
+    else:
+        return None
+    plan_cursor = cursor.connection.cursor()
+    try:
+        if savepoint:
+            plan_cursor.execute(f"SAVEPOINT {savepoint}")
+        try:
+            plan_cursor.execute(sql, parameters)
+            plan = [" ".join(str(column) for column in row) for row in plan_cursor.fetchall()]
+        except Exception:
+            if savepoint:
+                plan_cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+            raise
+        finally:
+            if savepoint:
+                plan_cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+        return plan
+    finally:
+        plan_cursor.close()
+
+
+######################################################################
+# Event listeners
+######################################################################
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    """Notes when the statement started"""
+    conn.info["slow_query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    """Logs and aggregates the statement if it ran over the threshold"""
+    duration = time.perf_counter() - conn.info.pop("slow_query_start", time.perf_counter())
+    if not has_app_context():
+        return
+    threshold = current_app.config.get("SLOW_QUERY_THRESHOLD_MS", 0)
+    if not threshold or duration * 1000 < threshold:
+        return
+
+    route = request.endpoint if has_request_context() else None
+    current_app.logger.warning(
+        "Slow query (%.1f ms) in %s: %s parameters=%s",
+        duration * 1000, route, statement, redact_parameters(parameters, context)
+    )
+    first_time = slow_query_log.record(statement, duration, route)
+    capture = current_app.config.get("SLOW_QUERY_EXPLAIN", False)
+    if first_time and capture and not executemany and statement.lstrip().upper().startswith("SELECT"):
+        try:
+            slow_query_log.set_plan(statement, explain(conn, cursor, statement, parameters))
+        except Exception as error:  # pylint: disable=broad-except
+            current_app.logger.warning("Could not capture query plan: %s", error)
+
+
+def init_app(app):  # pylint: disable=unused-argument
+    """Registers the slow query listeners"""
+    if not event.contains(Engine, "after_cursor_execute", _after_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,123 @@
+"""
+SQL Instrumentation
+
+Hooks SQLAlchemy engine and ORM events to record, for every request, how
+many statements were issued, how long they took and how many rows were
+loaded. The totals are returned in a Server-Timing response header and
+added to the metrics registry.
+
+Setting SQL_STATEMENT_BUDGET caps the statements one request may issue;
+with SQL_STRICT_MODE on (meant for tests) going over the budget raises
+StatementBudgetExceeded, otherwise a warning is logged. Statements that
+repeat the same SQL more than SQL_N_PLUS_ONE_THRESHOLD times in a request
+are reported as a likely N+1 pattern.
+"""
+import time
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.common.metrics import registry
+
+STATS_KEY = "customers.sql_stats"
+
+
+class StatementBudgetExceeded(Exception):
+    """Raised in strict mode when a request issues too many statements"""
+
+
+class RequestSqlStats:
+    """Statement counters for a single request"""
+
+    def __init__(self):
+        self.statements = 0
+        self.duration = 0.0
+        self.rows = 0
+        self.shapes = {}
+
+    def server_timing(self) -> str:
+        """Returns the stats as a Server-Timing header value"""
+        return (
+            f'db;dur={self.duration * 1000:.2f};desc="{self.statements} statements", '
+            f"db-rows;desc={self.rows}"
+        )
+
+
+def current_stats():
+    """Returns the SQL stats of the current request, or None outside one"""
+    if not has_request_context():
+        return None
+    return request.environ.get(STATS_KEY)
+
+
+######################################################################
+# Event listeners
+######################################################################
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    """Counts the statement and enforces the statement budget"""
+    stats = current_stats()
+    if stats is None:
+        return
+    stats.statements += 1
+    stats.shapes[statement] = stats.shapes.get(statement, 0) + 1
+
+    budget = current_app.config.get("SQL_STATEMENT_BUDGET", 0)
+    if budget and stats.statements > budget:
+        message = f"{request.endpoint} issued {stats.statements} SQL statements (budget {budget})"
+        if current_app.config.get("SQL_STRICT_MODE", False):
+            raise StatementBudgetExceeded(message)
+        if stats.statements == budget + 1:
+            current_app.logger.warning(message)
+    conn.info["query_start_time"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    """Adds the elapsed time to the request stats"""
+    stats = current_stats()
+    if stats is not None:
+        stats.duration += time.perf_counter() - conn.info.pop("query_start_time", time.perf_counter())
+
+
+def _on_load(target, context):  # pylint: disable=unused-argument
+    """Counts every row loaded into an ORM instance"""
+    stats = current_stats()
+    if stats is not None:
+        stats.rows += 1
+
+
+######################################################################
+# Request hooks
+######################################################################
+def _start_request():
+    """Attaches an empty stats object to the request"""
+    request.environ[STATS_KEY] = RequestSqlStats()
+
+
+def _finish_request(response):
+    """Publishes the request stats as a header and as metrics"""
+    stats = current_stats()
+    if stats is None:
+        return response
+    response.headers.add("Server-Timing", stats.server_timing())
+
+    endpoint = request.endpoint or "unknown"
+    registry.increment("db_statements_total", stats.statements, endpoint=endpoint)
+    registry.increment("db_time_seconds_total", stats.duration, endpoint=endpoint)
+    registry.increment("db_rows_total", stats.rows, endpoint=endpoint)
+
+    threshold = current_app.config.get("SQL_N_PLUS_ONE_THRESHOLD", 0)
+    repeated = [sql for sql, count in stats.shapes.items() if threshold and count > threshold]
+    for sql in repeated:
+        current_app.logger.warning(
+            "Possible N+1 in %s: statement ran %d times: %s", endpoint, stats.shapes[sql], sql
+        )
+    return response
+
+
+def init_app(app, model_base):
+    """Registers the SQL instrumentation with the app and ORM"""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(model_base, "load", _on_load, propagate=True)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
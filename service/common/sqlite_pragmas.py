@@ -0,0 +1,51 @@
+"""
+Embedded SQLite Mode
+
+Tunes every SQLite connection the app opens, so the service can run and
+be benchmarked on a laptop or CI box without a database server:
+
+* journal_mode=WAL lets readers run while the single writer commits
+* synchronous=NORMAL only syncs at checkpoints, which is safe with WAL
+* busy_timeout makes a writer wait for the lock instead of failing
+* a larger page cache, memory mapped reads and in-memory temp tables
+
+In-memory databases ignore the journal settings.
+"""
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The PRAGMA statements run on each new SQLite connection
+statements = []
+
+
+def build_pragmas(config) -> list:
+    """Returns the PRAGMA statements for the SQLite settings in config"""
+    return [
+        f"PRAGMA journal_mode = {config.get('SQLITE_JOURNAL_MODE', 'WAL')}",
+        f"PRAGMA synchronous = {config.get('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA busy_timeout = {int(config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+        # a negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size = {-int(config.get('SQLITE_CACHE_SIZE_KB', 65536))}",
+        f"PRAGMA mmap_size = {int(config.get('SQLITE_MMAP_SIZE_MB', 256)) * 1024 * 1024}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+
+def _on_connect(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    """Applies the pragmas to a new SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def init_app(app):
+    """Reads the SQLite settings and tunes every SQLite connection opened from now on"""
+    statements[:] = build_pragmas(app.config)
+    if not event.contains(Engine, "connect", _on_connect):
+        event.listen(Engine, "connect", _on_connect)
@@ -0,0 +1,213 @@
+"""
+Customer Statistics
+
+Counts customers by status and by email domain without scanning the
+table on every request.
+
+The counts are read from the database once, then kept current from the
+ORM: every flush records how the customers it inserts, deletes or changes
+move the counts, and the change is applied when the transaction commits.
+Each worker only sees its own commits, so the counts are reconciled with
+the database in the background every STATS_RECONCILE_SECONDS. A change
+that commits while a reconciliation is reading the table can be counted
+twice until the next one.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+DELTA_KEY = "customers.stats_delta"
+
+logger = logging.getLogger("flask.app")
+
+
+def email_domain(email: str) -> str:
+    """Returns the lowercase domain of an email address"""
+    return email.rpartition("@")[2].strip().lower() if email else ""
+
+
+def domain_expression(column, dialect: str):
+    """Returns a SQL expression for the lowercase domain of an email column"""
+    if dialect == "postgresql":
+        return func.lower(func.split_part(column, "@", 2))
+    return func.lower(func.substr(column, func.instr(column, "@") + 1))
+
+
+class CustomerStats:
+    """Customer counts by status and email domain, maintained incrementally"""
+
+    def __init__(self):
+        self.model = None
+        self.sessions = None
+        self.max_age = 60
+        self.by_status = Counter()
+        self.by_domain = Counter()
+        self.reconciled_at = None
+        self._reconciled = None
+        self._scanning = None
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._reconciling = threading.Event()
+
+    def configure(self, model, sessions, max_age: float):
+        """Sets the model to count, where to read it from, and how often to reconcile"""
+        self.model = model
+        self.sessions = sessions
+        self.max_age = max_age
+
+    def apply(self, delta: Counter):
+        """Adds the changes of a committed transaction to the counts"""
+        with self._lock:
+            for (kind, value), count in delta.items():
+                (self.by_status if kind == "status" else self.by_domain)[value] += count
+            if self._scanning is not None:
+                self._scanning.update(delta)
+
+    def reconcile(self):
+        """Recounts every customer from the database and replaces the counts"""
+        with self._reconcile_lock:
+            logger.info("Reconciling customer statistics")
+            with self._lock:
+                self._scanning = Counter()
+            by_status, by_domain = Counter(), Counter()
+            try:
+                for session in self.sessions():
+                    domain = domain_expression(self.model.email, session.get_bind().dialect.name)
+                    for status, count in session.query(self.model.status, func.count()).group_by(self.model.status):
+                        by_status[str(status)] += count
+                    for name, count in session.query(domain, func.count()).group_by(domain):
+                        by_domain[name] += count
+                    session.commit()
+            finally:
+                with self._lock:
+                    scanned, self._scanning = self._scanning, None
+            with self._lock:
+                # keep the changes committed while the table was being read
+                for (kind, value), count in scanned.items():
+                    (by_status if kind == "status" else by_domain)[value] += count
+                self.by_status, self.by_domain = +by_status, +by_domain
+                self.reconciled_at = datetime.utcnow()
+                self._reconciled = time.monotonic()
+
+    def refresh(self, app):
+        """Reconciles the counts now if they were never read, or in the background once they are too old"""
+        if self._reconciled is None:
+            self.reconcile()
+            return
+        too_old = self.max_age and time.monotonic() - self._reconciled >= self.max_age
+        if not too_old or self._reconciling.is_set():
+            return
+        self._reconciling.set()
+
+        def run():
+            try:
+                with app.app_context():
+                    self.reconcile()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Customer statistics reconciliation failed: %s", error)
+            finally:
+                self._reconciling.clear()
+
+        threading.Thread(target=run, name="customer-stats-reconcile", daemon=True).start()
+
+    def snapshot(self, top_domains: int) -> dict:
+        """Returns the counts, with only the most common email domains"""
+        with self._lock:
+            by_status = {status: count for status, count in self.by_status.items() if count}
+            by_domain = dict(self.by_domain.most_common(top_domains))
+            domains = sum(1 for count in self.by_domain.values() if count > 0)
+        return {
+            "total": sum(by_status.values()),
+            "by_status": by_status,
+            "by_email_domain": by_domain,
+            "email_domains": domains,
+            "reconciled_at": self.reconciled_at.isoformat() if self.reconciled_at else None,
+        }
+
+
+def _attribute_change(instance, name: str):
+    """Returns (old, new) for an attribute changed on instance, or None"""
+    history = inspect(instance).attrs[name].history
+    if not history.has_changes() or not history.deleted:
+        return None
+    return history.deleted[0], history.added[0] if history.added else None
+
+
+def _delta(instance, sign: int) -> Counter:
+    return Counter({("status", str(instance.status)): sign, ("domain", email_domain(instance.email)): sign})
+
+
+def _update_delta(instance) -> Counter:
+    """Moves an updated instance from its old status and domain to the new ones"""
+    delta = Counter()
+    for name, kind, key in (("status", "status", str), ("email", "domain", email_domain)):
+        change = _attribute_change(instance, name)
+        if change:
+            delta.subtract({(kind, key(change[0])): 1})
+            delta.update({(kind, key(change[1])): 1})
+    return delta
+
+
+def _after_flush(session, flush_context):  # pylint: disable=unused-argument
+    """Records how the flushed customers change the counts, until commit"""
+    model = customer_stats.model
+    if model is None:
+        return
+    delta = Counter()
+    for instance in session.new:
+        if isinstance(instance, model):
+            delta.update(_delta(instance, 1))
+    for instance in session.deleted:
+        if isinstance(instance, model):
+            delta.subtract(_delta(instance, 1))
+    for instance in session.dirty:
+        if isinstance(instance, model):
+            delta.update(_update_delta(instance))
+    if delta:
+        # kept per savepoint, so rolling one back only drops its own changes
+        deltas = session.info.setdefault(DELTA_KEY, {})
+        deltas.setdefault(session.get_nested_transaction(), Counter()).update(delta)
+
+
+def _after_commit(session):
+    if session.in_nested_transaction():
+        return
+    deltas = session.info.pop(DELTA_KEY, None)
+    if deltas:
+        total = Counter()
+        for delta in deltas.values():
+            total.update(delta)
+        customer_stats.apply(total)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    deltas = session.info.get(DELTA_KEY)
+    if not deltas:
+        return
+    if not previous_transaction.nested:
+        session.info.pop(DELTA_KEY, None)
+        return
+    for transaction in list(deltas):
+        # drop the savepoint's changes and those of savepoints inside it
+        parent = transaction
+        while parent is not None and parent is not previous_transaction:
+            parent = parent.parent
+        if parent is not None:
+            del deltas[transaction]
+
+
+def init_app(app, model, sessions):
+    """Starts counting model instances flushed by any session"""
+    customer_stats.configure(model, sessions, app.config.get("STATS_RECONCILE_SECONDS", 60))
+    if not event.contains(Session, "after_flush", _after_flush):
+        event.listen(Session, "after_flush", _after_flush)
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_soft_rollback", _after_soft_rollback)
+
+
+# The customer statistics of this worker
+customer_stats = CustomerStats()
@@ -13,6 +13,150 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Size the connection pool to match the worker concurrency that
+# gunicorn.conf.py exports, so threads never wait on a connection
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "2"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+if not DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
+# Server-side prepared statements with the psycopg 3 driver
+# (postgresql+psycopg://): a connection prepares a statement after running it
+# DB_PREPARE_THRESHOLD times ("none" turns it off, e.g. behind PgBouncer in
+# transaction mode) and keeps up to DB_PREPARED_MAX of them
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "5")
+DB_PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", "100"))
+
+# Embedded SQLite mode, e.g. DATABASE_URI=sqlite:///customers.db (kept in
+# the instance folder), for running and profiling the service without a
+# database server. sqlite:///:memory: is for tests only: every process gets
+# its own empty database and all threads share one connection, so
+# gunicorn.conf.py drops to one sync worker for it. These pragmas tune
+# every connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))
+
+# SQL instrumentation: cap statements per request (0 = no budget), fail
+# requests over budget when strict, and flag repeated statement shapes
+SQL_STATEMENT_BUDGET = int(os.getenv("SQL_STATEMENT_BUDGET", "0"))
+SQL_STRICT_MODE = os.getenv("SQL_STRICT_MODE", "false").lower() == "true"
+SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "10"))
+
+# Slow query log: threshold in milliseconds (0 = off) and whether to
+# capture the plan of the first slow occurrence of each SELECT
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "0"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+
+# Profiling: allow single requests to be profiled with an X-Profile header,
+# and optionally keep a rolling sample of request stacks (0 = off)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+REQUEST_PROFILE_INTERVAL_MS = float(os.getenv("REQUEST_PROFILE_INTERVAL_MS", "1"))
+PROFILER_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILER_SAMPLE_INTERVAL_MS", "0"))
+PROFILER_WINDOW_SECONDS = float(os.getenv("PROFILER_WINDOW_SECONDS", "60"))
+
+# Admission control: token bucket limits written as "rate/burst" for the
+# whole worker, per client, and per client for individual endpoints
+# ("list_customers=2/5,get_customers=50/100"), plus a cap on in-flight
+# requests with a bounded wait queue (0 = no cap)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+# Clients are told apart by address; set this to the number of proxies in
+# front of the service to take the address from their X-Forwarded-For hops
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+RATE_LIMIT_GLOBAL = os.getenv("RATE_LIMIT_GLOBAL", "")
+RATE_LIMIT_CLIENT = os.getenv("RATE_LIMIT_CLIENT", "50/100")
+RATE_LIMIT_ROUTES = os.getenv("RATE_LIMIT_ROUTES", "list_customers=5/10")
+CONCURRENCY_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", "0"))
+CONCURRENCY_QUEUE_SIZE = int(os.getenv("CONCURRENCY_QUEUE_SIZE", "10"))
+CONCURRENCY_QUEUE_TIMEOUT = float(os.getenv("CONCURRENCY_QUEUE_TIMEOUT", "0.5"))
+
+# How long responses to requests with an Idempotency-Key are kept
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+# Bloom filter over customer emails that answers most misses of
+# GET /customers?email= and most duplicate checks without a query. Each
+# worker keeps its own filter, fed with the emails of every worker and pod
+# by the SSE_PG_NOTIFY relay; without the relay lookups still query the
+# database, unless EMAIL_FILTER_SINGLE_PROCESS says one process writes all
+# customers (tests, or one worker on the embedded SQLite database)
+EMAIL_FILTER_ENABLED = os.getenv("EMAIL_FILTER_ENABLED", "false").lower() == "true"
+EMAIL_FILTER_SINGLE_PROCESS = os.getenv("EMAIL_FILTER_SINGLE_PROCESS", "false").lower() == "true"
+EMAIL_FILTER_ERROR_RATE = float(os.getenv("EMAIL_FILTER_ERROR_RATE", "0.01"))
+EMAIL_FILTER_CAPACITY = int(os.getenv("EMAIL_FILTER_CAPACITY", "10000"))
+EMAIL_FILTER_REBUILD_SECONDS = int(os.getenv("EMAIL_FILTER_REBUILD_SECONDS", "60"))
+
+# Group commit: concurrent creates in a worker wait up to
+# GROUP_COMMIT_MAX_WAIT_MS for others and share one transaction
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "32"))
+GROUP_COMMIT_MAX_WAIT_MS = float(os.getenv("GROUP_COMMIT_MAX_WAIT_MS", "2"))
+
+# The change feed holds back changes younger than this so that writes
+# stamped earlier but committed later are not skipped by a cursor
+CHANGE_FEED_SETTLE_SECONDS = float(os.getenv("CHANGE_FEED_SETTLE_SECONDS", "1"))
+
+# Server-Sent Events: each stream holds a worker thread, so cap streams per
+# worker (gevent workers handle many more). Subscribers whose queue fills
+# up are dropped. SSE_PG_NOTIFY fans events out to every worker through
+# Postgres LISTEN/NOTIFY instead of only the worker that made the change
+SSE_MAX_CLIENTS = int(os.getenv("SSE_MAX_CLIENTS", "2"))
+SSE_CLIENT_QUEUE_SIZE = int(os.getenv("SSE_CLIENT_QUEUE_SIZE", "100"))
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_PG_NOTIFY = os.getenv("SSE_PG_NOTIFY", "false").lower() == "true"
+
+# GET /customers/stats answers from counters kept by each worker, which are
+# recounted from the database in the background this often
+STATS_RECONCILE_SECONDS = float(os.getenv("STATS_RECONCILE_SECONDS", "60"))
+
+# Query cache: the encoded responses of GET /customers filters are kept
+# per worker up to QUERY_CACHE_MAX_BYTES and dropped on any change this
+# worker commits. Other workers' changes show after QUERY_CACHE_TTL_SECONDS
+QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "false").lower() == "true"
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "5"))
+
+# Request coalescing: concurrent identical GET /customers reads in a worker
+# share one query; waiters run their own after SINGLE_FLIGHT_TIMEOUT_SECONDS
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "false").lower() == "true"
+SINGLE_FLIGHT_TIMEOUT_SECONDS = float(os.getenv("SINGLE_FLIGHT_TIMEOUT_SECONDS", "2"))
+
+# Readiness: GET /readyz pings the database at most once per
+# READINESS_PROBE_SECONDS and answers 503 when the ping fails, a connection
+# pool is this saturated (1.0 means every connection is checked out), or
+# more than READINESS_MAX_IN_FLIGHT requests are in flight (0 for no limit)
+READINESS_PROBE_SECONDS = float(os.getenv("READINESS_PROBE_SECONDS", "5"))
+READINESS_MAX_POOL_SATURATION = float(os.getenv("READINESS_MAX_POOL_SATURATION", "1.0"))
+READINESS_MAX_IN_FLIGHT = int(os.getenv("READINESS_MAX_IN_FLIGHT", "0"))
+
+# Sharding: a comma separated list of databases to spread customers over
+# by a hash of their id. Ids are allocated on DATABASE_URI, which also keeps
+# the tables that are not sharded and may be one of the shards. To add a
+# shard, append its URI, run "flask shard-rebalance" and restart the workers
+SHARD_DATABASE_URIS = os.getenv("SHARD_DATABASE_URIS", "")
+SHARD_ID_BLOCK_SIZE = int(os.getenv("SHARD_ID_BLOCK_SIZE", "100"))
+
+# Token required in the X-Admin-Token header by the /diagnostics endpoints;
+# they are disabled when it is not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
 LOGGING_LEVEL = logging.INFO
+
+# Logging: "text" or "json", a bounded queue drained by a background
+# thread, and per-endpoint sampling of INFO logs ("list_customers=0.01,...")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
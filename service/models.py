@@ -3,17 +3,37 @@ Models for Customer
 
 All of the models are stored in this module
 """
+import itertools
 import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import any_, bindparam, inspect
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import NoResultFound, SQLAlchemyError
+from sqlalchemy.orm import make_transient, object_session
 from sqlalchemy.types import Enum
-from service.common import constants, enums
+from service.common import constants, enums, sharding
+from service.common.bloom import EmailFilter
+from service.common.group_commit import GroupCommitter
+from service.common.schema import compile_schema
+from service.common.sharding import IdAllocator, ShardRouter, max_id, parse_shard_uris
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Bloom filter over customer emails, built in init_db() when enabled
+email_filter = EmailFilter()
+
+# Callbacks told about every committed Customer change
+change_listeners = []
+
+# Session info key of the changes waiting for a transaction() to commit
+PENDING_CHANGES_KEY = "customers.pending_changes"
+
 
 # Function to initialize the database
 def init_db(app):
@@ -21,16 +41,106 @@ def init_db(app):
     Customer.init_db(app)
 
 
+def on_change(listener):
+    """Registers listener(event, customer) to be called after a Customer change is committed
+
+    The event is one of "create", "update", "suspend", "activate" or "delete".
+    """
+    if listener not in change_listeners:
+        change_listeners.append(listener)
+    return listener
+
+
+def notify_change(event: str, customer):
+    """Tells every change listener about a committed change"""
+    for listener in change_listeners:
+        try:
+            listener(event, customer)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Change listener %s failed: %s", listener, error)
+
+
+def customer_sessions() -> list:
+    """Returns the current session of every database that holds customers"""
+    if Customer.shards is None:
+        return [db.session]
+    return [shard() for shard in Customer.shards.sessions]
+
+
+def database_engines() -> list:
+    """Returns the engine of every database the service uses"""
+    if Customer.shards is None:
+        return [db.engine]
+    return [db.engine] + [engine for engine in Customer.shards.engines if engine is not db.engine]
+
+
+def on_relay_listening(listening: bool):
+    """Rebuilds the email filter each time the change relay starts listening, and trusts it after"""
+    email_filter.on_relay_listening(listening, Customer._rebuild_email_filter_in_app)  # pylint: disable=protected-access
+
+
+def _remove_shard_sessions(error):  # pylint: disable=unused-argument
+    """Closes the shard sessions at the end of the app context"""
+    if Customer.shards is not None:
+        Customer.shards.remove()
+
+
+def commit_change(session, event: str, customer):
+    """Commits a Customer change and tells the listeners, or only flushes it inside transaction()"""
+    pending = session.info.get(PENDING_CHANGES_KEY)
+    if pending is not None:
+        session.flush()
+        pending.append((event, customer))
+        return
+    session.commit()
+    notify_change(event, customer)
+
+
+def in_transaction() -> bool:
+    """Returns True inside transaction(), where changes are not committed yet"""
+    return PENDING_CHANGES_KEY in db.session.info
+
+
+@contextmanager
+def transaction():
+    """Runs several Customer changes in one transaction with a single commit
+
+    The changes made inside the block are flushed rather than committed,
+    and the change listeners hear about them once the block commits. An
+    exception rolls every change back.
+    """
+    if Customer.shards is not None:
+        raise DataValidationError("Changes cannot share a transaction when customers are sharded")
+    session = db.session
+    pending = session.info[PENDING_CHANGES_KEY] = []
+    try:
+        yield
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.info.pop(PENDING_CHANGES_KEY, None)
+    for event, customer in pending:
+        notify_change(event, customer)
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class DuplicateEmailError(DataValidationError):
+    """ Used when a Customer with the same email already exists """
+
+
 class Customer(db.Model):
     """
     Class that represents a Customer
     """
 
     app = None
+    group_committer = None
+    shards = None
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
@@ -42,6 +152,15 @@ class Customer(db.Model):
         Enum(enums.CustomerStatus, name='customer_status', values_callable=lambda obj: [e.value for e in obj]),
         default=enums.CustomerStatus.ACTIVE,
         nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        # Case-insensitive email lookups probe this index instead of scanning
+        db.Index("ix_customer_email_lower", db.func.lower(email)),
+        # The change feed walks customers in (updated_at, id) order
+        db.Index("ix_customer_updated_at_id", updated_at, id),
+    )
 
     def __repr__(self):
         return f"<Customer {self.email} id=[{self.id}]>"
@@ -50,28 +169,141 @@ class Customer(db.Model):
         """
         Creates a Customer to the database
         """
+        if Customer.group_committer is not None and PENDING_CHANGES_KEY not in db.session.info:
+            logger.info("Queueing Customer for group commit: %s", self.email)
+            Customer.group_committer.submit(self)
+            return
+
+        # each shard only enforces unique emails on its own rows
+        if Customer.shards is not None and Customer.email_exists(self.email):
+            raise DuplicateEmailError(f"Customer with email '{self.email}' already exists")
 
+        self.id = Customer._new_id()  # pylint: disable=invalid-name
+        session = Customer._session_for(self.id)
         try:
             logger.info("Creating Customer: %s", self.email)
-            self.id = None  # pylint: disable=invalid-name
-            db.session.add(self)
+            self.created_at = self.updated_at = datetime.utcnow()
+            # add to the email filter first so no lookup can miss the new row
+            email_filter.add(self.email)
+            session.add(self)
+            commit_change(session, "create", self)
+        except SQLAlchemyError as sql_error:
+            session.rollback()
+            raise sql_error
+
+    @classmethod
+    def create_many(cls, customers: list) -> list:
+        """
+        Creates several Customers in one transaction
+
+        Returns one entry per customer: None if it was created, or the
+        SQLAlchemyError that stopped it. If the batch fails as a whole,
+        each customer is retried in its own transaction so a bad row
+        only fails itself. The customers come back detached with their
+        attributes loaded, so they can be read from any thread.
+        """
+        logger.info("Creating %d Customers in one transaction", len(customers))
+        try:
+            for customer in customers:
+                customer.id = None
+                customer.created_at = customer.updated_at = datetime.utcnow()
+                email_filter.add(customer.email)
+                db.session.add(customer)
+            db.session.flush()
+            for customer in customers:
+                db.session.expunge(customer)
             db.session.commit()
         except SQLAlchemyError as sql_error:
+            logger.warning("Group commit failed, creating Customers one by one: %s", sql_error)
             db.session.rollback()
-            raise sql_error
+            return [cls._create_detached(customer) for customer in customers]
+        for customer in customers:
+            notify_change("create", customer)
+        return [None] * len(customers)
+
+    @staticmethod
+    def _create_detached(customer) -> SQLAlchemyError:
+        """Creates one Customer in its own transaction and detaches it"""
+        try:
+            make_transient(customer)
+            customer.id = None
+            customer.created_at = customer.updated_at = datetime.utcnow()
+            db.session.add(customer)
+            db.session.flush()
+            db.session.expunge(customer)
+            db.session.commit()
+        except SQLAlchemyError as sql_error:
+            db.session.rollback()
+            return sql_error
+        notify_change("create", customer)
+        return None
 
-    def update(self):
+    def update(self, event: str = "update"):
         """
         Updates a Customer to the database
+
+        Args:
+            event (string): the change event reported to the change listeners
         """
         logger.info("Saving Customer: %s", self.email)
-        db.session.commit()
+        session = self._session()
+        # each shard only enforces unique emails on its own rows
+        if Customer.shards is not None and inspect(self).attrs.email.history.has_changes() and Customer.email_exists(
+            self.email, exclude_id=self.id
+        ):
+            raise DuplicateEmailError(f"Customer with email '{self.email}' already exists")
+        self.updated_at = datetime.utcnow()
+        email_filter.add(self.email)
+        commit_change(session, event, self)
 
     def delete(self):
         """ Removes a Customer from the data store """
         logger.info("Deleting Customer: %s", self.email)
-        db.session.delete(self)
-        db.session.commit()
+        session = self._session()
+        session.delete(self)
+        # leave a tombstone so the change feed can report the delete
+        session.add(CustomerTombstone(customer_id=self.id, deleted_at=datetime.utcnow()))
+        email_filter.discard(self.email)
+        commit_change(session, "delete", self)
+
+    def _session(self):
+        """Returns the session that holds this Customer, attaching it if it is detached"""
+        session = object_session(self)
+        if session is None:
+            session = Customer._session_for(self.id)
+            session.add(self)
+        return session
+
+    @classmethod
+    def _session_for(cls, customer_id):
+        """Returns the session of the database that holds a Customer id"""
+        if cls.shards is None:
+            return db.session
+        return cls.shards.session_for(customer_id)
+
+    @classmethod
+    def _new_id(cls):
+        """Returns the id of a new Customer, or None to let the database number it"""
+        if cls.shards is None:
+            return None
+        return cls.shards.allocate_id()
+
+    @classmethod
+    def _find_all(cls, *criteria) -> list:
+        """Returns the Customers matching criteria, from every shard in parallel when sharded"""
+        return cls._query_all(lambda session: session.query(cls).filter(*criteria))
+
+    @classmethod
+    def _query_all(cls, build) -> list:
+        """Returns the Customers of the query build(session) makes for each database"""
+        if cls.shards is None:
+            return build(db.session).all()
+        customers = {}
+        for results in cls.shards.scatter(lambda session: build(session).all()):
+            for customer in results:
+                # a customer being rebalanced can briefly be on two shards
+                customers.setdefault(customer.id, customer)
+        return [customers[customer_id] for customer_id in sorted(customers)]
 
     def serialize(self):
         """ Serializes a Customer into a dictionary """
@@ -81,7 +313,9 @@ class Customer(db.Model):
             "last_name": self.last_name,
             "email": self.email,
             "password": self.password,
-            "status": str(self.status)
+            "status": str(self.status),
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
     def deserialize(self, data):
@@ -90,24 +324,21 @@ class Customer(db.Model):
 
         Args:
             data (dict): A dictionary containing the resource data
+
+        Raises:
+            DataValidationError: listing every problem with the data
         """
-        try:
-            self.id = (data["id"] if "id" in data else None)
-            self.first_name = data["first_name"]
-            self.last_name = data["last_name"]
-            self.email = data["email"]
-            self.password = data["password"]
+        errors = customer_schema.validate(data)
+        if errors:
+            raise DataValidationError("Invalid Customer: " + "; ".join(errors))
+        self.id = data.get("id")
+        self.first_name = data["first_name"]
+        self.last_name = data["last_name"]
+        self.email = data["email"]
+        self.password = data["password"]
+        # a missing status keeps the current one, or the column default
+        if data.get("status") is not None:
             self.status = enums.CustomerStatus.from_string(data["status"])
-
-        except KeyError as error:
-            raise DataValidationError(
-                "Invalid Customer: missing " + error.args[0]
-            ) from error
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Customer: body of request contained bad or no data - "
-                "Error message: " + error
-            ) from error
         return self
 
     @classmethod
@@ -119,26 +350,127 @@ class Customer(db.Model):
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        cls.init_shards(app, parse_shard_uris(app.config.get("SHARD_DATABASE_URIS")))
+        email_filter.configure(app.config)
+        if email_filter.enabled:
+            cls.rebuild_email_filter()
+            if not email_filter.single_process and not app.config.get("SSE_PG_NOTIFY", False):
+                logger.warning("The email filter needs SSE_PG_NOTIFY to see other workers: lookups will query the database")
+        cls.group_committer = None
+        if app.config.get("GROUP_COMMIT_ENABLED", False) and cls.shards is not None:
+            logger.warning("Group commit is not supported with sharding and was disabled")
+        elif app.config.get("GROUP_COMMIT_ENABLED", False):
+            cls.group_committer = GroupCommitter(
+                cls.create_many,
+                app.config.get("GROUP_COMMIT_MAX_BATCH", 32),
+                app.config.get("GROUP_COMMIT_MAX_WAIT_MS", 2) / 1000,
+            )
+
+    @classmethod
+    def init_shards(cls, app, uris: list):
+        """Spreads Customers over the databases in uris, or keeps them in db if it is empty
+
+        Ids are allocated from the main database, starting after the
+        highest id already in any shard.
+        """
+        if cls.shards is not None:
+            cls.shards.dispose()
+            cls.shards = None
+        if not uris:
+            return
+        logger.info("Sharding Customers across %d databases", len(uris))
+        router = ShardRouter.from_uris(uris, app.config.get("SQLALCHEMY_ENGINE_OPTIONS"), db.session.registry.scopefunc)
+        router.create_all([cls.__table__, CustomerTombstone.__table__])
+        sharding.metadata.create_all(db.engine)
+        router.allocator = IdAllocator(
+            db.engine,
+            cls.__tablename__,
+            app.config.get("SHARD_ID_BLOCK_SIZE", 100),
+            start=lambda: max_id(router, cls.__table__) + 1,
+        )
+        if _remove_shard_sessions not in app.teardown_appcontext_funcs:
+            app.teardown_appcontext(_remove_shard_sessions)
+        cls.shards = router
+
+    @classmethod
+    def rebuild_email_filter(cls):
+        """ Rebuilds the email Bloom filter from a streamed scan of the table """
+        logger.info("Rebuilding email filter")
+        sessions = customer_sessions()
+        expected = sum(session.query(db.func.count(cls.id)).scalar() for session in sessions)
+        emails = itertools.chain.from_iterable(
+            session.execute(db.select(cls.email).execution_options(yield_per=1000)).scalars()
+            for session in sessions
+        )
+        email_filter.rebuild(emails, expected)
+        for session in sessions:
+            session.commit()
+
+    @classmethod
+    def email_exists(cls, email: str, exclude_id: int = None) -> bool:
+        """ Returns True if a Customer, other than the one with exclude_id, already has this email """
+        if email_filter.definitely_absent(email):
+            return False
+        criteria = [cls.email == email]
+        if exclude_id is not None:
+            criteria.append(cls.id != exclude_id)
+        if cls.shards is not None:
+            return any(cls.shards.scatter(
+                lambda session: session.query(session.query(cls).filter(*criteria).exists()).scalar()
+            ))
+        return db.session.query(cls.query.filter(*criteria).exists()).scalar()
 
     @classmethod
     def all(cls):
         """ Returns all of the Customers in the database """
         logger.info("Processing all Customers")
-        return cls.query.all()
+        return cls._find_all()
 
     @classmethod
     def find(cls, by_id):
         """ Finds a Customer by it's ID """
         logger.info("Processing lookup for id %s ...", by_id)
+        if cls.shards is not None:
+            return cls.shards.session_for(by_id).get(cls, by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def find_many(cls, ids: list) -> dict:
+        """Returns the Customers with the given ids, keyed by id, in one query per database
+
+        Args:
+            ids (list): the ids of the Customers you want; missing ids are left out
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        if not ids:
+            return {}
+
+        def build(session):
+            # each shard may be a different kind of database
+            dialect = session.get_bind(mapper=cls.__mapper__).dialect
+            return session.query(cls).filter(cls._ids_criterion(ids, dialect))
+        return {customer.id: customer for customer in cls._query_all(build)}
+
+    @classmethod
+    def _ids_criterion(cls, ids: list, dialect):
+        """Returns the criterion that matches the ids on a database of the dialect"""
+        if dialect.name == "postgresql":
+            # WHERE id = ANY(:ids) has the same text and plan for any number of ids
+            return cls.id == any_(bindparam("ids", ids, type_=ARRAY(db.Integer)))
+        return cls.id.in_(ids)
+
     @classmethod
     def find_or_404(cls, by_id: int):
         """Finds a Customer by it's id
         :return: an instance with the by_id, or 404_NOT_FOUND if not found
         """
         logger.info("Processing lookup or 404 for id %s ...", by_id)
-        return cls.query.get_or_404(by_id)
+        if cls.shards is None:
+            return cls.query.get_or_404(by_id)
+        customer = cls.find(by_id)
+        if customer is None:
+            abort(404)
+        return customer
 
     @classmethod
     def find_by_email(cls, email):
@@ -148,7 +480,80 @@ class Customer(db.Model):
             name (string): the name of the Customers you want to match
         """
         logger.info("Processing email query for %s ...", email)
-        return cls.query.filter(cls.email == email).all()
+        if email_filter.needs_rebuild():
+            email_filter.rebuild_in_background(cls._rebuild_email_filter_in_app)
+        if email_filter.definitely_absent(email):
+            return []
+        return cls._find_all(cls.email == email)
+
+    @classmethod
+    def find_one_by_email(cls, email: str):
+        """Returns the Customer with the given email, ignoring case, or None
+
+        Args:
+            email (string): the email of the Customer you want to find
+        """
+        logger.info("Processing single email lookup for %s ...", email)
+        if email_filter.definitely_absent(email):
+            return None
+        if cls.shards is not None:
+            matches = cls._find_all(db.func.lower(cls.email) == email.strip().lower())
+            # prefer an exact match if addresses only differ by case
+            return min(matches, key=lambda customer: customer.email != email, default=None)
+        return (
+            cls.query.filter(db.func.lower(cls.email) == email.strip().lower())
+            # prefer an exact match if addresses only differ by case
+            .order_by(cls.email != email)
+            .first()
+        )
+
+    @classmethod
+    def changes_since(cls, cursor, limit: int, settle: float = 0):
+        """Returns the customers and tombstones changed after a cursor
+
+        Args:
+            cursor (tuple): (timestamp, id) of the last change already seen, or None
+            limit (int): the most changes to return
+            settle (float): seconds to hold back the newest changes so that
+                transactions stamped earlier but committed later are not skipped
+
+        Returns:
+            a list of (timestamp, id, Customer or CustomerTombstone) ordered by
+            timestamp then id
+        """
+        logger.info("Processing change feed query after %s ...", cursor)
+        until = datetime.utcnow() - timedelta(seconds=settle)
+
+        def query_changes(session):
+            customers = session.query(cls).filter(cls.updated_at <= until)
+            tombstones = session.query(CustomerTombstone).filter(CustomerTombstone.deleted_at <= until)
+            if cursor:
+                timestamp, last_id = cursor
+                customers = customers.filter(
+                    db.or_(cls.updated_at > timestamp, db.and_(cls.updated_at == timestamp, cls.id > last_id))
+                )
+                tombstones = tombstones.filter(
+                    db.or_(
+                        CustomerTombstone.deleted_at > timestamp,
+                        db.and_(CustomerTombstone.deleted_at == timestamp, CustomerTombstone.customer_id > last_id),
+                    )
+                )
+            return [
+                (customer.updated_at, customer.id, customer)
+                for customer in customers.order_by(cls.updated_at, cls.id).limit(limit)
+            ] + [
+                (tombstone.deleted_at, tombstone.customer_id, tombstone)
+                for tombstone in tombstones.order_by(
+                    CustomerTombstone.deleted_at, CustomerTombstone.customer_id
+                ).limit(limit)
+            ]
+
+        if cls.shards is None:
+            changes = query_changes(db.session)
+        else:
+            changes = list(itertools.chain.from_iterable(cls.shards.scatter(query_changes)))
+        changes.sort(key=lambda change: change[:2])
+        return changes[:limit]
 
     @classmethod
     def set_status(cls, customer_id: int, status: enums.CustomerStatus) -> "Customer":
@@ -163,7 +568,7 @@ class Customer(db.Model):
             raise NoResultFound(f"Customer with id '{customer_id}' was not found.")
 
         customer.status = status
-        customer.update()
+        customer.update("suspend" if status == enums.CustomerStatus.SUSPENDED else "activate")
         return customer
 
     @classmethod
@@ -182,6 +587,15 @@ class Customer(db.Model):
         """
         return cls.set_status(customer_id, enums.CustomerStatus.ACTIVE)
 
+    @classmethod
+    def _rebuild_email_filter_in_app(cls):
+        """ Rebuilds the email filter from a background thread """
+        with cls.app.app_context():
+            try:
+                cls.rebuild_email_filter()
+            finally:
+                db.session.remove()
+
     @classmethod
     def find_by_first_name(cls, first_name):
         """Returns all Customers with the given first name
@@ -189,4 +603,94 @@ class Customer(db.Model):
             name (string): the name of the Customers you want to match
         """
         logger.info("Processing first name query for %s ...", first_name)
-        return cls.query.filter(cls.first_name == first_name).all()
+        return cls._find_all(cls.first_name == first_name)
+
+
+# Checks Customer payloads against the columns; the server sets the id and timestamps
+customer_schema = compile_schema(Customer.__table__, exclude=("id", "created_at", "updated_at"))
+
+
+class CustomerTombstone(db.Model):
+    """
+    Class that records the deletion of a Customer for the change feed
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index("ix_customer_tombstone_deleted_at_id", deleted_at, customer_id),)
+
+    def __repr__(self):
+        return f"<CustomerTombstone customer_id=[{self.customer_id}]>"
+
+    def serialize(self):
+        """ Serializes a CustomerTombstone into a dictionary """
+        return {"id": self.customer_id, "deleted_at": self.deleted_at.isoformat()}
+
+    @classmethod
+    def purge_older_than(cls, cutoff: datetime) -> int:
+        """Deletes tombstones from before cutoff and returns how many were removed"""
+        logger.info("Purging tombstones older than %s", cutoff)
+        count = 0
+        for session in customer_sessions():
+            count += session.query(cls).filter(cls.deleted_at < cutoff).delete()
+            session.commit()
+        return count
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored response of an idempotent request
+
+    Retries that carry the same Idempotency-Key header are answered from
+    this record instead of being executed again.
+    """
+
+    # Table Schema
+    key = db.Column(db.String(constants.IDEMPOTENCY_KEY_MAX_LEN), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.SmallInteger, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    location = db.Column(db.String(constants.LOCATION_MAX_LEN))
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} status=[{self.status_code}]>"
+
+    def create(self, ttl: int):
+        """
+        Saves the response to the database for ttl seconds, replacing an
+        expired response for the same key that has not been purged yet
+        """
+        logger.info("Storing response for Idempotency-Key: %s", self.key)
+        now = datetime.utcnow()
+        self.expires_at = now + timedelta(seconds=ttl)
+        try:
+            # an unexpired response is kept, so a concurrent request with the key still fails
+            db.session.query(IdempotencyKey).filter(
+                IdempotencyKey.key == self.key, IdempotencyKey.expires_at <= now
+            ).delete()
+            db.session.add(self)
+            db.session.commit()
+        except SQLAlchemyError as sql_error:
+            db.session.rollback()
+            raise sql_error
+
+    @classmethod
+    def find(cls, key: str):
+        """Returns the unexpired stored response for a key, or None"""
+        logger.info("Processing lookup for Idempotency-Key %s ...", key)
+        record = db.session.get(cls, key)
+        if record is not None and record.expires_at <= datetime.utcnow():
+            return None
+        return record
+
+    @classmethod
+    def purge_expired(cls) -> int:
+        """Deletes every expired key and returns how many were removed"""
+        logger.info("Purging expired idempotency keys")
+        count = cls.query.filter(cls.expires_at <= datetime.utcnow()).delete()
+        db.session.commit()
+        return count
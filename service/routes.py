@@ -3,17 +3,50 @@ Customer Database Service
 
 Paths:
 ------
+GET /readyz - Returns 503 when the database is unreachable or this worker is overloaded
+GET /metrics - Returns the worker metrics in the Prometheus text format
+GET /diagnostics/slow-queries - Returns the slowest statement shapes by total time
+GET /diagnostics/profile - Returns the rolling profile of this worker as folded stacks
+GET /diagnostics/profiles/{id} - Returns a stored single request profile
+GET /diagnostics/memory - Returns RSS, GC and identity map statistics for this worker
+POST /diagnostics/memory/snapshots - Takes a tracemalloc snapshot and diffs it with the last one
+DELETE /diagnostics/memory/snapshots - Stops tracemalloc
+GET /diagnostics/email-filter - Returns the size and accuracy of the email Bloom filter
 GET /customers - Returns a list all of the Customers
+GET /customers?ids={id},{id},... - Returns the Customers with the given ids, in order, and the missing ids
+GET /customers/changes?since={cursor} - Returns the Customers changed or deleted after a cursor
+GET /customers/events - Streams Customer changes as Server-Sent Events
+GET /customers/stats - Returns the number of Customers by status and by email domain
 GET /customers/{id} - Returns the Customer with a given id number
-POST /customers - creates a new Customer record in the database
+GET /customers/by-email/{email} - Returns the Customer with a given email, ignoring case
+POST /customers - creates a new Customer record in the database (honors Idempotency-Key)
 PUT /customers/{id} - updates a Customer record in the database
 DELETE /customers/{id} - deletes a Customer record in the database
+POST /batch - runs several Customer operations in one request, optionally in one transaction
 """
 
-from flask import jsonify, request, url_for, abort
+import hashlib
+import json
+from datetime import datetime
+from flask import Response, jsonify, request, url_for, abort
 from sqlalchemy.exc import NoResultFound, SQLAlchemyError
-from service.common import status
-from service.models import Customer
+from werkzeug.exceptions import HTTPException, InternalServerError, ServiceUnavailable
+from werkzeug.test import EnvironBuilder
+from service.common import constants, status
+from service.common.auth import has_admin_token, is_admin_token_configured
+from service.common import media, profiling
+from service.common.memory import memory_stats, memory_tracer
+from service.common.metrics import registry
+from service.common.rate_limit import check_rate_limit
+from service.common.query_cache import list_cache_key, query_cache
+from service.common.readiness import concurrency_limiter, readiness_probe
+from service.common.single_flight import single_flight
+from service.common.slow_queries import slow_query_log
+from service.common.stats import customer_stats
+from service.models import (
+    Customer, CustomerTombstone, DuplicateEmailError, IdempotencyKey, customer_sessions, db, email_filter, in_transaction,
+    transaction
+)
 
 # Import Flask application
 from . import app
@@ -39,6 +72,109 @@ def healthcheck():
     """Let them know our heart is still beating"""
     return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
 
+
+######################################################################
+# GET READINESS
+######################################################################
+
+
+@app.route("/readyz")
+def readiness():
+    """Tells the load balancer whether this worker can take more requests"""
+    result = readiness_probe.check(concurrency_limiter())
+    code = status.HTTP_200_OK if result["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE
+    return jsonify(status=code, **result), code
+
+######################################################################
+# GET METRICS
+######################################################################
+
+
+@app.route("/metrics")
+def metrics():
+    """Returns this worker's metrics in the Prometheus text format"""
+    return Response(registry.render(), status=status.HTTP_200_OK, mimetype="text/plain")
+
+
+######################################################################
+# GET SLOW QUERIES
+######################################################################
+
+
+@app.route("/diagnostics/slow-queries", methods=["GET"])
+def list_slow_queries():
+    """Returns this worker's slowest statement shapes ordered by total time"""
+    check_admin_token()
+    limit = request.args.get("limit", 10, type=int)
+    return jsonify(slow_query_log.top(limit)), status.HTTP_200_OK
+
+
+######################################################################
+# GET PROFILES
+######################################################################
+
+
+@app.route("/diagnostics/profile", methods=["GET"])
+def get_rolling_profile():
+    """Returns the rolling sampling profile of this worker as folded stacks"""
+    check_admin_token()
+    if profiling.rolling_profiler is None:
+        abort(status.HTTP_404_NOT_FOUND, "The rolling profiler is not enabled.")
+    return Response(profiling.rolling_profiler.dump(), status=status.HTTP_200_OK, mimetype="text/plain")
+
+
+@app.route("/diagnostics/profiles/<profile_id>", methods=["GET"])
+def get_request_profile(profile_id):
+    """Returns a profile captured for a single request"""
+    check_admin_token()
+    profile = profiling.profile_store.get(profile_id)
+    if profile is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Profile with id '{profile_id}' was not found.")
+    return Response(profile, status=status.HTTP_200_OK, mimetype="text/plain")
+
+
+######################################################################
+# MEMORY DIAGNOSTICS
+######################################################################
+
+
+@app.route("/diagnostics/memory", methods=["GET"])
+def get_memory_stats():
+    """Returns RSS, garbage collector and identity map statistics for this worker"""
+    check_admin_token()
+    return jsonify(memory_stats(db.session)), status.HTTP_200_OK
+
+
+@app.route("/diagnostics/memory/snapshots", methods=["POST"])
+def take_memory_snapshot():
+    """Takes a tracemalloc snapshot and reports the growth since the last one"""
+    check_admin_token()
+    limit = request.args.get("limit", 20, type=int)
+    frames = request.args.get("frames", 1, type=int)
+    app.logger.info("Taking memory snapshot")
+    return jsonify(memory_tracer.snapshot(limit, frames)), status.HTTP_201_CREATED
+
+
+@app.route("/diagnostics/memory/snapshots", methods=["DELETE"])
+def stop_memory_tracing():
+    """Stops tracemalloc and discards the snapshots"""
+    check_admin_token()
+    memory_tracer.stop()
+    return "", status.HTTP_204_NO_CONTENT
+
+
+######################################################################
+# GET EMAIL FILTER STATS
+######################################################################
+
+
+@app.route("/diagnostics/email-filter", methods=["GET"])
+def get_email_filter_stats():
+    """Returns the size and accuracy of this worker's email Bloom filter"""
+    check_admin_token()
+    return jsonify(email_filter.stats()), status.HTTP_200_OK
+
+
 ######################################################################
 # GET A LIST OF CUSTOMERS
 ######################################################################
@@ -48,18 +184,46 @@ def healthcheck():
 def list_customers():
     """Returns all of the Customers"""
     app.logger.info("Request for customer list")
-    customers = []
+    if "ids" in request.args:
+        return list_customers_by_id(parse_id_list(request.args["ids"]))
+    # the cache does not know about the uncommitted changes of an atomic batch
+    key = None if in_transaction() else list_cache_key(request.args)
+    if key is not None:
+        key += (media.response_type(),)
+        cached = query_cache.get(key)
+        if cached is not None:
+            return Response(cached, status=status.HTTP_200_OK, mimetype=key[-1], headers={"X-Cache": "HIT", "Vary": "Accept"})
+    generation = query_cache.generation
     email = request.args.get("email")
     first_name = request.args.get("first_name")
+    results = single_flight.do(flight_key("list", email, first_name), lambda: find_customer_list(email, first_name))
+    app.logger.info("Returning %d customers", len(results))
+    response = media.respond(results, status.HTTP_200_OK)
+    if key is not None and query_cache.enabled:
+        body = response.get_data()
+        query_cache.put(key, generation, body, len(body))
+        response.headers["X-Cache"] = "MISS"
+    return response
+
+
+def find_customer_list(email: str, first_name: str) -> list:
+    """Returns the serialized Customers that match the list filters"""
     if email:
         customers = Customer.find_by_email(email)
     elif first_name:
         customers = Customer.find_by_first_name(first_name)
     else:
         customers = Customer.all()
-    results = [customer.serialize() for customer in customers]
-    app.logger.info("Returning %d customers", len(results))
-    return jsonify(results), status.HTTP_200_OK
+    return [customer.serialize() for customer in customers]
+
+
+def list_customers_by_id(ids: list):
+    """Returns the Customers with the given ids in the order asked for, and the ids not found"""
+    found = Customer.find_many(ids)
+    results = [found[customer_id].serialize() for customer_id in ids if customer_id in found]
+    missing = [customer_id for customer_id in ids if customer_id not in found]
+    app.logger.info("Returning %d customers, %d missing", len(results), len(missing))
+    return media.respond({"customers": results, "missing": missing}, status.HTTP_200_OK)
 
 ######################################################################
 # GET A CUSTOMER
@@ -73,13 +237,115 @@ def get_customers(customer_id):
     This endpoint will return a Customer based on it's id
     """
     app.logger.info("Request for customer with id: %s", customer_id)
-    customer = Customer.find(customer_id)
-    if not customer:
+    data = single_flight.do(flight_key("get", customer_id), lambda: serialize_customer(Customer.find(customer_id)))
+    if not data:
         abort(status.HTTP_404_NOT_FOUND, f"Customer with id '{customer_id}' was not found.")
 
-    app.logger.info("Returning customer: %s", customer.first_name)
+    app.logger.info("Returning customer: %s", data["first_name"])
+    return media.respond(data, status.HTTP_200_OK)
+
+
+def serialize_customer(customer):
+    """Returns the serialized Customer, or None if there is none"""
+    return customer.serialize() if customer else None
+
+
+def flight_key(*key):
+    """Returns the key that concurrent identical reads share, or None outside of autocommit requests"""
+    # an atomic batch reads its own uncommitted changes and must not share them
+    return None if in_transaction() else (*key, query_cache.generation)
+
+######################################################################
+# GET THE CUSTOMER CHANGE FEED
+######################################################################
+
+
+@app.route("/customers/changes", methods=["GET"])
+def list_customer_changes():
+    """
+    Returns the Customers created, updated or deleted after a cursor
+    Pass the returned next_cursor as ?since= to continue from where a sync left off
+    """
+    since = request.args.get("since")
+    app.logger.info("Request for customer changes since %s", since)
+    cursor = parse_change_cursor(since) if since else None
+    limit = min(max(request.args.get("limit", 100, type=int), 1), constants.CHANGE_FEED_MAX_LIMIT)
+
+    changes = Customer.changes_since(cursor, limit, app.config.get("CHANGE_FEED_SETTLE_SECONDS", 1))
+    results = [
+        {"type": "delete", **change.serialize()} if isinstance(change, CustomerTombstone)
+        else {"type": "upsert", **change.serialize()}
+        for _, _, change in changes
+    ]
+    next_cursor = format_change_cursor(*changes[-1][:2]) if changes else since
+    app.logger.info("Returning %d changes", len(results))
+    return (
+        jsonify(changes=results, next_cursor=next_cursor, has_more=len(changes) == limit),
+        status.HTTP_200_OK,
+    )
+
+
+######################################################################
+# GET CUSTOMER STATISTICS
+######################################################################
+
+
+@app.route("/customers/stats", methods=["GET"])
+def get_customer_stats():
+    """
+    Returns the number of Customers by status and by email domain
+    Only the ?domains= most common domains are listed (default 20)
+    """
+    app.logger.info("Request for customer statistics")
+    top_domains = min(max(request.args.get("domains", 20, type=int), 0), constants.STATS_MAX_DOMAINS)
+    customer_stats.refresh(app)
+    return jsonify(customer_stats.snapshot(top_domains)), status.HTTP_200_OK
+
+
+######################################################################
+# STREAM CUSTOMER EVENTS
+######################################################################
+
+
+@app.route("/customers/events", methods=["GET"])
+def stream_customer_events():
+    """
+    Streams Customer changes as Server-Sent Events
+    Optional filters: ?events=suspend,activate and ?id=<customer id>
+    """
+    event_types = [name for name in request.args.get("events", "").split(",") if name]
+    customer_id = request.args.get("id", type=int)
+    broker = app.extensions["event_broker"]
+    subscriber = broker.subscribe(event_types, customer_id)
+    if subscriber is None:
+        raise ServiceUnavailable("Too many event stream clients on this worker", retry_after=5)
+    app.logger.info("Event stream opened for %s", event_types or "all events")
+    return Response(
+        broker.stream(subscriber, app.config.get("SSE_KEEPALIVE_SECONDS", 15)),
+        status=status.HTTP_200_OK,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+######################################################################
+# GET A CUSTOMER BY EMAIL
+######################################################################
+
+
+@app.route("/customers/by-email/<email>", methods=["GET"])
+def get_customer_by_email(email):
+    """
+    Retrieve a single customer by email
+    This endpoint will return the Customer whose email matches, ignoring case
+    """
+    app.logger.info("Request for customer with email: %s", email)
+    customer = Customer.find_one_by_email(email)
+    if not customer:
+        abort(status.HTTP_404_NOT_FOUND, f"Customer with email '{email}' was not found.")
     return jsonify(customer.serialize()), status.HTTP_200_OK
 
+
 ######################################################################
 # ADD A NEW CUSTOMER
 ######################################################################
@@ -92,19 +358,37 @@ def create_customers():
     This endpoint will create a Customer based the data in the body that is posted
     """
     app.logger.info("Request to create a customer")
-    check_content_type("application/json")
+    check_content_type(*media.request_types())
+
+    # answer retries of an earlier request from its stored response
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        replay = replay_idempotent_response(idempotency_key)
+        if replay:
+            return replay
 
     # initialize an empty Customer record
     customer = Customer()
 
-    # deserialize the request JSON into the newly created record
-    customer.deserialize(request.get_json())
+    # deserialize the request JSON or MessagePack into the newly created record
+    customer.deserialize(media.get_body())
+
+    # a trusted email filter clears most new emails without a query
+    if email_filter.authoritative() and Customer.email_exists(customer.email):
+        raise DuplicateEmailError(f"Customer with email '{customer.email}' already exists")
 
     try:
         # add the customer record to the database
         customer.create()
     except SQLAlchemyError as sql_error:
-        app.logger.error(f'Failed to create customer: {str(sql_error)}')
+        # a concurrent request with the same key may have won the race
+        replay = idempotency_key and replay_idempotent_response(idempotency_key)
+        if replay:
+            return replay
+        # report a taken email the same way whether or not the filter caught it
+        if Customer.email_exists(customer.email):
+            raise DuplicateEmailError(f"Customer with email '{customer.email}' already exists") from sql_error
+        app.logger.error("Failed to create customer: %s", sql_error)
         abort(
             status.HTTP_400_BAD_REQUEST,
             'Failed to create customer'
@@ -115,11 +399,9 @@ def create_customers():
     location_url = url_for("get_customers", customer_id=customer.id, _external=True)
 
     app.logger.info("Customer with ID [%s] created.", customer.id)
-    return (
-        jsonify(message),
-        status.HTTP_201_CREATED,
-        {"location": location_url}
-    )
+    if idempotency_key:
+        store_idempotent_response(idempotency_key, status.HTTP_201_CREATED, message, location_url)
+    return media.respond(message, status.HTTP_201_CREATED, {"location": location_url})
 
 ######################################################################
 # UPDATE A CUSTOMER
@@ -141,7 +423,7 @@ def update_customer(customer_id):
     """
 
     app.logger.info("Request to update Customer with id: %s", customer_id)
-    check_content_type('application/json')
+    check_content_type(*media.request_types())
 
     customer = Customer.find(customer_id)
     if not customer:
@@ -150,17 +432,14 @@ def update_customer(customer_id):
             f'Customer with id {customer_id} does not exist'
         )
 
-    customer.deserialize(request.get_json())
+    customer.deserialize(media.get_body())
 
     customer.id = customer_id
 
     customer.update()
 
-    app.logger.info(f'Customer with id {customer_id} updated')
-    return (
-        jsonify(customer.serialize()),
-        status.HTTP_200_OK
-    )
+    app.logger.info("Customer with id %s updated", customer_id)
+    return media.respond(customer.serialize(), status.HTTP_200_OK)
 
 ######################################################################
 # DELETE A CUSTOMER
@@ -199,13 +478,13 @@ def suspend_customer(customer_id):
         customer: Customer = Customer.suspend(customer_id)
     except NoResultFound:
         # if no customer is found, return a 404
-        app.logger.error(f'Customer with id {customer_id} does not exist')
+        app.logger.error("Customer with id %s does not exist", customer_id)
         abort(
             status.HTTP_404_NOT_FOUND,
             f'Customer with id {customer_id} does not exist'
         )
 
-    app.logger.info(f"Customer with id [{customer_id}] suspend complete.")
+    app.logger.info("Customer with id [%s] suspend complete.", customer_id)
     return (
         jsonify(customer.serialize()),
         status.HTTP_200_OK
@@ -229,37 +508,240 @@ def activate_customer(customer_id):
         customer: Customer = Customer.activate(customer_id)
     except NoResultFound:
         # if no customer is found, return a 404
-        app.logger.error(f'Customer with id {customer_id} does not exist')
+        app.logger.error("Customer with id %s does not exist", customer_id)
         abort(
             status.HTTP_404_NOT_FOUND,
             f'Customer with id {customer_id} does not exist'
         )
 
-    app.logger.info(f"Customer with id [{customer_id}] activated.")
+    app.logger.info("Customer with id [%s] activated.", customer_id)
     return (
         jsonify(customer.serialize()),
         status.HTTP_200_OK
     )
 
+
+######################################################################
+# RUN A BATCH OF OPERATIONS
+######################################################################
+
+# The endpoints a batch operation may call
+BATCH_ENDPOINTS = {
+    "get_customers",
+    "create_customers",
+    "update_customer",
+    "delete_customers",
+    "suspend_customer",
+    "activate_customer",
+}
+
+
+class BatchFailed(Exception):
+    """Raised to roll back an atomic batch when one of its operations fails"""
+
+
+@app.route("/batch", methods=["POST"])
+def run_batch():
+    """
+    Runs a list of Customer operations in order and returns the result of each
+    Each operation is {"method": "PUT", "path": "/customers/1/suspend", "body": {...}}.
+    With "atomic": true (the default) they share one transaction that is only
+    committed if every operation succeeds; the operations after a failure
+    are skipped with 424 Failed Dependency. With "atomic": false each one
+    commits on its own.
+    An Idempotency-Key applies to the whole batch; the operations cannot carry headers.
+    """
+    check_content_type("application/json")
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        replay = replay_idempotent_response(idempotency_key)
+        if replay:
+            return replay
+    data = request.get_json()
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not 0 < len(operations) <= constants.BATCH_MAX_OPERATIONS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"operations must be a list of 1 to {constants.BATCH_MAX_OPERATIONS} operations",
+        )
+    atomic = data.get("atomic", True)
+    app.logger.info("Request to run a batch of %d operations (atomic=%s)", len(operations), atomic)
+
+    if not atomic:
+        results = [run_batch_operation(operation) for operation in operations]
+        return batch_response(idempotency_key, {"atomic": False, "results": results})
+
+    results = []
+    try:
+        with transaction():
+            for operation in operations:
+                results.append(run_batch_operation(operation))
+                if results[-1]["status"] >= 400:
+                    raise BatchFailed()
+        committed = True
+    except BatchFailed:
+        committed = False
+        skipped = {"status": status.HTTP_424_FAILED_DEPENDENCY, "body": None}
+        results += [skipped] * (len(operations) - len(results))
+    app.logger.info("Batch of %d operations %s", len(operations), "committed" if committed else "rolled back")
+    return batch_response(idempotency_key, {"atomic": True, "committed": committed, "results": results})
+
+
+def batch_response(idempotency_key: str, payload: dict):
+    """Returns the batch results, stored first for retries with the same Idempotency-Key"""
+    if idempotency_key:
+        store_idempotent_response(idempotency_key, status.HTTP_200_OK, payload)
+    return jsonify(payload), status.HTTP_200_OK
+
+
+def run_batch_operation(operation) -> dict:
+    """Runs one batch operation through its route and returns its status, body and location
+
+    The operation does not go through the before_request hooks: it is rate
+    limited like a request of its own, but it runs in the concurrency slot of
+    the batch and its SQL and profile are counted with the batch.
+    """
+    if not isinstance(operation, dict) or not isinstance(operation.get("path"), str):
+        return {"status": status.HTTP_400_BAD_REQUEST, "body": {"message": "Operation must have a path"}}
+    environ = EnvironBuilder(
+        path=operation["path"],
+        method=str(operation.get("method", "GET")).upper(),
+        json=operation.get("body"),
+        base_url=request.host_url,
+        environ_base={"REMOTE_ADDR": request.remote_addr},
+    ).get_environ()
+    # the operation reuses this request's app context, and so its database session
+    with app.request_context(environ):
+        try:
+            if request.routing_exception is not None:
+                raise request.routing_exception
+            if request.endpoint not in BATCH_ENDPOINTS:
+                abort(status.HTTP_400_BAD_REQUEST, f"{request.path} cannot be called in a batch")
+            check_rate_limit(request.endpoint)
+            response = app.make_response(app.view_functions[request.endpoint](**request.view_args))
+        except HTTPException as error:
+            response = app.make_response(app.handle_user_exception(error))
+        except Exception as error:  # pylint: disable=broad-except
+            response = app.make_response(batch_operation_failed(error))
+    result = {"status": response.status_code, "body": response.get_json(silent=True)}
+    if "Location" in response.headers:
+        result["location"] = response.headers["Location"]
+    return result
+
+
+def batch_operation_failed(error: Exception):
+    """Answers an operation that failed unexpectedly, keeping the rest of the batch"""
+    try:
+        # errors with a handler of their own, e.g. DataValidationError, answer as usual
+        return app.handle_user_exception(error)
+    except Exception:  # pylint: disable=broad-except
+        app.logger.exception("Batch operation %s %s failed", request.method, request.path)
+    # an atomic batch rolls back as a whole; otherwise only undo this operation
+    if not in_transaction():
+        for session in customer_sessions():
+            session.rollback()
+    return app.handle_user_exception(InternalServerError(original_exception=error))
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 
-def check_content_type(content_type):
-    """Checks that the media type is correct"""
+def check_content_type(*content_types):
+    """Checks that the media type is one of content_types"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         abort(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
 
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {content_type}",
+        f"Content-Type must be {expected}",
+    )
+
+
+def check_admin_token():
+    """Checks that the request carries the configured admin token"""
+    if not is_admin_token_configured():
+        abort(status.HTTP_403_FORBIDDEN, "Diagnostics are disabled: no admin token is configured")
+    if not has_admin_token():
+        app.logger.warning("Invalid admin token for %s", request.path)
+        abort(status.HTTP_401_UNAUTHORIZED, "A valid X-Admin-Token header is required")
+
+
+def request_fingerprint() -> str:
+    """Returns a hash of the request body"""
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+
+def replay_idempotent_response(key: str):
+    """Returns the stored response for an Idempotency-Key, or None if there is none"""
+    if len(key) > constants.IDEMPOTENCY_KEY_MAX_LEN:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Idempotency-Key must be at most {constants.IDEMPOTENCY_KEY_MAX_LEN} characters",
+        )
+    record = IdempotencyKey.find(key)
+    if record is None:
+        return None
+    if record.fingerprint != request_fingerprint():
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"Idempotency-Key '{key}' was already used with a different request body",
+        )
+    app.logger.info("Replaying stored response for Idempotency-Key: %s", key)
+    headers = {"Idempotent-Replayed": "true"}
+    if record.location:
+        headers["location"] = record.location
+    return media.respond(json.loads(record.body), record.status_code, headers)
+
+
+def store_idempotent_response(key: str, status_code: int, body, location: str = None):
+    """Stores a response so retries with the same Idempotency-Key can replay it"""
+    record = IdempotencyKey(
+        key=key,
+        fingerprint=request_fingerprint(),
+        status_code=status_code,
+        body=json.dumps(body),
+        location=location,
     )
+    try:
+        record.create(app.config.get("IDEMPOTENCY_TTL_SECONDS", 86400))
+    except SQLAlchemyError as sql_error:
+        app.logger.warning("Could not store response for Idempotency-Key %s: %s", key, sql_error)
+
+
+def format_change_cursor(timestamp: datetime, last_id: int) -> str:
+    """Returns the change feed cursor for a change"""
+    return f"{timestamp.isoformat()}~{last_id}"
+
+
+def parse_id_list(value: str) -> list:
+    """Parses a comma separated list of customer ids, dropping repeats"""
+    try:
+        ids = list(dict.fromkeys(int(item) for item in value.split(",") if item.strip()))
+    except ValueError:
+        return abort(status.HTTP_400_BAD_REQUEST, f"Invalid customer id list: {value}")
+    if not ids or len(ids) > constants.BATCH_GET_MAX_IDS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Ask for between 1 and {constants.BATCH_GET_MAX_IDS} customer ids",
+        )
+    return ids
+
+
+def parse_change_cursor(cursor: str):
+    """Parses a change feed cursor into a (timestamp, id) tuple"""
+    try:
+        timestamp, last_id = cursor.rsplit("~", 1)
+        return datetime.fromisoformat(timestamp), int(last_id)
+    except ValueError:
+        return abort(status.HTTP_400_BAD_REQUEST, f"Invalid change feed cursor: {cursor}")
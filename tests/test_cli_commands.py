@@ -5,7 +5,7 @@ import os
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import db_create, idempotency_purge, shard_rebalance, tombstones_purge
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +21,32 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.IdempotencyKey')
+    def test_idempotency_purge(self, key_mock):
+        """It should call the idempotency-purge command"""
+        key_mock.purge_expired.return_value = 3
+        result = self.runner.invoke(idempotency_purge)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 3", result.output)
+
+    @patch('service.common.cli_commands.CustomerTombstone')
+    def test_tombstones_purge(self, tombstone_mock):
+        """It should call the tombstones-purge command"""
+        tombstone_mock.purge_older_than.return_value = 2
+        result = self.runner.invoke(tombstones_purge, ["--days", "7"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 2", result.output)
+
+    @patch('service.common.cli_commands.rebalance')
+    @patch('service.common.cli_commands.Customer')
+    def test_shard_rebalance(self, customer_mock, rebalance_mock):
+        """It should call the shard-rebalance command"""
+        customer_mock.__table__ = "customer"
+        rebalance_mock.return_value = {"customer": 4}
+        result = self.runner.invoke(shard_rebalance, ["--dry-run"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("customer: 4 rows to move", result.output)
+        customer_mock.shards = None
+        result = self.runner.invoke(shard_rebalance)
+        self.assertNotEqual(result.exit_code, 0)
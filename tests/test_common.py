@@ -3,8 +3,39 @@ Test file for common module code
 """
 
 
+import cProfile
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
 import unittest
+from types import SimpleNamespace
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from service import app
+from service.models import Customer
 from service.common.enums import CustomerStatus
+from service.common.bloom import BloomFilter, EmailFilter
+from service.common.events import EventBroker
+from service.common.group_commit import GroupCommitter
+from service.common import prepared
+from service.common.profiling import RollingProfiler, fold_profile
+from service.common.schema import compile_schema
+from service.common.slow_queries import explain
+from service.common.single_flight import FlightFailed, SingleFlight
+from service.common.sharding import jump_hash, parse_shard_uris
+from service.common.sqlite_pragmas import build_pragmas
+from service.common.query_cache import QueryCache, list_cache_key
+from service.common.readiness import ReadinessProbe, pool_status
+from service.common import rate_limit
+from service.common.rate_limit import ConcurrencyLimiter, TokenBucket, parse_limit, parse_route_limits
+from service.common.log_handlers import (
+    JsonFormatter, NonBlockingQueueHandler, RequestSamplingFilter, parse_sample_rates
+)
 
 
 class TestCommon(unittest.TestCase):
@@ -23,6 +54,445 @@ class TestCommon(unittest.TestCase):
         self.assertEqual(CustomerStatus.ACTIVE, CustomerStatus.from_string("ACTIVE"))
         self.assertEqual(CustomerStatus.SUSPENDED, CustomerStatus.from_string("SUSPENDED"))
 
+    def test_json_formatter(self):
+        """It should format a log record as JSON"""
+        record = logging.LogRecord("flask.app", logging.INFO, __file__, 1, "hello %s", ("world",), None)
+        record.endpoint = "list_customers"
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "hello world")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["endpoint"], "list_customers")
+
+    def test_parse_sample_rates(self):
+        """It should parse per endpoint sample rates"""
+        rates = parse_sample_rates("list_customers=0.01, get_customers=0.5,bogus")
+        self.assertEqual(rates, {"list_customers": 0.01, "get_customers": 0.5})
+        self.assertEqual(parse_sample_rates(""), {})
+
+    def test_sampling_filter(self):
+        """It should sample INFO logs per route but always keep warnings"""
+        log_filter = RequestSamplingFilter(1.0, {"list_customers": 0.0})
+        info = logging.LogRecord("flask.app", logging.INFO, __file__, 1, "info", None, None)
+        warning = logging.LogRecord("flask.app", logging.WARNING, __file__, 1, "warn", None, None)
+        with app.test_request_context("/customers"):
+            self.assertFalse(log_filter.filter(info))
+            self.assertTrue(log_filter.filter(warning))
+            self.assertEqual(warning.endpoint, "list_customers")
+        with app.test_request_context("/customers/1"):
+            self.assertTrue(log_filter.filter(info))
+        self.assertTrue(log_filter.filter(info))
+
+    def test_queue_handler_drops_when_full(self):
+        """It should drop records rather than block when the queue is full"""
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord("flask.app", logging.INFO, __file__, 1, "msg %d", (1,), None)
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(handler.queue.get_nowait().msg, "msg 1")
+
+    def test_rolling_profiler(self):
+        """It should sample the stacks of busy threads"""
+        done = threading.Event()
+        worker = threading.Thread(target=done.wait)
+        worker.start()
+        profiler = RollingProfiler(0.001, 60, lambda: (worker.ident,)).start()
+        time.sleep(0.05)
+        profiler.stop()
+        done.set()
+        worker.join()
+        self.assertIn("wait (threading.py", profiler.dump())
+
+    def test_fold_profile(self):
+        """It should fold a cProfile run into stacks weighted by time, split over the callers"""
+        def leaf():
+            time.sleep(0.01)
+
+        def once():
+            leaf()
+
+        def twice():
+            leaf()
+            leaf()
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        once()
+        twice()
+        profiler.disable()
+        sleeps = {}
+        for stack, micros in fold_profile(profiler).items():
+            frames = stack.split(";")
+            if frames[-1] == "<built-in method time.sleep>":
+                self.assertEqual(frames[-2].split(" ")[0], "leaf")
+                sleeps[frames[-3].split(" ")[0]] = micros
+        self.assertEqual(set(sleeps), {"once", "twice"})
+        self.assertGreater(sleeps["once"], 9000)
+        self.assertGreater(sleeps["twice"], 1.5 * sleeps["once"])
+
+    def test_fold_profile_recursion(self):
+        """It should count the time of a recursive function once"""
+        def walk(depth):
+            time.sleep(0.001)
+            if depth:
+                walk(depth - 1)
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        walk(30)
+        (lambda: walk(30))()
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        counts = fold_profile(profiler)
+        self.assertTrue(counts)
+        self.assertTrue(all(stack.count("walk (") <= 1 for stack in counts))
+        self.assertLess(sum(counts.values()), elapsed * 1e6 * 1.1)
+        self.assertGreater(sum(counts.values()), elapsed * 1e6 * 0.5)
+
+    def test_explain_savepoint(self):
+        """It should roll a failed Postgres EXPLAIN back to a savepoint, leaving the transaction usable"""
+        executed = []
+
+        class Cursor:
+            """A DBAPI cursor that fails on EXPLAIN"""
+            connection = None
+
+            def execute(self, sql, parameters=None):  # pylint: disable=unused-argument
+                executed.append(sql.split(" (")[0])
+                if sql.startswith("EXPLAIN"):
+                    raise ValueError("cannot explain")
+
+            def close(self):
+                """Nothing to close"""
+
+        Cursor.connection = SimpleNamespace(cursor=Cursor)
+        conn = SimpleNamespace(dialect=SimpleNamespace(name="postgresql"))
+        self.assertRaises(ValueError, explain, conn, Cursor(), "SELECT 1", {})
+        self.assertEqual(executed, [
+            "SAVEPOINT slow_query_explain", "EXPLAIN", "ROLLBACK TO SAVEPOINT slow_query_explain",
+            "RELEASE SAVEPOINT slow_query_explain",
+        ])
+
+    def test_token_bucket(self):
+        """It should allow bursts and then report when a token is due"""
+        bucket = TokenBucket(10, 2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        retry_after = bucket.acquire()
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 0.1)
+
+    def test_concurrency_limiter(self):
+        """It should queue a bounded number of waiters"""
+        limiter = ConcurrencyLimiter(1, 1, 1.0)
+        self.assertTrue(limiter.acquire())
+        threading.Timer(0.01, limiter.release).start()
+        self.assertTrue(limiter.acquire())
+        limiter.queue_size = 0
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_parse_limits(self):
+        """It should parse rate limit specifications"""
+        self.assertEqual(parse_limit("10/20"), (10.0, 20.0))
+        self.assertEqual(parse_limit("5"), (5.0, 5.0))
+        self.assertIsNone(parse_limit(""))
+        self.assertRaises(ValueError, parse_limit, "0/10")
+        self.assertRaises(ValueError, parse_limit, "5/0.5")
+        self.assertEqual(parse_route_limits("list_customers=1/2"), {"list_customers": (1.0, 2.0)})
+
+    def test_client_id_trusted_proxies(self):
+        """It should only take the client address from hops added by trusted proxies"""
+        proxied = Flask("proxied")
+        proxied.config["TRUSTED_PROXIES"] = 1
+        rate_limit.init_app(proxied)
+        proxied.add_url_rule("/", "client", rate_limit.client_id)
+        client = proxied.test_client()
+        response = client.get("/", headers={"X-Forwarded-For": "1.2.3.4, 10.0.0.7"}, environ_base={"REMOTE_ADDR": "10.0.0.1"})
+        self.assertEqual(response.get_data(as_text=True), "10.0.0.7")
+
+    def test_bloom_filter(self):
+        """It should never miss a member and keep false positives near the target"""
+        bloom = BloomFilter(1000, 0.01)
+        members = [f"user{i}@example.com" for i in range(1000)]
+        for member in members:
+            bloom.add(member)
+        self.assertTrue(all(member in bloom for member in members))
+        false_positives = sum(f"other{i}@example.com" in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.005)
+
+    def test_email_filter(self):
+        """It should only report emails it has never seen as absent"""
+        email_filter = EmailFilter()
+        email_filter.configure(
+            {"EMAIL_FILTER_ENABLED": True, "EMAIL_FILTER_SINGLE_PROCESS": True, "EMAIL_FILTER_CAPACITY": 100}
+        )
+        self.assertFalse(email_filter.definitely_absent("a@example.com"))
+        email_filter.rebuild(["A@Example.com"], 1)
+        self.assertFalse(email_filter.definitely_absent("a@example.com"))
+        self.assertTrue(email_filter.definitely_absent("b@example.com"))
+        email_filter.add("b@example.com")
+        self.assertFalse(email_filter.definitely_absent("b@example.com"))
+        self.assertFalse(email_filter.needs_rebuild())
+        email_filter.discard("a@example.com")
+        email_filter.discard("b@example.com")
+        self.assertTrue(email_filter.needs_rebuild())
+        self.assertEqual(email_filter.stats()["entries"], 2)
+
+    def test_email_filter_relay_sync(self):
+        """It should only trust the filter once it was rebuilt after the relay started listening"""
+        email_filter = EmailFilter()
+        email_filter.configure({"EMAIL_FILTER_ENABLED": True})
+        email_filter.rebuild([], 0)
+        self.assertFalse(email_filter.definitely_absent("a@example.com"))
+        rebuilt = threading.Event()
+
+        def loader():
+            email_filter.rebuild(["a@example.com"], 1)
+            rebuilt.set()
+
+        email_filter.on_relay_listening(True, loader)
+        self.assertTrue(rebuilt.wait(5))
+        for _ in range(100):
+            if email_filter.synced:
+                break
+            time.sleep(0.01)
+        self.assertTrue(email_filter.definitely_absent("b@example.com"))
+        email_filter.on_relayed_change("create", {"id": 2, "email": "b@example.com"})
+        self.assertFalse(email_filter.definitely_absent("b@example.com"))
+        email_filter.on_relay_listening(False, loader)
+        self.assertFalse(email_filter.definitely_absent("c@example.com"))
+
+    def test_group_commit(self):
+        """It should flush concurrent submissions together and route errors back"""
+        batches = []
+
+        def flush(items):
+            batches.append(list(items))
+            return [ValueError(item) if item == "bad" else item.upper() for item in items]
+
+        committer = GroupCommitter(flush, 4, 5.0)
+        results = {}
+
+        def submit(item):
+            try:
+                results[item] = committer.submit(item)
+            except ValueError as error:
+                results[item] = error
+
+        threads = [threading.Thread(target=submit, args=(item,)) for item in ("a", "b", "c", "bad")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(batches[0]), ["a", "b", "bad", "c"])
+        self.assertEqual(results["a"], "A")
+        self.assertIsInstance(results["bad"], ValueError)
+
+        # a lone submission is flushed once max_wait expires
+        committer.max_wait = 0.001
+        self.assertEqual(committer.submit("d"), "D")
+
+    def test_event_broker(self):
+        """It should filter events per subscriber and drop slow consumers"""
+        broker = EventBroker(max_subscribers=2, queue_size=1)
+        everything = broker.subscribe()
+        one_customer = broker.subscribe(customer_id=7)
+        self.assertIsNone(broker.subscribe())
+
+        broker.publish("update", {"id": 7})
+        self.assertEqual(one_customer.queue.get_nowait()["data"], {"id": 7})
+        broker.publish("update", {"id": 8})
+        self.assertTrue(one_customer.queue.empty())
+
+        # everything never read its first event, so it is dropped
+        self.assertTrue(everything.dropped)
+        self.assertEqual(broker.subscriber_count, 1)
+        stream = broker.stream(everything, 0.01)
+        self.assertEqual(next(stream), "retry: 3000\n\n")
+        self.assertIn("event: dropped", next(stream))
+
+    def test_schema_validate_many(self):
+        """It should validate payloads against checks compiled from the columns"""
+        schema = compile_schema(Customer.__table__, exclude=("id",))
+        valid = {"first_name": "Ada", "last_name": "Lovelace", "email": "ada@example.com", "password": "pw"}
+        self.assertEqual(schema.validate(valid), [])
+        self.assertEqual(schema.validate({**valid, "status": "suspended"}), [])
+        self.assertEqual(schema.validate({**valid, "password": "p" * 21}), ["password must be at most 20 characters"])
+        invalid = schema.validate_many([valid, {"first_name": None}, valid])
+        self.assertEqual(list(invalid), [1])
+        self.assertEqual(invalid[1][0], "first_name must not be null")
+        self.assertIn("missing email", invalid[1])
+
+    def test_sqlite_pragmas(self):
+        """It should tune every new SQLite connection"""
+        self.assertIn("PRAGMA cache_size = -1024", build_pragmas({"SQLITE_CACHE_SIZE_KB": 1024}))
+        with tempfile.TemporaryDirectory() as tempdir:
+            engine = create_engine(f"sqlite:///{os.path.join(tempdir, 'tuned.db')}")
+            with engine.connect() as conn:
+                self.assertEqual(conn.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal")
+                self.assertEqual(conn.exec_driver_sql("PRAGMA synchronous").scalar(), 1)
+                self.assertEqual(conn.exec_driver_sql("PRAGMA busy_timeout").scalar(), 5000)
+            engine.dispose()
+
+    def test_prepared_statements(self):
+        """It should set the prepare threshold on psycopg 3 connections only"""
+        self.assertIsNone(prepared.parse_threshold("none"))
+        self.assertIsNone(prepared.parse_threshold(""))
+        self.assertEqual(prepared.parse_threshold("0"), 0)
+        connection = type("Connection", (), {"__module__": "psycopg.connection"})()
+        prepared._on_connect(connection, None)  # pylint: disable=protected-access
+        self.assertEqual(connection.prepare_threshold, prepared.settings["threshold"])
+        self.assertEqual(connection.prepared_max, prepared.settings["max"])
+        other = type("Connection", (), {"__module__": "psycopg2.extensions"})()
+        prepared._on_connect(other, None)  # pylint: disable=protected-access
+        self.assertFalse(hasattr(other, "prepare_threshold"))
+
+    def test_jump_hash(self):
+        """It should only move keys onto a new shard"""
+        self.assertEqual(parse_shard_uris(" sqlite:///a.db, ,sqlite:///b.db"), ["sqlite:///a.db", "sqlite:///b.db"])
+        before = [jump_hash(key, 4) for key in range(1000)]
+        after = [jump_hash(key, 5) for key in range(1000)]
+        self.assertEqual(sorted(set(before)), [0, 1, 2, 3])
+        moved = [key for key in range(1000) if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 4 for key in moved))
+        self.assertTrue(100 < len(moved) < 300)
+
+    def test_query_cache(self):
+        """It should evict the least recently used entries and miss after an invalidation"""
+        self.assertEqual(list_cache_key({"first_name": "Ann", "email": "a@x.com"}), ("list", "email", "a@x.com"))
+        self.assertEqual(list_cache_key({}), ("list", None, None))
+        self.assertIsNone(list_cache_key({"last_name": "Lee"}))
+        cache = QueryCache()
+        cache.configure({"QUERY_CACHE_ENABLED": True, "QUERY_CACHE_MAX_BYTES": 300})
+        for key in ("a", "b", "c", "d"):
+            cache.put(key, cache.generation, key, 75)
+        cache.get("a")
+        cache.put("e", cache.generation, "e", 75)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.size, 300)
+        cache.put("huge", cache.generation, "huge", 76)
+        self.assertIsNone(cache.get("huge"))
+        generation = cache.generation
+        cache.invalidate("update", None)
+        self.assertIsNone(cache.get("a"))
+        cache.put("f", generation, "f", 10)
+        self.assertIsNone(cache.get("f"))
+
+    def test_single_flight(self):
+        """It should share one call among concurrent callers of a key, errors included"""
+        flights = SingleFlight()
+        flights.configure({"SINGLE_FLIGHT_ENABLED": True, "SINGLE_FLIGHT_TIMEOUT_SECONDS": 5})
+        release = threading.Event()
+        calls = []
+
+        def query(result):
+            calls.append(result)
+            release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        results = queue.Queue()
+
+        def read(key, result):
+            try:
+                results.put(flights.do(key, lambda: query(result)))
+            except (ValueError, FlightFailed) as error:
+                results.put(error)
+
+        threads = [threading.Thread(target=read, args=(key, result))
+                   for key, result in [("a", 1)] * 4 + [("b", ValueError("down"))] * 3]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        outcomes = [results.get_nowait() for _ in threads]
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(outcomes.count(1), 4)
+        errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        self.assertEqual(sum(isinstance(error, ValueError) for error in errors), 1)
+        self.assertEqual(sum(isinstance(error.__cause__, ValueError) for error in errors), 2)
+        self.assertEqual(flights.do(None, lambda: 2), 2)
+
+    def test_single_flight_interrupted(self):
+        """It should have waiters run the call themselves when the one in flight is interrupted"""
+        flights = SingleFlight()
+        flights.configure({"SINGLE_FLIGHT_ENABLED": True, "SINGLE_FLIGHT_TIMEOUT_SECONDS": 5})
+        release = threading.Event()
+
+        def interrupted():
+            release.wait(5)
+            raise KeyboardInterrupt()
+
+        def lead():
+            try:
+                flights.do("a", interrupted)
+            except KeyboardInterrupt:
+                pass
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        time.sleep(0.01)
+        threading.Timer(0.01, release.set).start()
+        self.assertEqual(flights.do("a", lambda: "own"), "own")
+        leader.join()
+
+    def test_single_flight_timeout(self):
+        """It should run the call itself when the one in flight takes too long"""
+        flights = SingleFlight()
+        flights.configure({"SINGLE_FLIGHT_ENABLED": True, "SINGLE_FLIGHT_TIMEOUT_SECONDS": 0.01})
+        release = threading.Event()
+        leader = threading.Thread(target=flights.do, args=("a", lambda: release.wait(5)))
+        leader.start()
+        time.sleep(0.01)
+        self.assertEqual(flights.do("a", lambda: "own"), "own")
+        release.set()
+        leader.join()
+
+    def test_readiness_pool_saturation(self):
+        """It should report an exhausted pool as not ready without pinging it"""
+        with tempfile.TemporaryDirectory() as tempdir:
+            engine = create_engine(
+                f"sqlite:///{os.path.join(tempdir, 'pool.db')}", poolclass=QueuePool, pool_size=1, max_overflow=0
+            )
+            probe = ReadinessProbe()
+            probe.configure(lambda: [engine], 60, 1.0, 0)
+            self.assertTrue(probe.check()["ready"])
+            self.assertEqual(pool_status(engine)["capacity"], 1)
+            with engine.connect():
+                self.assertEqual(pool_status(engine)["saturation"], 1.0)
+                probe.checked_at = None
+                result = probe.check()
+                self.assertFalse(result["ready"])
+                self.assertIn("exhausted", result["database"]["error"])
+            engine.dispose()
+
+    def test_readiness_first_probe(self):
+        """It should wait for the first ping in progress instead of reporting the database down"""
+        probe = ReadinessProbe()
+        probe.configure(lambda: [], 60, 1.0, 0)
+        self.assertEqual(probe._reasons([], {"in_flight": 0}), [])  # pylint: disable=protected-access
+        results = queue.Queue()
+        with probe._probe_lock:  # pylint: disable=protected-access
+            waiter = threading.Thread(target=lambda: results.put(probe.check()))
+            waiter.start()
+            time.sleep(0.05)
+            self.assertTrue(results.empty())
+            probe.database_ok, probe.database_error = False, "refused"
+            probe.checked_at = time.monotonic()
+        waiter.join()
+        result = results.get_nowait()
+        self.assertFalse(result["ready"])
+        self.assertEqual(result["reasons"], ["database unavailable: refused"])
+
     ######################################################################
     #  S A D  T E S T   C A S E S
     ######################################################################
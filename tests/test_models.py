@@ -3,10 +3,17 @@ Test cases for Customer Model
 
 """
 import logging
+import os
+import tempfile
 import unittest
+from datetime import datetime, timedelta
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
 from tests.factories import CustomerFactory
 from service.common.enums import CustomerStatus
-from service.models import Customer, db
+from service.common.sharding import id_blocks, rebalance
+from service.common.stats import customer_stats
+from service.models import Customer, CustomerTombstone, DataValidationError, DuplicateEmailError, IdempotencyKey, db
 
 ######################################################################
 #  C U S T O M E R   M O D E L   T E S T   C A S E S
@@ -41,6 +48,8 @@ class TestCustomer(unittest.TestCase):
 
         # delete all customers from the database from last tests
         db.session.query(Customer).delete()
+        db.session.query(IdempotencyKey).delete()
+        db.session.query(CustomerTombstone).delete()
         # commit the transaction
         db.session.commit()
 
@@ -94,6 +103,25 @@ class TestCustomer(unittest.TestCase):
         customer: Customer = Customer.find(customer.id)
         self.assertEqual(customer.first_name, new_name)
 
+    def test_customer_timestamps(self) -> None:
+        """It should stamp customers when they are created and updated"""
+        customer: Customer = self.create_customer()
+        self.assertIsNotNone(customer.created_at)
+        self.assertEqual(customer.created_at, customer.updated_at)
+        Customer.suspend(customer.id)
+        customer = Customer.find(customer.id)
+        self.assertGreater(customer.updated_at, customer.created_at)
+
+    def test_delete_leaves_tombstone(self) -> None:
+        """It should leave a tombstone when a customer is deleted"""
+        customer: Customer = self.create_customer()
+        customer_id = customer.id
+        customer.delete()
+        tombstone = CustomerTombstone.query.filter(CustomerTombstone.customer_id == customer_id).one()
+        self.assertEqual(tombstone.serialize()["id"], customer_id)
+        self.assertEqual(CustomerTombstone.purge_older_than(tombstone.deleted_at), 0)
+        self.assertEqual(CustomerTombstone.purge_older_than(datetime.utcnow() + timedelta(seconds=1)), 1)
+
     def test_delete_customer(self) -> None:
         """It should delete a customer record"""
 
@@ -117,10 +145,93 @@ class TestCustomer(unittest.TestCase):
         empty_customer: Customer = Customer.find(customer_id)
         self.assertIsNone(empty_customer)
 
+    def test_find_one_by_email(self):
+        """It should find a single customer by email ignoring case"""
+        customer = self.create_customer()
+        self.create_customer()
+        found = Customer.find_one_by_email(f"  {customer.email.upper()} ")
+        self.assertEqual(found.id, customer.id)
+        self.assertIsNone(Customer.find_one_by_email("nobody@nowhere.com"))
+
+    def test_find_many(self):
+        """It should find several customers by id with the query that suits each database"""
+        customers = [self.create_customer() for _ in range(3)]
+        found = Customer.find_many([customers[0].id, customers[2].id, 0])
+        self.assertEqual(sorted(found), [customers[0].id, customers[2].id])
+        for dialect, sql in [(postgresql.dialect(), "= ANY (%(ids)s"), (sqlite.dialect(), " IN (")]:
+            criterion = Customer._ids_criterion([1, 2], dialect)  # pylint: disable=protected-access
+            self.assertIn(sql, str(criterion.compile(dialect=dialect)))
+
+    def test_create_many(self):
+        """It should create several customers in one transaction"""
+        customers = CustomerFactory.create_batch(3)
+        self.assertEqual(Customer.create_many(customers), [None, None, None])
+        db.session.remove()
+        # the customers are detached but still readable
+        self.assertTrue(all(customer.id for customer in customers))
+        self.assertEqual(customers[0].serialize()["email"], customers[0].email)
+        self.assertEqual(len(Customer.all()), 3)
+
+    def test_create_many_with_bad_row(self):
+        """It should fail only the bad row of a batch"""
+        existing = self.create_customer()
+        customers = CustomerFactory.create_batch(3)
+        customers[1].email = existing.email
+        results = Customer.create_many(customers)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], SQLAlchemyError)
+        self.assertIsNone(results[2])
+        self.assertEqual(len(Customer.all()), 3)
+
+    def test_idempotency_key_expiry(self):
+        """It should forget idempotency keys once they expire"""
+        IdempotencyKey(key="live", fingerprint="f", status_code=201, body="{}").create(60)
+        IdempotencyKey(key="dead", fingerprint="f", status_code=201, body="{}").create(-1)
+        self.assertEqual(IdempotencyKey.find("live").status_code, 201)
+        self.assertIsNone(IdempotencyKey.find("dead"))
+        self.assertIsNone(IdempotencyKey.find("missing"))
+        self.assertEqual(IdempotencyKey.purge_expired(), 1)
+        self.assertEqual(IdempotencyKey.query.count(), 1)
+        # an expired key that was not purged yet is replaced, a live one is not
+        IdempotencyKey(key="dead", fingerprint="f", status_code=201, body="{}").create(-1)
+        IdempotencyKey(key="dead", fingerprint="g", status_code=200, body="{}").create(60)
+        self.assertEqual(IdempotencyKey.find("dead").fingerprint, "g")
+        duplicate = IdempotencyKey(key="live", fingerprint="g", status_code=200, body="{}")
+        self.assertRaises(SQLAlchemyError, duplicate.create, 60)
+
+    def test_stats_ignore_rolled_back_changes(self):
+        """It should only count Customer changes that commit"""
+        customer_stats.reconcile()
+        kept = CustomerFactory(email="kept@example.com")
+        lost = CustomerFactory(email="lost@example.com")
+        db.session.add(lost)
+        db.session.flush()
+        db.session.rollback()
+        savepoint = db.session.begin_nested()
+        db.session.add(CustomerFactory(email="savepoint@example.com"))
+        db.session.flush()
+        savepoint.rollback()
+        kept.create()
+        self.assertEqual(customer_stats.snapshot(10)["by_email_domain"], {"example.com": 1})
+
     ######################################################################
     #  S A D  T E S T   C A S E S
     ######################################################################
 
+    def test_deserialize_reports_every_error(self):
+        """It should report every problem with a Customer payload at once"""
+        data = CustomerFactory().serialize()
+        data.update(first_name=7, last_name="x" * 121, status="retired")
+        del data["email"]
+        with self.assertRaises(DataValidationError) as context:
+            Customer().deserialize(data)
+        message = str(context.exception)
+        self.assertIn("first_name must be a string", message)
+        self.assertIn("last_name must be at most 120 characters", message)
+        self.assertIn("missing email", message)
+        self.assertIn("status must be one of ACTIVE, SUSPENDED", message)
+        self.assertRaises(DataValidationError, Customer().deserialize, ["not", "a", "dict"])
+
     def test_typeerror_deserialize(self):
         """It should fail to deserialize with a TypeError"""
 
@@ -136,3 +247,106 @@ class TestCustomer(unittest.TestCase):
         customer = self.create_customer()
 
         self.assertRaises(TypeError, customer.deserialize(bad_obj))
+
+
+######################################################################
+#  S H A R D E D   C U S T O M E R   T E S T   C A S E S
+######################################################################
+
+
+class TestShardedCustomer(unittest.TestCase):
+    """ Test Cases for Customers spread across shards """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.tempdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.uris = [f"sqlite:///{os.path.join(self.tempdir.name, f'shard{i}.db')}" for i in range(3)]
+        Customer.init_shards(Customer.app, self.uris[:2])
+
+    def tearDown(self):
+        """ This runs after each test """
+        Customer.init_shards(Customer.app, [])
+        db.session.execute(id_blocks.delete())
+        db.session.commit()
+        self.tempdir.cleanup()
+
+    def test_create_and_find(self):
+        """It should spread Customers over the shards and find them by id"""
+        customers = CustomerFactory.create_batch(10)
+        for customer in customers:
+            customer.create()
+        ids = [customer.id for customer in customers]
+        self.assertEqual(len(set(ids)), 10)
+        counts = [shard().query(Customer).count() for shard in Customer.shards.sessions]
+        self.assertEqual(sum(counts), 10)
+        self.assertTrue(all(counts))
+        for customer in customers:
+            self.assertEqual(Customer.find(customer.id).email, customer.email)
+        self.assertEqual([customer.id for customer in Customer.all()], sorted(ids))
+
+    def test_scatter_queries(self):
+        """It should gather queries from every shard"""
+        customers = CustomerFactory.create_batch(6, first_name="Ada")
+        for customer in customers:
+            customer.create()
+        self.assertEqual(len(Customer.find_by_first_name("Ada")), 6)
+        self.assertEqual(Customer.find_by_email(customers[3].email)[0].id, customers[3].id)
+        self.assertEqual(Customer.find_one_by_email(customers[4].email.upper()).id, customers[4].id)
+        self.assertIsNone(Customer.find_one_by_email("nobody@example.com"))
+        self.assertTrue(Customer.email_exists(customers[5].email))
+        self.assertEqual(sorted(Customer.find_many([customer.id for customer in customers])), sorted(
+            customer.id for customer in customers
+        ))
+        duplicate = CustomerFactory(email=customers[0].email)
+        self.assertRaises(DataValidationError, duplicate.create)
+
+    def test_update_email_unique_across_shards(self):
+        """It should not update a Customer to an email held on another shard"""
+        customers = CustomerFactory.create_batch(8)
+        for customer in customers:
+            customer.create()
+        shard = Customer.shards.shard_for
+        other = next(customer for customer in customers[1:] if shard(customer.id) != shard(customers[0].id))
+        found = Customer.find(customers[0].id)
+        email = found.email
+        found.email = other.email
+        self.assertRaises(DuplicateEmailError, found.update)
+        Customer.shards.remove()
+        found = Customer.find(customers[0].id)
+        self.assertEqual(found.email, email)
+        # keeping its own email, or taking a free one, is allowed
+        found.first_name = "Kept"
+        found.update()
+        found.email = "free@example.com"
+        found.update()
+        self.assertEqual(Customer.find(customers[0].id).email, "free@example.com")
+
+    def test_update_and_delete(self):
+        """It should update and delete Customers on their own shard"""
+        customer = CustomerFactory()
+        customer.create()
+        found = Customer.find(customer.id)
+        found.first_name = "Changed"
+        found.update()
+        self.assertEqual(Customer.find_by_first_name("Changed")[0].id, customer.id)
+        Customer.find(customer.id).delete()
+        self.assertIsNone(Customer.find(customer.id))
+        changes = Customer.changes_since(None, 10)
+        self.assertEqual([(change[1], type(change[2])) for change in changes], [(customer.id, CustomerTombstone)])
+
+    def test_rebalance(self):
+        """It should move Customers onto a new shard"""
+        customers = CustomerFactory.create_batch(20)
+        for customer in customers:
+            customer.create()
+        ids = [customer.id for customer in customers]
+        Customer.init_shards(Customer.app, self.uris)
+        tables = {Customer.__table__: "id", CustomerTombstone.__table__: "customer_id"}
+        moving = rebalance(Customer.shards, tables, dry_run=True)["customer"]
+        self.assertGreater(moving, 0)
+        self.assertLess(moving, 20)
+        self.assertEqual(rebalance(Customer.shards, tables, batch_size=7)["customer"], moving)
+        self.assertEqual(rebalance(Customer.shards, tables, dry_run=True)["customer"], 0)
+        for customer_id in ids:
+            self.assertIsNotNone(Customer.find(customer_id))
+        self.assertEqual(len(Customer.all()), 20)
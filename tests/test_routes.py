@@ -10,9 +10,18 @@ import logging
 from typing import List
 from unittest import TestCase
 from urllib.parse import quote_plus
+import msgpack
 from service import app
-from service.models import db, init_db, Customer
+from service.models import db, init_db, Customer, CustomerTombstone, IdempotencyKey, email_filter
 from service.common import enums, status
+from service.common.sql_metrics import StatementBudgetExceeded
+from service.common.slow_queries import slow_query_log
+from service.common.stats import customer_stats
+from service.common.group_commit import GroupCommitter
+from service.common.rate_limit import ConcurrencyLimiter, RateLimiter
+from service.common.query_cache import query_cache
+from service.common.readiness import readiness_probe
+from service.common.single_flight import single_flight
 from tests.factories import CustomerFactory
 
 # DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
@@ -36,6 +45,7 @@ class TestCustomerServer(TestCase):
         app.config["DEBUG"] = False
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["CHANGE_FEED_SETTLE_SECONDS"] = 0
         app.logger.setLevel(logging.CRITICAL)
         init_db(app)
 
@@ -48,6 +58,8 @@ class TestCustomerServer(TestCase):
         """Runs before each test"""
         self.client = app.test_client()
         db.session.query(Customer).delete()  # clean up the last tests
+        db.session.query(IdempotencyKey).delete()
+        db.session.query(CustomerTombstone).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -80,6 +92,44 @@ class TestCustomerServer(TestCase):
         self.assertEqual(data["status"], 200)
         self.assertEqual(data["message"], "Healthy")
 
+    def test_readiness(self):
+        """It should be ready while the database answers and the worker is not saturated"""
+        readiness_probe.checked_at = None
+        response = self.client.get("/readyz")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertTrue(data["ready"])
+        self.assertTrue(data["database"]["ok"])
+        self.assertEqual(data["requests"]["in_flight"], 0)
+        self.assertEqual(len(data["pools"]), 1)
+
+    def test_readiness_caches_probe(self):
+        """It should not ping the database again within the probe interval"""
+        readiness_probe.checked_at = None
+        self.client.get("/readyz")
+        checked_at = readiness_probe.checked_at
+        self.client.get("/readyz")
+        self.assertEqual(readiness_probe.checked_at, checked_at)
+
+    def test_readiness_overloaded(self):
+        """It should answer 503 when requests are queueing or too many are in flight"""
+        limiter = ConcurrencyLimiter(1, 5, 0.01)
+        limiter.waiting = 2
+        app.extensions["concurrency_limiter"] = limiter
+        try:
+            response = self.client.get("/readyz")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            data = response.get_json()
+            self.assertFalse(data["ready"])
+            self.assertEqual(data["requests"]["waiting"], 2)
+        finally:
+            del app.extensions["concurrency_limiter"]
+        readiness_probe.max_in_flight, readiness_probe.in_flight = 1, 1
+        try:
+            self.assertEqual(self.client.get("/readyz").status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            readiness_probe.max_in_flight, readiness_probe.in_flight = 0, 0
+
     def test_root_url(self):
         """It should get the root URL message"""
         response = self.client.get("/")
@@ -122,6 +172,15 @@ class TestCustomerServer(TestCase):
         data = response.get_json()
         self.assertEqual(data["first_name"], test_customer.first_name)
 
+    def test_get_customer_by_email_path(self):
+        """It should Get a single Customer by email ignoring case"""
+        test_customer = self._create_customers(3)[1]
+        response = self.client.get(f"{BASE_URL}/by-email/{test_customer.email.upper()}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["id"], test_customer.id)
+        self.assertIn("db-rows;desc=1", response.headers["Server-Timing"])
+
     def test_create_customer(self):
         """It should Create a new Customer"""
 
@@ -272,6 +331,12 @@ class TestCustomerServer(TestCase):
         logging.debug("Response data = %s", data)
         self.assertIn("was not found", data["message"])
 
+    def test_get_customer_by_email_not_found(self):
+        """It should not Get a Customer by an unknown email"""
+        response = self.client.get(f"{BASE_URL}/by-email/nobody@nowhere.com")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("was not found", response.get_json()["message"])
+
     def test_create_customer_no_data(self):
         """It should not Create a Customer with missing data"""
         response = self.client.post(BASE_URL, json={})
@@ -300,7 +365,7 @@ class TestCustomerServer(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
         data = response.get_json()
-        self.assertIn('Failed to create customer'.lower(), data['message'].lower())
+        self.assertIn("first_name must not be null", data["message"])
 
     def test_update_customer_id(self):
         """It should not update a Customer id"""
@@ -375,3 +440,595 @@ class TestCustomerServer(TestCase):
         # check the data just to be sure
         for customer in data:
             self.assertEqual(customer["first_name"], test_name)
+
+    def test_query_customer_list_by_ids(self):
+        """It should return the customers with the given ids in order"""
+        customers = self._create_customers(3)
+        ids = [customers[2].id, 0, customers[0].id, customers[2].id]
+        response = self.client.get(BASE_URL, query_string={"ids": ",".join(map(str, ids))})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([customer["id"] for customer in data["customers"]], [customers[2].id, customers[0].id])
+        self.assertEqual(data["missing"], [0])
+
+        response = self.client.get(BASE_URL, query_string={"ids": "1,two"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        too_many = ",".join(str(n) for n in range(501))
+        response = self.client.get(BASE_URL, query_string={"ids": too_many})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  S Q L   I N S T R U M E N T A T I O N   T E S T   C A S E S
+    ######################################################################
+
+    def test_server_timing_header(self):
+        """It should report the SQL issued by a request in Server-Timing"""
+        test_customer = self._create_customers(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_customer.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        server_timing = response.headers.get("Server-Timing")
+        self.assertIn("db;dur=", server_timing)
+        self.assertIn('desc="1 statements"', server_timing)
+        self.assertIn("db-rows;desc=1", server_timing)
+
+    def test_metrics(self):
+        """It should expose SQL metrics per endpoint"""
+        self._create_customers(1)
+        self.client.get(BASE_URL)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('db_statements_total{endpoint="list_customers"}', response.get_data(as_text=True))
+
+    def test_statement_budget_strict_mode(self):
+        """It should fail a request that exceeds the statement budget in strict mode"""
+        test_customer = self._create_customers(1)[0]
+        app.config.update(SQL_STATEMENT_BUDGET=1, SQL_STRICT_MODE=True)
+        try:
+            self.assertRaises(
+                StatementBudgetExceeded, self.client.delete, f"{BASE_URL}/{test_customer.id}"
+            )
+        finally:
+            app.config.update(SQL_STATEMENT_BUDGET=0, SQL_STRICT_MODE=False)
+            db.session.rollback()
+
+    def test_slow_query_log(self):
+        """It should log slow queries with redacted passwords and a plan"""
+        app.config.update(SLOW_QUERY_THRESHOLD_MS=0.000001, SLOW_QUERY_EXPLAIN=True, ADMIN_TOKEN="t0ken")
+        slow_query_log.reset()
+        try:
+            with self.assertLogs(app.logger, level="WARNING") as logs:
+                test_customer = self._create_customers(1)[0]
+                self.client.get(BASE_URL, query_string={"first_name": test_customer.first_name})
+            inserts = [line for line in logs.output if "INSERT" in line]
+            self.assertTrue(inserts)
+            self.assertNotIn(test_customer.password, inserts[0])
+            self.assertIn("********", inserts[0])
+
+            response = self.client.get("/diagnostics/slow-queries", headers={"X-Admin-Token": "t0ken"})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            selects = [entry for entry in response.get_json() if "list_customers" in entry["routes"]]
+            self.assertTrue(selects[0]["statement"].startswith("SELECT"))
+            self.assertTrue(selects[0]["plan"])
+        finally:
+            app.config.update(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN=False, ADMIN_TOKEN="")
+
+    def test_diagnostics_require_token(self):
+        """It should refuse diagnostics without a valid admin token"""
+        response = self.client.get("/diagnostics/slow-queries")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        app.config["ADMIN_TOKEN"] = "t0ken"
+        try:
+            response = self.client.get("/diagnostics/slow-queries", headers={"X-Admin-Token": "wrong"})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        finally:
+            app.config["ADMIN_TOKEN"] = ""
+
+    ######################################################################
+    #  P R O F I L I N G   T E S T   C A S E S
+    ######################################################################
+
+    def test_profile_request(self):
+        """It should profile a single request when asked with a valid token"""
+        app.config.update(PROFILING_ENABLED=True, ADMIN_TOKEN="t0ken")
+        headers = {"X-Admin-Token": "t0ken"}
+        try:
+            self._create_customers(3)
+            response = self.client.get(BASE_URL, headers=dict(headers, **{"X-Profile": "deterministic"}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            profile_id = response.headers["X-Profile-Id"]
+            response = self.client.get(f"/diagnostics/profiles/{profile_id}", headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # folded stacks: frames separated by semicolons, then a weight in microseconds
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertTrue(any("list_customers (routes.py" in line for line in lines))
+            stack, weight = lines[0].rsplit(" ", 1)
+            self.assertIn(";", stack)
+            self.assertTrue(weight.isdigit())
+
+            response = self.client.get(BASE_URL, headers=dict(headers, **{"X-Profile": "sample"}))
+            self.assertIn("X-Profile-Id", response.headers)
+
+            # without the token the header is ignored
+            response = self.client.get(BASE_URL, headers={"X-Profile": "sample"})
+            self.assertNotIn("X-Profile-Id", response.headers)
+            response = self.client.get("/diagnostics/profiles/missing", headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            app.config.update(PROFILING_ENABLED=False, ADMIN_TOKEN="")
+
+    ######################################################################
+    #  M E M O R Y   D I A G N O S T I C S   T E S T   C A S E S
+    ######################################################################
+
+    def test_memory_diagnostics(self):
+        """It should report memory statistics and diff tracemalloc snapshots"""
+        app.config["ADMIN_TOKEN"] = "t0ken"
+        headers = {"X-Admin-Token": "t0ken"}
+        try:
+            response = self.client.get("/diagnostics/memory", headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertGreater(data["rss_bytes"], 0)
+            self.assertIn("objects", data["identity_map"])
+            self.assertIn("counts", data["gc"])
+
+            response = self.client.post("/diagnostics/memory/snapshots", headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertIsNone(response.get_json()["growth"])
+            self._create_customers(5)
+            response = self.client.post("/diagnostics/memory/snapshots?limit=5", headers=headers)
+            data = response.get_json()
+            self.assertEqual(data["snapshot"], 1)
+            self.assertTrue(data["growth"])
+            self.assertLessEqual(len(data["top"]), 5)
+
+            response = self.client.delete("/diagnostics/memory/snapshots", headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertFalse(self.client.get("/diagnostics/memory", headers=headers).get_json()["tracing"])
+        finally:
+            app.config["ADMIN_TOKEN"] = ""
+
+    ######################################################################
+    #  A D M I S S I O N   C O N T R O L   T E S T   C A S E S
+    ######################################################################
+
+    def test_rate_limit_per_route(self):
+        """It should answer 429 with Retry-After once a route limit is used up"""
+        app.extensions["rate_limiter"] = RateLimiter(None, (100, 100), {"list_customers": (0.5, 2)})
+        try:
+            for _ in range(2):
+                self.assertEqual(self.client.get(BASE_URL).status_code, status.HTTP_200_OK)
+            response = self.client.get(BASE_URL)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response.headers["Retry-After"], "2")
+            # other routes and other clients have their own buckets
+            self.assertEqual(self.client.get(f"{BASE_URL}/0").status_code, status.HTTP_404_NOT_FOUND)
+            # a made-up X-Forwarded-For does not give a client a new bucket
+            response = self.client.get(BASE_URL, headers={"X-Forwarded-For": "10.0.0.3"})
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            response = self.client.get(BASE_URL, environ_base={"REMOTE_ADDR": "10.0.0.2"})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get("/healthcheck").status_code, status.HTTP_200_OK)
+        finally:
+            del app.extensions["rate_limiter"]
+
+    def test_list_customers_cached(self):
+        """It should answer repeated list filters from the cache until a customer changes"""
+        query_cache.enabled = True
+        try:
+            customer = self._create_customers(1)[0]
+            url = f"{BASE_URL}?first_name={quote_plus(customer.first_name)}"
+            self.assertEqual(self.client.get(url).headers["X-Cache"], "MISS")
+            response = self.client.get(url)
+            self.assertEqual(response.headers["X-Cache"], "HIT")
+            self.assertEqual(response.get_json()[0]["id"], customer.id)
+            packed = self.client.get(url, headers={"Accept": "application/msgpack"})
+            self.assertEqual(packed.headers["X-Cache"], "MISS")
+            self.assertEqual(msgpack.unpackb(packed.data)[0]["id"], customer.id)
+
+            response = self.client.put(f"{BASE_URL}/{customer.id}/suspend")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(url)
+            self.assertEqual(response.headers["X-Cache"], "MISS")
+            self.assertEqual(response.get_json()[0]["status"], "SUSPENDED")
+            self.assertNotIn("X-Cache", self.client.get(f"{BASE_URL}?ids={customer.id}").headers)
+        finally:
+            query_cache.enabled = False
+            query_cache.clear()
+
+    def test_reads_coalesced(self):
+        """It should still answer reads and misses with request coalescing on"""
+        single_flight.enabled = True
+        try:
+            customer = self._create_customers(1)[0]
+            response = self.client.get(f"{BASE_URL}/{customer.id}")
+            self.assertEqual(response.get_json()["email"], customer.email)
+            self.assertEqual(self.client.get(f"{BASE_URL}/0").status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+        finally:
+            single_flight.enabled = False
+
+    def test_concurrency_limit(self):
+        """It should answer 503 when no concurrency slot is free"""
+        limiter = ConcurrencyLimiter(1, 0, 0.01)
+        app.extensions["concurrency_limiter"] = limiter
+        try:
+            self.assertEqual(self.client.get(BASE_URL).status_code, status.HTTP_200_OK)
+            self.assertEqual(limiter.in_flight, 0)
+            limiter.acquire()
+            response = self.client.get(BASE_URL)
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response.headers["Retry-After"], "1")
+            limiter.release()
+        finally:
+            del app.extensions["concurrency_limiter"]
+
+    ######################################################################
+    #  I D E M P O T E N C Y   T E S T   C A S E S
+    ######################################################################
+
+    def test_create_customer_idempotent_retry(self):
+        """It should replay the original response when a create is retried"""
+        payload = CustomerFactory().serialize()
+        headers = {"Idempotency-Key": "create-abc"}
+        first = self.client.post(BASE_URL, json=payload, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+
+        retry = self.client.post(BASE_URL, json=payload, headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.headers["location"], first.headers["location"])
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(len(Customer.all()), 1)
+
+        # without the key the duplicate email is still rejected
+        response = self.client.post(BASE_URL, json=payload)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_create_customer_idempotency_key_expired(self):
+        """It should store the response again when an expired Idempotency-Key is reused"""
+        IdempotencyKey(key="create-old", fingerprint="f", status_code=201, body="{}").create(-1)
+        payload = CustomerFactory().serialize()
+        headers = {"Idempotency-Key": "create-old"}
+        first = self.client.post(BASE_URL, json=payload, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        retry = self.client.post(BASE_URL, json=payload, headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(IdempotencyKey.query.count(), 1)
+
+    def test_create_customer_idempotency_key_reused(self):
+        """It should not reuse an Idempotency-Key for a different request"""
+        headers = {"Idempotency-Key": "create-xyz"}
+        response = self.client.post(BASE_URL, json=CustomerFactory().serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(BASE_URL, json=CustomerFactory().serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        response = self.client.post(BASE_URL, json=CustomerFactory().serialize(), headers={"Idempotency-Key": "k" * 300})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  E M A I L   F I L T E R   T E S T   C A S E S
+    ######################################################################
+
+    def test_email_filter_skips_database(self):
+        """It should answer lookups for unknown emails without a query"""
+        email_filter.configure({"EMAIL_FILTER_ENABLED": True, "EMAIL_FILTER_SINGLE_PROCESS": True})
+        try:
+            test_customer = self._create_customers(1)[0]
+            Customer.rebuild_email_filter()
+
+            response = self.client.get(BASE_URL, query_string={"email": "nobody@nowhere.com"})
+            self.assertEqual(response.get_json(), [])
+            self.assertIn('desc="0 statements"', response.headers["Server-Timing"])
+
+            response = self.client.get(BASE_URL, query_string={"email": test_customer.email})
+            self.assertEqual(len(response.get_json()), 1)
+
+            # a customer created after the rebuild is found as well
+            new_customer = self._create_customers(1)[0]
+            response = self.client.get(BASE_URL, query_string={"email": new_customer.email})
+            self.assertEqual(len(response.get_json()), 1)
+
+            # duplicates are caught before the insert
+            response = self.client.post(BASE_URL, json=new_customer.serialize())
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+            app.config["ADMIN_TOKEN"] = "t0ken"
+            response = self.client.get("/diagnostics/email-filter", headers={"X-Admin-Token": "t0ken"})
+            self.assertEqual(response.get_json()["entries"], 2)
+            self.assertGreaterEqual(response.get_json()["skipped_lookups"], 1)
+        finally:
+            email_filter.configure({})
+            app.config["ADMIN_TOKEN"] = ""
+
+    def test_email_filter_not_trusted_across_workers(self):
+        """It should query the database while the filter may be missing other workers' emails"""
+        email_filter.configure({"EMAIL_FILTER_ENABLED": True})
+        try:
+            Customer.rebuild_email_filter()
+            # as if another worker had created the customer
+            other = CustomerFactory()
+            other.id = None
+            db.session.add(other)
+            db.session.commit()
+
+            response = self.client.get(BASE_URL, query_string={"email": other.email})
+            self.assertEqual(len(response.get_json()), 1)
+            response = self.client.get(f"{BASE_URL}/by-email/{quote_plus(other.email)}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(BASE_URL, json=other.serialize())
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        finally:
+            email_filter.configure({})
+
+    ######################################################################
+    #  G R O U P   C O M M I T   T E S T   C A S E S
+    ######################################################################
+
+    def test_create_customer_group_commit(self):
+        """It should create customers through the group committer"""
+        Customer.group_committer = GroupCommitter(Customer.create_many, 8, 0.001)
+        try:
+            customers = self._create_customers(2)
+            response = self.client.get(f"{BASE_URL}/{customers[1].id}")
+            self.assertEqual(response.get_json()["email"], customers[1].email)
+            response = self.client.post(BASE_URL, json=customers[0].serialize())
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        finally:
+            Customer.group_committer = None
+
+    ######################################################################
+    #  C H A N G E   F E E D   T E S T   C A S E S
+    ######################################################################
+
+    def test_customer_change_feed(self):
+        """It should page through creates, updates and deletes after a cursor"""
+        customers = self._create_customers(3)
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"limit": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([change["id"] for change in data["changes"]], [customers[0].id, customers[1].id])
+        self.assertTrue(data["has_more"])
+
+        data = self.client.get(f"{BASE_URL}/changes", query_string={"since": data["next_cursor"]}).get_json()
+        self.assertEqual([change["id"] for change in data["changes"]], [customers[2].id])
+        self.assertFalse(data["has_more"])
+        cursor = data["next_cursor"]
+
+        # nothing new since the cursor
+        data = self.client.get(f"{BASE_URL}/changes", query_string={"since": cursor}).get_json()
+        self.assertEqual(data["changes"], [])
+        self.assertEqual(data["next_cursor"], cursor)
+
+        self.client.put(f"{BASE_URL}/{customers[1].id}/suspend")
+        self.client.delete(f"{BASE_URL}/{customers[0].id}")
+        data = self.client.get(f"{BASE_URL}/changes", query_string={"since": cursor}).get_json()
+        self.assertEqual(
+            [(change["type"], change["id"]) for change in data["changes"]],
+            [("upsert", customers[1].id), ("delete", customers[0].id)],
+        )
+        self.assertEqual(data["changes"][0]["status"], "SUSPENDED")
+        self.assertIsNotNone(data["changes"][1]["deleted_at"])
+
+    def test_customer_change_feed_bad_cursor(self):
+        """It should reject a malformed change feed cursor"""
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  E V E N T   S T R E A M   T E S T   C A S E S
+    ######################################################################
+
+    def test_customer_event_stream(self):
+        """It should stream matching customer changes as Server-Sent Events"""
+        test_customer = self._create_customers(1)[0]
+        app.config["SSE_KEEPALIVE_SECONDS"] = 0.01
+        try:
+            response = self.client.get(f"{BASE_URL}/events?events=suspend,delete", buffered=False)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.mimetype, "text/event-stream")
+            stream = iter(response.response)
+            self.assertEqual(next(stream), b"retry: 3000\n\n")
+
+            self.client.put(f"{BASE_URL}/{test_customer.id}/activate")
+            self.client.put(f"{BASE_URL}/{test_customer.id}/suspend")
+            self.client.delete(f"{BASE_URL}/{test_customer.id}")
+            message = next(stream).decode()
+            self.assertIn("event: suspend\n", message)
+            self.assertIn('"status": "SUSPENDED"', message)
+            self.assertNotIn("password", message)
+            message = next(stream).decode()
+            self.assertIn("event: delete\n", message)
+            self.assertIn(f'"id": {test_customer.id}', message)
+            self.assertEqual(next(stream), b": keepalive\n\n")
+            response.close()
+        finally:
+            app.config["SSE_KEEPALIVE_SECONDS"] = 15
+        self.assertEqual(app.extensions["event_broker"].subscriber_count, 0)
+
+    def test_customer_event_stream_full(self):
+        """It should refuse event streams beyond the per-worker limit"""
+        broker = app.extensions["event_broker"]
+        subscribers = [broker.subscribe() for _ in range(broker.max_subscribers)]
+        try:
+            response = self.client.get(f"{BASE_URL}/events")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            for subscriber in subscribers:
+                broker.unsubscribe(subscriber)
+
+    ######################################################################
+    #  S T A T I S T I C S   T E S T   C A S E S
+    ######################################################################
+
+    def test_customer_stats(self):
+        """It should count Customers by status and email domain without a scan"""
+        ids = []
+        for email in ("a@example.com", "b@example.com", "c@Example.org"):
+            response = self.client.post(BASE_URL, json=CustomerFactory(email=email).serialize())
+            ids.append(response.get_json()["id"])
+        customer_stats.reconcile()
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["total"], 3)
+        self.assertEqual(data["by_status"], {"ACTIVE": 3})
+        self.assertEqual(data["by_email_domain"], {"example.com": 2, "example.org": 1})
+
+        # changes are counted as they commit, without recounting
+        reconciled_at = data["reconciled_at"]
+        self.client.put(f"{BASE_URL}/{ids[0]}/suspend")
+        self.client.delete(f"{BASE_URL}/{ids[1]}")
+        updated = CustomerFactory(email="c@example.net").serialize()
+        self.client.put(f"{BASE_URL}/{ids[2]}", json=updated)
+        data = self.client.get(f"{BASE_URL}/stats?domains=1").get_json()
+        self.assertEqual(data["reconciled_at"], reconciled_at)
+        self.assertEqual(data["by_status"], {"ACTIVE": 1, "SUSPENDED": 1})
+        self.assertEqual(data["email_domains"], 2)
+        self.assertEqual(len(data["by_email_domain"]), 1)
+
+        customer_stats.reconcile()
+        recounted = self.client.get(f"{BASE_URL}/stats").get_json()
+        self.assertEqual(recounted["by_status"], data["by_status"])
+        self.assertEqual(recounted["by_email_domain"], {"example.com": 1, "example.net": 1})
+
+    ######################################################################
+    #  B A T C H   T E S T   C A S E S
+    ######################################################################
+
+    def test_batch_atomic(self):
+        """It should run a batch of operations in one transaction"""
+        existing = self._create_customers(1)[0]
+        new_customer = CustomerFactory().serialize()
+        operations = [
+            {"method": "POST", "path": BASE_URL, "body": new_customer},
+            {"method": "PUT", "path": f"{BASE_URL}/{existing.id}/suspend"},
+            {"method": "GET", "path": f"{BASE_URL}/{existing.id}"},
+        ]
+        response = self.client.post("/batch", json={"operations": operations})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertTrue(data["committed"])
+        self.assertEqual([result["status"] for result in data["results"]], [201, 200, 200])
+        self.assertIn("location", data["results"][0])
+        self.assertEqual(data["results"][2]["body"]["status"], "SUSPENDED")
+        self.assertEqual(len(Customer.find_by_email(new_customer["email"])), 1)
+
+    def test_batch_atomic_rollback(self):
+        """It should roll back an atomic batch when an operation fails"""
+        existing = self._create_customers(1)[0]
+        operations = [
+            {"method": "PUT", "path": f"{BASE_URL}/{existing.id}/suspend"},
+            {"method": "DELETE", "path": f"{BASE_URL}/{existing.id}"},
+            {"method": "PUT", "path": f"{BASE_URL}/{existing.id}/activate"},
+            {"method": "GET", "path": f"{BASE_URL}/{existing.id}"},
+        ]
+        data = self.client.post("/batch", json={"operations": operations}).get_json()
+        self.assertFalse(data["committed"])
+        self.assertEqual([result["status"] for result in data["results"]], [200, 204, 404, 424])
+        customer = self.client.get(f"{BASE_URL}/{existing.id}").get_json()
+        self.assertEqual(customer["status"], "ACTIVE")
+
+    def test_batch_independent(self):
+        """It should commit each operation of a non-atomic batch on its own"""
+        existing = self._create_customers(1)[0]
+        operations = [
+            {"method": "PUT", "path": f"{BASE_URL}/{existing.id}/suspend"},
+            {"method": "PUT", "path": f"{BASE_URL}/0/activate"},
+            {"method": "GET", "path": "/diagnostics/memory"},
+            {"method": "GET", "path": "/nowhere"},
+            {"path": 5},
+        ]
+        data = self.client.post("/batch", json={"atomic": False, "operations": operations}).get_json()
+        self.assertNotIn("committed", data)
+        self.assertEqual([result["status"] for result in data["results"]], [200, 404, 400, 404, 400])
+        customer = self.client.get(f"{BASE_URL}/{existing.id}").get_json()
+        self.assertEqual(customer["status"], "SUSPENDED")
+
+        response = self.client.post("/batch", json={"operations": []})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_operation_error(self):
+        """It should answer 500 for just the operation of a batch that fails unexpectedly"""
+        first, second = self._create_customers(2)
+        duplicate = dict(second.serialize(), email=first.email)
+        operations = [
+            {"method": "PUT", "path": f"{BASE_URL}/{first.id}/suspend"},
+            {"method": "PUT", "path": f"{BASE_URL}/{second.id}", "body": duplicate},
+            {"method": "GET", "path": f"{BASE_URL}/{second.id}"},
+        ]
+        response = self.client.post("/batch", json={"atomic": False, "operations": operations})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.get_json()["results"]
+        self.assertEqual([result["status"] for result in results], [200, 500, 200])
+        self.assertEqual(results[2]["body"]["email"], second.email)
+        customer = self.client.get(f"{BASE_URL}/{first.id}").get_json()
+        self.assertEqual(customer["status"], "SUSPENDED")
+
+        data = self.client.post("/batch", json={"operations": operations}).get_json()
+        self.assertFalse(data["committed"])
+        self.assertEqual([result["status"] for result in data["results"]], [200, 500, 424])
+
+    def test_batch_rate_limit_and_idempotency(self):
+        """It should rate limit each operation of a batch and replay a batch by Idempotency-Key"""
+        app.extensions["rate_limiter"] = RateLimiter(None, (100, 100), {"get_customers": (0.5, 1)})
+        try:
+            existing = self._create_customers(1)[0]
+            operations = [{"method": "GET", "path": f"{BASE_URL}/{existing.id}"}] * 2
+            headers = {"Idempotency-Key": "batch-1"}
+            response = self.client.post("/batch", json={"atomic": False, "operations": operations}, headers=headers)
+            results = response.get_json()["results"]
+            self.assertEqual([result["status"] for result in results], [200, 429])
+            response = self.client.post("/batch", json={"atomic": False, "operations": operations}, headers=headers)
+            self.assertEqual(response.headers.get("Idempotent-Replayed"), "true")
+            self.assertEqual(response.get_json()["results"], results)
+        finally:
+            del app.extensions["rate_limiter"]
+
+    ######################################################################
+    #  C O N T E N T   N E G O T I A T I O N   T E S T   C A S E S
+    ######################################################################
+
+    def test_customer_msgpack(self):
+        """It should create, update and read Customers as MessagePack"""
+        headers = {"Accept": "application/msgpack"}
+        test_customer = CustomerFactory().serialize()
+        response = self.client.post(
+            BASE_URL,
+            data=msgpack.packb(test_customer),
+            content_type="application/msgpack",
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.mimetype, "application/msgpack")
+        self.assertIn("Accept", response.headers["Vary"])
+        created = msgpack.unpackb(response.data)
+        self.assertEqual(created["email"], test_customer["email"])
+        self.assertIn("location", response.headers)
+
+        test_customer["first_name"] = "Packed"
+        response = self.client.put(
+            f"{BASE_URL}/{created['id']}", data=msgpack.packb(test_customer), content_type="application/x-msgpack"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(response.get_json()["first_name"], "Packed")
+
+        response = self.client.get(f"{BASE_URL}/{created['id']}", headers=headers)
+        self.assertEqual(msgpack.unpackb(response.data)["first_name"], "Packed")
+        response = self.client.get(BASE_URL, headers=headers)
+        self.assertEqual([customer["id"] for customer in msgpack.unpackb(response.data)], [created["id"]])
+        response = self.client.get(BASE_URL, query_string={"ids": created["id"]}, headers=headers)
+        self.assertEqual(msgpack.unpackb(response.data)["missing"], [])
+
+        # JSON is preferred when both are equally acceptable
+        response = self.client.get(BASE_URL, headers={"Accept": "application/msgpack, application/json"})
+        self.assertEqual(response.mimetype, "application/json")
+
+    def test_customer_msgpack_bad_body(self):
+        """It should not Create a Customer from a corrupt MessagePack body"""
+        response = self.client.post(BASE_URL, data=b"\xc1", content_type="application/msgpack")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)